@@ -0,0 +1,17 @@
+# In-process application for the benchmarks, on its own SQLite database.
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+
+# An in-memory database when 'database_path' is None.
+def create_benchmark_app(database_path=None):
+    # measured without the overhead of the instrumentation, unless asked for
+    os.environ.setdefault('COMPANIFY_INSTRUMENTATION', '0')
+    # a single client sends every request, which the rate limits would turn away
+    os.environ.setdefault('COMPANIFY_ADMISSION_CONTROL', '0')
+    os.environ['COMPANIFY_TEST_DATABASE_URI'] = 'sqlite://' if database_path is None else 'sqlite:///' + database_path
+    from app.app_core import create_app, run_modes
+    return create_app(run_modes['test'])
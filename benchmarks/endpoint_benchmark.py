@@ -0,0 +1,262 @@
+# Load benchmark of every endpoint of the API, run in-process with Flask's test client
+# on a synthetic org chart (see org_chart.py). For each endpoint it reports the latency
+# percentiles of 'requests' sequential requests, on randomly chosen (but reproducible)
+# companies and employees, and the resulting throughput.
+#
+# Results can be saved as a named baseline (benchmarks/baselines/<name>.json) and later
+# runs compared against it: an endpoint whose p50 or p90 got slower than the baseline by
+# more than the tolerance is reported as a regression, and the script exits with 1.
+# Baselines are only comparable between runs with the same configuration and machine.
+#
+#     python benchmarks/endpoint_benchmark.py --size small --save-baseline small
+#     python benchmarks/endpoint_benchmark.py --size small --compare small
+#     python benchmarks/endpoint_benchmark.py --companies 100 --employees 10000 --depth 8 --fan-out 4
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_app import create_benchmark_app
+from org_chart import OrgChart, FIRST_NAMES
+
+BASELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# companies, employees per company, depth, fan-out
+SIZES = {
+    'small': (10, 1000, 5, 5),
+    'medium': (50, 10000, 7, 5),
+    'large': (200, 10000, 8, 4),
+    'huge': (1000, 2000, 6, 6)
+}
+
+
+# ================================ S C E N A R I O S ================================ #
+# One per endpoint (or per distinct use of one). Each builds its next request from the
+# random generator and the benchmark state: (method, path, json body, headers).
+# Write scenarios only touch employees and companies they create, so the read
+# scenarios always see the generated org chart.
+# =================================================================================== #
+class BenchmarkState:
+    def __init__(self, chart, rng):
+        self.chart = chart
+        self.rng = rng
+        self.created = []
+        self.bulk_created = []
+        self.created_companies = []
+        self.sequence = 0
+        self.etags = {}
+
+    def company(self):
+        return self.rng.randrange(self.chart.companies) + 1
+
+    def employee(self):
+        return self.rng.randrange(self.chart.total_employees) + 1
+
+    def top_manager(self):
+        company = self.rng.randrange(self.chart.companies)
+        tree = self.rng.randrange(-(-self.chart.employees // self.chart.tree_size))
+        return self.chart.employeeID(company, tree * self.chart.tree_size)
+
+    def new_employee(self):
+        self.sequence += 1
+        company = self.company()
+        return {'name': 'Benchmark {}'.format(self.sequence), 'email': 'benchmark{}@example.com'.format(self.sequence),
+                'companyID': company, 'managerID': self.chart.employeeID(company - 1, 0)}
+
+    def name_fragment(self):
+        return self.rng.choice(FIRST_NAMES)[:4]
+
+
+def conditional_get(state, path):
+    return 'GET', path, None, {'If-None-Match': state.etags.get(path, '')}
+
+
+def bulk_delete(state):
+    batch, state.bulk_created = state.bulk_created[:100], state.bulk_created[100:]
+    return 'DELETE', '/employees/bulk', {'employeeIDs': batch}, None
+
+
+SCENARIOS = [
+    ('GET /companies', lambda s: ('GET', '/companies', None, None)),
+    ('GET /companies/<id>', lambda s: ('GET', '/companies/{}'.format(s.company()), None, None)),
+    ('GET /companies/search', lambda s: ('GET', '/companies/search?name=pany {}'.format(s.company()), None, None)),
+    ('GET /companies/<id>/employees', lambda s: ('GET', '/companies/{}/employees'.format(s.company()), None, None)),
+    ('GET /companies/<id>/employees?limit=100', lambda s: ('GET', '/companies/{}/employees?limit=100'.format(s.company()), None, None)),
+    ('GET /companies/<id>/managers', lambda s: ('GET', '/companies/{}/managers'.format(s.company()), None, None)),
+    ('GET /companies/<id>/tree', lambda s: ('GET', '/companies/{}/tree'.format(s.company()), None, None)),
+    ('GET /companies/<id>/tree?stream=json', lambda s: ('GET', '/companies/{}/tree?stream=json'.format(s.company()), None, None)),
+    ('GET /employees?limit=100&after=<id>', lambda s: ('GET', '/employees?limit=100&after={}'.format(s.employee()), None, None)),
+    ('GET /employees?limit=100 (If-None-Match)', lambda s: conditional_get(s, '/employees?limit=100')),
+    ('GET /employees/search', lambda s: ('GET', '/employees/search?name={}&limit=100'.format(s.name_fragment()), None, None)),
+    ('GET /employees/search?ranked=true', lambda s: ('GET', '/employees/search?name={}&ranked=true&limit=10'.format(s.name_fragment()), None, None)),
+    ('GET /employees/<id>', lambda s: ('GET', '/employees/{}'.format(s.employee()), None, None)),
+    ('GET /employees/<id>/structure/0', lambda s: ('GET', '/employees/{}/structure/0'.format(s.employee()), None, None)),
+    ('GET /employees/<id>/structure/1', lambda s: ('GET', '/employees/{}/structure/1'.format(s.employee()), None, None)),
+    ('GET /employees/<top>/structure/2', lambda s: ('GET', '/employees/{}/structure/2'.format(s.top_manager()), None, None)),
+    ('GET /employees/<top>/structure/all', lambda s: ('GET', '/employees/{}/structure/all'.format(s.top_manager()), None, None)),
+    ('GET /employees/<id>/chain', lambda s: ('GET', '/employees/{}/chain'.format(s.employee()), None, None)),
+    ('POST /employees/lca (100)', lambda s: ('POST', '/employees/lca', {'pairs': [[s.employee(), s.employee()] for _ in range(100)]}, None)),
+    ('GET /changes?limit=100', lambda s: ('GET', '/changes?limit=100', None, None)),
+    ('POST /companies', lambda s: ('POST', '/companies', {'name': 'Benchmark company {}'.format(s.rng.random())}, None)),
+    ('DELETE /companies/<id>', lambda s: ('DELETE', '/companies/{}'.format(s.created_companies.pop()), None, None)),
+    ('POST /employees', lambda s: ('POST', '/employees', s.new_employee(), None)),
+    ('PUT /employees/<id>', lambda s: ('PUT', '/employees/{}'.format(s.rng.choice(s.created or [s.employee()])), {'name': 'Renamed {}'.format(s.rng.random())}, None)),
+    ('DELETE /employees/<id>', lambda s: ('DELETE', '/employees/{}'.format(s.created.pop()), None, None)),
+    ('POST /employees/bulk (100)', lambda s: ('POST', '/employees/bulk', {'employees': [s.new_employee() for _ in range(100)]}, None)),
+    ('PUT /employees/bulk (100)', lambda s: ('PUT', '/employees/bulk', {'employees': [
+        {'employeeID': e, 'name': 'Renamed {}'.format(s.rng.random())} for e in s.rng.sample(s.bulk_created, min(100, len(s.bulk_created)))]}, None)),
+    ('DELETE /employees/bulk (100)', bulk_delete),
+]
+
+
+# Keeps what the write scenarios need for the next ones (IDs created, ETags...).
+def record(state, method, path, response):
+    if response.status_code != 200:
+        return
+    if method == 'GET' and 'ETag' in response.headers:
+        state.etags[path] = response.headers['ETag']
+    elif method == 'POST' and path == '/companies':
+        state.created_companies.append(response.get_json()['companyID'])
+    elif method == 'POST' and path == '/employees':
+        state.created.append(response.get_json()['employeeID'])
+    elif method == 'POST' and path == '/employees/bulk':
+        state.bulk_created.extend(e['employeeID'] for e in response.get_json())
+
+
+# ================================== R U N N E R ==================================== #
+def percentile(quantiles, p):
+    return quantiles[p - 1]
+
+
+def summarize(latencies, errors):
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(quantiles, 50) * 1000,
+        'p90_ms': percentile(quantiles, 90) * 1000,
+        'p99_ms': percentile(quantiles, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'throughput_rps': len(latencies) / sum(latencies)
+    }
+
+
+def run_scenario(client, state, make_request, requests, warmup):
+    latencies = []
+    errors = 0
+    for i in range(warmup + requests):
+        method, path, body, headers = make_request(state)
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=headers)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        record(state, method, path, response)
+        if i < warmup:
+            continue
+        latencies.append(elapsed)
+        if response.status_code not in (200, 304, 404):
+            errors += 1
+    return summarize(latencies, errors)
+
+
+def run(chart, requests, warmup, only, database_path):
+    app = create_benchmark_app(database_path)
+    from app.app_core import db
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        chart.load(db, progress=lambda done, total: print('\r    generating org chart: {}/{}'.format(done, total), end='', file=sys.stderr))
+        print('\r    generated {} employees in {:.1f} s'.format(chart.total_employees, time.perf_counter() - start), file=sys.stderr)
+
+        client = app.test_client()
+        state = BenchmarkState(chart, random.Random(chart.seed))
+        results = {}
+        for name, make_request in SCENARIOS:
+            if only is not None and only not in name:
+                continue
+            results[name] = run_scenario(client, state, make_request, requests, warmup)
+            print_result(name, results[name])
+        db.session.remove()
+        db.engine.dispose()
+    return results
+
+
+def print_result(name, result):
+    line = '{:45} {:8.2f} {:8.2f} {:8.2f} {:9.1f}'.format(
+        name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['throughput_rps'])
+    if result['errors'] > 0:
+        line += '  ({} errors)'.format(result['errors'])
+    print(line)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('p50_ms', 'p90_ms'):
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append('{}: {} {:.2f} ms (baseline {:.2f} ms)'.format(
+                    name, metric, result[metric], baseline[name][metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the API endpoints on a synthetic org chart.')
+    parser.add_argument('--size', choices=SIZES, default='small', help='preset org chart size')
+    parser.add_argument('--companies', type=int)
+    parser.add_argument('--employees', type=int, help='employees per company')
+    parser.add_argument('--depth', type=int, help='maximum depth of the chains of management')
+    parser.add_argument('--fan-out', type=int, help='maximum direct subordinates of a manager')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint')
+    parser.add_argument('--only', help='run only the endpoints whose name contains this')
+    parser.add_argument('--memory', action='store_true', help='use an in-memory SQLite database')
+    parser.add_argument('--cache', choices=['memory', 'none'], default='none', help='API cache backend')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown allowed against the baseline')
+    args = parser.parse_args()
+
+    companies, employees, depth, fan_out = SIZES[args.size]
+    chart = OrgChart(args.companies or companies, args.employees or employees,
+                     depth if args.depth is None else args.depth, args.fan_out or fan_out, args.seed)
+    config = {'companies': chart.companies, 'employees': chart.employees, 'depth': chart.depth,
+              'fan_out': chart.fan_out, 'seed': chart.seed, 'requests': args.requests, 'cache': args.cache,
+              'database': 'memory' if args.memory else 'file'}
+    os.environ['COMPANIFY_CACHE'] = args.cache
+
+    print('{} companies x {} employees, depth {}, fan-out {}'.format(chart.companies, chart.employees, chart.depth, chart.fan_out))
+    print('{:45} {:>8} {:>8} {:>8} {:>9}'.format('endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s'))
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = None if args.memory else os.path.join(directory, 'benchmark.sqlite')
+        results = run(chart, args.requests, args.warmup, args.only, database_path)
+
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(os.path.join(BASELINES_DIR, args.save_baseline + '.json'), 'w') as file:
+            json.dump({'config': config, 'results': results}, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+    if args.compare:
+        with open(os.path.join(BASELINES_DIR, args.compare + '.json')) as file:
+            baseline = json.load(file)
+        if baseline['config'] != config:
+            print('\nBaseline {} was run with another configuration: {}'.format(args.compare, baseline['config']))
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if len(regressions) > 0:
+            print('\nRegressions against baseline {} (tolerance {:.0%}):'.format(args.compare, args.tolerance))
+            print('\n'.join('    ' + r for r in regressions))
+            sys.exit(1)
+        print('\nNo regressions against baseline {}.'.format(args.compare))
+
+
+if __name__ == '__main__':
+    main()
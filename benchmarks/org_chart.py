@@ -0,0 +1,117 @@
+# Synthetic org charts for the benchmarks: 'companies' companies with 'employees'
+# employees each, organized in trees where every manager has up to 'fan_out' direct
+# subordinates and chains are at most 'depth' levels deep (a company starts a new tree,
+# i.e. another top manager, when the current one is full). Everything is derived from
+# the IDs and the seed, so a configuration always generates the same database, and rows
+# are generated and written in chunks, so millions of employees fit in flat memory.
+import random
+
+from models.hierarchy import PATH_SEPARATOR
+
+FIRST_NAMES = ['Michael', 'Dwight', 'Jim', 'Pam', 'Angela', 'Oscar', 'Kevin', 'Stanley', 'Phyllis', 'Andy',
+               'Erin', 'Richard', 'Bertram', 'Dinesh', 'Monica', 'Jared', 'Gavin', 'Jack', 'Gwen', 'Ianto',
+               'Owen', 'Toshiko', 'Martha', 'Rhys', 'Yvonne', 'José', 'Zoë']
+LAST_NAMES = ['Scott', 'Schrute', 'Halpert', 'Beesly', 'Martin', 'Martinez', 'Malone', 'Hudson', 'Vance',
+              'Bernard', 'Hannon', 'Hendricks', 'Gilfoyle', 'Chugtai', 'Hall', 'Dunn', 'Belson', 'Harkness',
+              'Cooper', 'Jones', 'Harper', 'Sato', 'Williams', 'Hartman', 'Müller', "O'Brien"]
+CHUNK_SIZE = 10000
+
+
+class OrgChart:
+    def __init__(self, companies=10, employees=1000, depth=5, fan_out=5, seed=42):
+        if companies < 1 or employees < 1 or depth < 0 or fan_out < 1:
+            raise ValueError('companies, employees and fan_out must be positive, and depth not negative')
+        self.companies = companies
+        self.employees = employees
+        self.depth = depth
+        self.fan_out = fan_out
+        self.seed = seed
+        # employees in a full tree: 1 + fan_out + fan_out^2 + ... + fan_out^depth
+        self.tree_size = sum(fan_out ** level for level in range(depth + 1))
+
+    @property
+    def total_employees(self):
+        return self.companies * self.employees
+
+    def employeeID(self, company, index):
+        return company * self.employees + index + 1
+
+    # Company (0-based) of an employeeID, and its index in the company.
+    def locate(self, employeeID):
+        return divmod(employeeID - 1, self.employees)
+
+    # Index in the company of the manager of the employee at 'index', or None for the
+    # top managers. Each tree is laid out as a heap: the subordinates of the node 'n'
+    # are the nodes n * fan_out + 1 ... n * fan_out + fan_out.
+    def manager_index(self, index):
+        tree_start = index - index % self.tree_size
+        node = index - tree_start
+        return None if node == 0 else tree_start + (node - 1) // self.fan_out
+
+    # Number of subordinates (every level) and direct subordinates of the employee at
+    # 'index', walking down its heap one level (a range of nodes) at a time.
+    def aggregates(self, index):
+        tree_start = index - index % self.tree_size
+        last = min(self.tree_size, self.employees - tree_start) - 1
+        low = high = index - tree_start
+        levels = []
+        while True:
+            low, high = low * self.fan_out + 1, min(high * self.fan_out + self.fan_out, last)
+            if low > last:
+                return sum(levels), levels[0] if len(levels) > 0 else 0
+            levels.append(high - low + 1)
+
+    def chain(self, company, index):
+        chain = [index]
+        while True:
+            manager = self.manager_index(chain[-1])
+            if manager is None:
+                return [self.employeeID(company, i) for i in reversed(chain)]
+            chain.append(manager)
+
+    def employee_row(self, company, index, rng):
+        chain = self.chain(company, index)
+        employeeID = chain[-1]
+        headcount, direct_reports = self.aggregates(index)
+        return {
+            'employeeID': employeeID,
+            'name': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+            'email': 'employee{}@company{}.example.com'.format(employeeID, company + 1),
+            'companyID': company + 1,
+            'managerID': chain[-2] if len(chain) > 1 else None,
+            'path': PATH_SEPARATOR + PATH_SEPARATOR.join(map(str, chain)) + PATH_SEPARATOR,
+            'depth': len(chain) - 1,
+            'headcount': headcount,
+            'directReports': direct_reports
+        }
+
+    def company_rows(self):
+        return [{'companyID': c + 1, 'name': 'Company {:0{}d}'.format(c + 1, len(str(self.companies)))}
+                for c in range(self.companies)]
+
+    # Chunks of employee rows, managers always before their subordinates.
+    def employee_chunks(self, chunk_size=CHUNK_SIZE):
+        rng = random.Random(self.seed)
+        chunk = []
+        for company in range(self.companies):
+            for index in range(self.employees):
+                chunk.append(self.employee_row(company, index, rng))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    # Writes the org chart into the (empty) database of 'db', with the hierarchy index
+    # and the aggregates.
+    def load(self, db, progress=None):
+        from models.company_model import Company
+        from models.employee_model import Employee
+        db.session.execute(Company.__table__.insert(), self.company_rows())
+        written = 0
+        for chunk in self.employee_chunks():
+            db.session.execute(Employee.__table__.insert(), chunk)
+            written += len(chunk)
+            if progress is not None:
+                progress(written, self.total_employees)
+        db.session.commit()
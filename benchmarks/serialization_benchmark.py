@@ -0,0 +1,59 @@
+# Compares the two ways the list endpoints serialize their rows (see
+# src/routes/api_serialization.py): ORM objects + schema.dump + jsonify, and the fast
+# path writing the selected columns straight into JSON. Checks that both produce the
+# same bytes, then times GET /employees in-process for each table size.
+#
+#     python benchmarks/serialization_benchmark.py [--rows 10000 100000] [--repeat 5]
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from bench_app import create_benchmark_app
+from org_chart import OrgChart
+
+
+def time_request(client, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), response.get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the serialization of list responses.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            app = create_benchmark_app(os.path.join(directory, 'bench_{}.sqlite'.format(rows)))
+            from app.app_core import db
+            with app.app_context():
+                db.create_all()
+                companies = max(1, rows // 1000)
+                OrgChart(companies=companies, employees=rows // companies).load(db)
+                client = app.test_client()
+                print('{:>8} rows'.format(rows))
+                for compact in (True, False):
+                    app.json.compact = compact
+                    results = {}
+                    for fast in (False, True):
+                        app.config['FAST_SERIALIZATION'] = fast
+                        results[fast] = time_request(client, '/employees', args.repeat)
+                    assert results[True][1] == results[False][1], 'fast serialization output differs'
+                    orm, fast = results[False][0], results[True][0]
+                    print('    {:8} ORM + jsonify {:8.1f} ms    fast {:8.1f} ms    {:5.1f}x'.format(
+                        'compact' if compact else 'indented', orm * 1000, fast * 1000, orm / fast))
+                db.session.remove()
+                db.drop_all()
+                db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Cold start benchmark: runs the API in fresh interpreters (as a new worker process does)
+# and reports, as the median of the runs, how long it takes to import the app, build it
+# with the app factory, and serve the first request (GET /companies, on an empty in-memory
+# database), along with the whole process time. One more run under 'python -X importtime'
+# breaks the import time down by top-level package.
+#
+# Results can be saved as a named baseline (benchmarks/baselines/<name>.json) and later
+# runs compared against it, as in endpoint_benchmark.py: a measure slower than the baseline
+# by more than the tolerance is reported as a regression, and so is any module that must
+# not be loaded at startup (STARTUP_EXCLUDED_MODULES), both making the script exit with 1.
+#
+#     python benchmarks/startup_benchmark.py --save-baseline startup
+#     python benchmarks/startup_benchmark.py --compare startup
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BASELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Modules the API doesn't need to serve requests, which must not slow its start down.
+STARTUP_EXCLUDED_MODULES = ('requests', 'urllib3', 'numpy', 'pandas')
+
+MEASURES = ('import_ms', 'create_app_ms', 'first_request_ms', 'time_to_first_request_ms', 'process_ms')
+
+
+# Runs in the fresh interpreter: times each phase and prints them as JSON.
+def child():
+    start = time.perf_counter()
+    from bench_app import create_benchmark_app
+    from app.app_core import db
+    imported = time.perf_counter()
+    api = create_benchmark_app()
+    created = time.perf_counter()
+    with api.app_context():
+        db.create_all()
+    status = api.test_client().get('/companies').status_code
+    served = time.perf_counter()
+    print(json.dumps({
+        'import_ms': (imported - start) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_request_ms': (served - created) * 1000,
+        'time_to_first_request_ms': (served - start) * 1000,
+        'status': status,
+        'excluded_modules': sorted(m for m in STARTUP_EXCLUDED_MODULES if m in sys.modules)
+    }))
+
+
+def run_child(*options):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, *options, os.path.abspath(__file__), '--child'],
+                             capture_output=True, text=True, check=True)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - start) * 1000
+    return result, process.stderr
+
+
+# Self import time (in ms) of each top-level package, from the output of -X importtime.
+def import_breakdown(importtime_output):
+    packages = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, module = line[len('import time:'):].split('|')
+        package = module.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1000
+    return packages
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for measure in MEASURES:
+        if results[measure] > baseline[measure] * (1 + tolerance):
+            regressions.append('{}: {:.1f} ms (baseline {:.1f} ms)'.format(measure, results[measure], baseline[measure]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the cold start of the API.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--runs', type=int, default=5, help='measured fresh interpreters')
+    parser.add_argument('--top', type=int, default=12, help='packages shown in the import breakdown')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown allowed against the baseline')
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    # a first run warms the OS file cache up, as a restarted worker would find it
+    run_child()
+    runs = [run_child()[0] for _ in range(args.runs)]
+    # an empty list is a 404, anything but a server error means the request was served
+    if any(run['status'] >= 500 for run in runs):
+        print('The first request failed with status {}.'.format(runs[0]['status']))
+        sys.exit(2)
+    results = {measure: statistics.median(run[measure] for run in runs) for measure in MEASURES}
+    for measure in MEASURES:
+        print('{:30} {:8.1f} ms'.format(measure, results[measure]))
+
+    _, importtime_output = run_child('-X', 'importtime')
+    packages = import_breakdown(importtime_output)
+    total = sum(packages.values())
+    print('\n{:30} {:>8} {:>7}'.format('imports by package', 'self ms', 'share'))
+    for package, elapsed in sorted(packages.items(), key=lambda p: -p[1])[:args.top]:
+        print('{:30} {:8.1f} {:7.1%}'.format(package, elapsed, elapsed / total))
+
+    config = {'runs': args.runs, 'python': '{}.{}'.format(*sys.version_info[:2])}
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(os.path.join(BASELINES_DIR, args.save_baseline + '.json'), 'w') as file:
+            json.dump({'config': config, 'results': results}, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+    regressions = ['{} is imported at startup'.format(m) for m in runs[0]['excluded_modules']]
+    if args.compare:
+        with open(os.path.join(BASELINES_DIR, args.compare + '.json')) as file:
+            baseline = json.load(file)
+        if baseline['config'] != config:
+            print('\nBaseline {} was run with another configuration: {}'.format(args.compare, baseline['config']))
+            sys.exit(2)
+        regressions += compare(results, baseline['results'], args.tolerance)
+    if len(regressions) > 0:
+        print('\nRegressions{} (tolerance {:.0%}):'.format('' if not args.compare else ' against baseline ' + args.compare, args.tolerance))
+        print('\n'.join('    ' + r for r in regressions))
+        sys.exit(1)
+    if args.compare:
+        print('\nNo regressions against baseline {}.'.format(args.compare))
+
+
+if __name__ == '__main__':
+    main()
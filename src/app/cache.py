@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from flask import current_app
+import json
+import os
+import threading
+import time
+
+# ====================================== C A C H E ====================================== #
+# Read-through cache for the payloads the API serves the most (see routes/api_cache.py).
+# The backend is chosen by the COMPANIFY_CACHE environment variable:
+#     memory  in-process LRU cache with TTL (default, except in production mode)
+#     shared  cache shared by every worker, in the Redis server of COMPANIFY_CACHE_URL;
+#             'fake://' uses an in-process stand-in instead, for tests and development
+#     none    no cache (default in production mode, where each worker process would
+#             otherwise only see its own invalidations)
+# COMPANIFY_CACHE_TTL (seconds, default 60) bounds how long an entry may be served, and
+# COMPANIFY_CACHE_SIZE (default 10000) how many entries the memory cache keeps.
+#
+# Values must be JSON serializable, and are never mutated by the callers.
+# ======================================================================================= #
+
+
+class LRUCache:
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Cache kept in a Redis-like server ('client' only needs get, set with 'ex' and delete),
+# so an invalidation made by one worker is seen by all of them.
+class SharedCache:
+    def __init__(self, client, ttl=60, prefix='companify:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if len(keys) > 0:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if len(keys) > 0:
+            self.client.delete(*keys)
+
+
+# In-process stand-in for a Redis client, with the subset of its API used by SharedCache.
+class FakeSharedClient:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires_at = self.values.get(key, (None, None))
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value, None if ex is None else time.monotonic() + ex)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+    def scan_iter(self, pattern):
+        with self.lock:
+            return [key for key in self.values if key.startswith(pattern.rstrip('*'))]
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+def create_cache(backend):
+    ttl = int(os.environ.get('COMPANIFY_CACHE_TTL', 60))
+    if backend == 'memory':
+        return LRUCache(int(os.environ.get('COMPANIFY_CACHE_SIZE', 10000)), ttl)
+    if backend == 'shared':
+        url = os.environ.get('COMPANIFY_CACHE_URL', 'redis://localhost:6379/0')
+        if url == 'fake://':
+            return SharedCache(FakeSharedClient(), ttl)
+        import redis
+        return SharedCache(redis.Redis.from_url(url), ttl)
+    return NullCache()
+
+
+def init_cache(app, default_backend):
+    app.extensions['companify_cache'] = create_cache(os.environ.get('COMPANIFY_CACHE', default_backend))
+
+
+def get_cache():
+    return current_app.extensions['companify_cache']
@@ -0,0 +1,205 @@
+from collections import Counter
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+import os
+import threading
+import time
+
+# ============================== I N S T R U M E N T A T I O N ============================== #
+# Opt-in profiling of every request, enabled by COMPANIFY_INSTRUMENTATION=1 (default in the
+# Debug and Test modes, off in production). For each request it records:
+#     - the wall time, from the moment Flask starts handling it to the response;
+#     - the SQL statements executed and their total time (SQLAlchemy engine events);
+#     - the time spent writing JSON (jsonify, and the fast path of api_serialization.py).
+# They are sent back in the 'Server-Timing' header, and aggregated per route in histograms
+# served at /metrics, in Prometheus' text format. Each worker process keeps its own metrics.
+#
+# Requests running more than COMPANIFY_QUERY_COUNT_THRESHOLD statements (default 20) are
+# flagged as possible N+1 patterns (a query per row, or per level of a structure...): a
+# warning with the most repeated statement is logged and counted in the metrics.
+# ============================================================================================ #
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values => (count in each bucket, total count, sum of the values)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self.lock:
+            buckets, count, total = self.series.get(label_values, ([0] * len(self.buckets), 0, 0))
+            buckets = [n + (value <= bound) for n, bound in zip(buckets, self.buckets)]
+            self.series[label_values] = (buckets, count + 1, total + value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, (buckets, count, total) in series:
+            labels = format_labels(self.labels, label_values)
+            for bound, n in zip(self.buckets, buckets):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, labels, bound, n))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, labels, count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels, count))
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = Counter()
+        self.lock = threading.Lock()
+
+    def increment(self, label_values):
+        with self.lock:
+            self.series[label_values] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, count in series:
+            lines.append('{}{{{}}} {}'.format(self.name, format_labels(self.labels, label_values), count))
+        return lines
+
+
+def format_labels(labels, values):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('{}="{}"'.format(label, escape(value)) for label, value in zip(labels, values))
+
+
+class Metrics:
+    def __init__(self):
+        self.request_duration = Histogram('companify_request_duration_seconds',
+            'Wall time of the requests.', ('method', 'route', 'status'), DURATION_BUCKETS)
+        self.sql_statements = Histogram('companify_request_sql_statements',
+            'SQL statements executed per request.', ('method', 'route'), COUNT_BUCKETS)
+        self.sql_duration = Histogram('companify_request_sql_duration_seconds',
+            'Time spent executing SQL statements per request.', ('method', 'route'), DURATION_BUCKETS)
+        self.serialization_duration = Histogram('companify_request_serialization_duration_seconds',
+            'Time spent writing JSON per request.', ('method', 'route'), DURATION_BUCKETS)
+        self.query_count_exceeded = CounterMetric('companify_request_query_count_exceeded_total',
+            'Requests over the query count threshold (possible N+1 patterns).', ('method', 'route'))
+
+    def render(self):
+        lines = []
+        for metric in (self.request_duration, self.sql_statements, self.sql_duration,
+                       self.serialization_duration, self.query_count_exceeded):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# -------------------------------------- R E Q U E S T S -------------------------------------- #
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = Counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.serialization_time = 0.0
+
+
+def current_profile():
+    if not has_request_context():
+        return None
+    return g.get('companify_profile')
+
+
+# Adds the time of the block to the serialization time of the current request, if profiled.
+class serialization_timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        profile = current_profile()
+        if profile is not None:
+            profile.serialization_time += time.perf_counter() - self.start
+
+
+def timed_serialization(function):
+    def timed_function(*args, **kwargs):
+        with serialization_timer():
+            return function(*args, **kwargs)
+    return timed_function
+
+
+def route_labels():
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return (request.method, route)
+
+
+def start_profile():
+    g.companify_profile = RequestProfile()
+
+
+def finish_profile(response):
+    profile = current_profile()
+    if profile is None:
+        return response
+    total = time.perf_counter() - profile.start
+    method, route = route_labels()
+    metrics = current_app.extensions['companify_metrics']
+    metrics.request_duration.observe((method, route, response.status_code), total)
+    metrics.sql_statements.observe((method, route), profile.sql_count)
+    metrics.sql_duration.observe((method, route), profile.sql_time)
+    metrics.serialization_duration.observe((method, route), profile.serialization_time)
+
+    threshold = current_app.config['QUERY_COUNT_THRESHOLD']
+    if profile.sql_count > threshold:
+        metrics.query_count_exceeded.increment((method, route))
+        statement, repetitions = profile.statements.most_common(1)[0]
+        current_app.logger.warning(
+            'Possible N+1 pattern: %s %s ran %d SQL statements (threshold %d); ran %d times: %s',
+            method, request.path, profile.sql_count, threshold, repetitions, ' '.join(statement.split()))
+
+    response.headers.add('Server-Timing', 'total;dur={:.2f}'.format(total * 1000))
+    response.headers.add('Server-Timing', 'sql;dur={:.2f};desc="{} statements"'.format(profile.sql_time * 1000, profile.sql_count))
+    response.headers.add('Server-Timing', 'serialization;dur={:.2f}'.format(profile.serialization_time * 1000))
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    if profile is not None:
+        conn.info.setdefault('companify_statement_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    starts = conn.info.get('companify_statement_start')
+    if profile is None or not starts:
+        return
+    profile.sql_time += time.perf_counter() - starts.pop()
+    profile.sql_count += 1
+    profile.statements[statement] += 1
+
+
+def get_metrics():
+    return current_app.response_class(current_app.extensions['companify_metrics'].render(),
+                                      mimetype='text/plain; version=0.0.4')
+
+
+# Called by create_app, within an app context (needs the engine).
+def init_instrumentation(app, db, default_enabled):
+    enabled = os.environ.get('COMPANIFY_INSTRUMENTATION', '1' if default_enabled else '0') != '0'
+    app.config['INSTRUMENTATION'] = enabled
+    app.config['QUERY_COUNT_THRESHOLD'] = int(os.environ.get('COMPANIFY_QUERY_COUNT_THRESHOLD', 20))
+    if not enabled:
+        return
+    app.extensions['companify_metrics'] = Metrics()
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.add_url_rule('/metrics', 'metrics', get_metrics, methods=['GET'])
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    app.json.dumps = timed_serialization(app.json.dumps)
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import inspect
+import json
+import os
+import threading
+
+# ======================================== J O B S ========================================= #
+# Background jobs, for writes too long to run inside a request (e.g. reorganizations that
+# move hundreds of employees, see routes/job_routes.py). A job is stored in the Jobs table
+# when it is submitted, and run by a pool of COMPANIFY_JOB_WORKERS threads (default 2) of
+# the process that received it; clients poll its status until it has finished.
+#
+# Jobs are claimed with a conditional UPDATE (queued => running), so each one runs once even
+# with several processes. Queued jobs are picked up again when a process starts, and jobs
+# left running by a process that stopped are queued again by requeue_interrupted_jobs
+# (their writes, being a single transaction, were rolled back).
+#
+# A job handler (registered with job_handler) receives the payload of the job and returns
+# (succeeded, result), both stored in the job. It runs in an app context, without request.
+# ========================================================================================== #
+job_handlers = {}
+
+
+def job_handler(kind):
+    def register(handler):
+        job_handlers[kind] = handler
+        return handler
+    return register
+
+
+# The threads are only started by the first job, or the first request (see init_jobs), so
+# processes that don't serve requests (e.g. the one forking the production workers) don't
+# run jobs.
+class JobQueue:
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self.executor = None
+        self.resumed = False
+        self.lock = threading.Lock()
+
+    def submit(self, jobID):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='companify-job')
+        self.executor.submit(self.run, jobID)
+
+    def run(self, jobID):
+        from app.app_core import db
+        from models.job_model import Job, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, utc_now
+        with self.app.app_context():
+            try:
+                claimed = Job.query.filter(Job.jobID == jobID, Job.status == JOB_QUEUED)\
+                    .update({Job.status: JOB_RUNNING, Job.startedAt: utc_now()}, synchronize_session=False)
+                db.session.commit()
+                if claimed == 0:
+                    return
+                job = Job.query.get(jobID)
+                try:
+                    succeeded, result = job_handlers[job.kind](json.loads(job.payload))
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception('Job %d (%s) failed', jobID, job.kind)
+                    succeeded, result = False, {'error': str(e)}
+                job = Job.query.get(jobID)
+                job.status = JOB_SUCCEEDED if succeeded else JOB_FAILED
+                job.result = json.dumps(result)
+                job.finishedAt = utc_now()
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+    # Submits the jobs waiting in the queue, e.g. received by a process that stopped.
+    def resume(self):
+        from app.app_core import db
+        from models.job_model import Job, JOB_QUEUED
+        with self.lock:
+            if self.resumed:
+                return
+            self.resumed = True
+        if not inspect(db.engine).has_table(Job.__tablename__):
+            return
+        for jobID, in Job.query.with_entities(Job.jobID).filter(Job.status == JOB_QUEUED).order_by(Job.jobID):
+            self.submit(jobID)
+
+
+# Queues again the jobs that were running when the API stopped. Must only be called
+# before any process starts running jobs (e.g. right after upgrading the database).
+def requeue_interrupted_jobs():
+    from app.app_core import db
+    from models.job_model import Job, JOB_QUEUED, JOB_RUNNING
+    Job.query.filter(Job.status == JOB_RUNNING).update({Job.status: JOB_QUEUED, Job.startedAt: None})
+    db.session.commit()
+
+
+def init_jobs(app):
+    queue = JobQueue(app, int(os.environ.get('COMPANIFY_JOB_WORKERS', 2)))
+    app.extensions['companify_jobs'] = queue
+    app.before_request(queue.resume)
+
+
+def get_job_queue():
+    return current_app.extensions['companify_jobs']
@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+
+# ============================= P R O D U C T I O N   S E R V E R ============================= #
+# Serves the API with a real WSGI server instead of Flask's development server, so requests
+# are handled concurrently by several processes (workers), each with several threads.
+# Configured through the environment:
+#     COMPANIFY_BIND              address to listen on (default 127.0.0.1:5002)
+#     COMPANIFY_WORKERS           number of worker processes (default: number of CPUs)
+#     COMPANIFY_THREADS           number of threads per worker (default 4)
+#     COMPANIFY_GRACEFUL_TIMEOUT  seconds given to the requests in progress to finish on
+#                                 shutdown (SIGTERM/SIGINT) before workers are killed (default 30)
+#
+# Uses gunicorn when it is installed, waitress (threads only, single process) otherwise.
+# Each worker builds its own application through the app factory, so no connection to
+# the database is ever shared between processes.
+# ============================================================================================= #
+
+
+def get_server_config():
+    return {
+        'bind': os.environ.get('COMPANIFY_BIND', '127.0.0.1:5002'),
+        'workers': int(os.environ.get('COMPANIFY_WORKERS', multiprocessing.cpu_count())),
+        'threads': int(os.environ.get('COMPANIFY_THREADS', 4)),
+        'graceful_timeout': int(os.environ.get('COMPANIFY_GRACEFUL_TIMEOUT', 30))
+    }
+
+
+def run_gunicorn(run_mode, config):
+    from gunicorn.app.base import BaseApplication
+
+    class CompanifyApplication(BaseApplication):
+        def load_config(self):
+            for key, value in config.items():
+                self.cfg.set(key, value)
+            self.cfg.set('worker_class', 'gthread')
+
+        # called in each worker after it is forked
+        def load(self):
+            from app.app_core import create_app
+            return create_app(run_mode)
+
+    CompanifyApplication().run()
+
+
+def run_waitress(run_mode, config):
+    import waitress
+    from app.app_core import create_app
+
+    if config['workers'] > 1:
+        print(" waitress runs a single process: COMPANIFY_WORKERS is ignored, install gunicorn to use it.")
+    waitress.serve(create_app(run_mode), listen=config['bind'], threads=config['threads'])
+
+
+def run_production_server(run_mode):
+    config = get_server_config()
+    print(" Serving on {bind} with {workers} worker(s) x {threads} thread(s) ".format(**config))
+    try:
+        run_gunicorn(run_mode, config)
+    except ImportError:
+        try:
+            run_waitress(run_mode, config)
+        except ImportError:
+            print(" Neither gunicorn nor waitress is installed, falling back to Flask's development server.")
+            from app.app_core import create_app
+            host, port = config['bind'].rsplit(':', 1)
+            create_app(run_mode).run(host=host, port=int(port), threaded=True)
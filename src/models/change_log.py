@@ -0,0 +1,97 @@
+import json
+
+from app.app_core import db, ma
+import models.data_versions as data_versions
+from models.employee_model import Employee, EmployeeSchema
+from models.job_model import utc_now
+
+# ================================= C H A N G E   L O G ============================= #
+# Every write to the Employees and Companies tables made through the API is recorded
+# here, in the same transaction, so systems mirroring the data can sync the changes
+# since their last read (GET /changes?since=<token>, see routes/change_routes.py)
+# instead of reading every table again.
+#
+# A change holds the state of the row right after it, indirect changes included (e.g.
+# the subordinates left without a manager by the change_manager_after_update_companyID
+# trigger or by a delete), or only its ID when the row was deleted. The token of a
+# change is its changeID: they only grow, and SQLite commits one write at a time, so a
+# change is never committed with an ID smaller than one already read. Other databases
+# commit concurrent transactions in any order, so there each transaction recording
+# changes first locks the row of the 'changes' data version (see models/data_versions.py)
+# until it commits: changeIDs are given out in the order the changes are committed, and
+# consumers reading past an ID never skip a change committed later with a smaller one.
+# =================================================================================== #
+EMPLOYEE = 'employee'
+COMPANY = 'company'
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# Data version locked by the transactions recording changes, outside SQLite
+CHANGES = 'changes'
+
+# ID column of each kind of entity, in the API's payloads
+ENTITY_KEYS = {
+    EMPLOYEE: 'employeeID',
+    COMPANY: 'companyID'
+}
+
+
+class Change(db.Model):
+    __tablename__ = 'ChangeLog'
+    changeID = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entityID = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text)
+    changedAt = db.Column(db.DateTime, nullable=False)
+
+
+# Records a change to each row in 'payloads' (the rows as served by the API).
+def record_changes(entity, operation, payloads):
+    if payloads is None or len(payloads) == 0:
+        return
+    if db.engine.dialect.name != 'sqlite':
+        data_versions.bump(CHANGES)
+    key = ENTITY_KEYS[entity]
+    now = utc_now()
+    db.session.execute(Change.__table__.insert(), [{
+            'entity': entity,
+            'entityID': payload[key],
+            'operation': operation,
+            'data': None if operation == DELETE else json.dumps(payload),
+            'changedAt': now
+        } for payload in payloads])
+
+
+# Records the current state of the employees, read straight from the table: it must be
+# called after the session is flushed, so the changes made by the database itself (the
+# trigger and the foreign keys) are in it too.
+def record_employee_updates(employeeIDs):
+    employeeIDs = {e for e in employeeIDs if e is not None}
+    if len(employeeIDs) == 0:
+        return
+    columns = [getattr(Employee.__table__.c, field) for field in EmployeeSchema.Meta.fields]
+    rows = db.session.execute(
+        Employee.__table__.select().with_only_columns(*columns)
+            .where(Employee.__table__.c.employeeID.in_(employeeIDs))
+            .order_by(Employee.__table__.c.employeeID)
+    )
+    record_changes(EMPLOYEE, UPDATE, [dict(row._mapping) for row in rows])
+
+
+# IDs of the employees in a list of payloads (e.g. the indirect changes of a write).
+def payload_ids(payloads):
+    return [] if payloads is None else [p[ENTITY_KEYS[EMPLOYEE]] for p in payloads]
+# =================================================================================== #
+
+
+# ====================================== S C H E M A ======================================= #
+class ChangeSchema(ma.Schema):
+    class Meta:
+        # Fields to expose
+        fields = ('changeID', 'entity', 'entityID', 'operation', 'changedAt')
+
+change_schema = ChangeSchema()
+# ========================================================================================== #
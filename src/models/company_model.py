@@ -1,13 +1,3 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-from sqlalchemy import Column, Integer, DateTime, DDL, event
-from flask_cors import CORS
-import json 
-import os
-import datetime
-import requests
-
 from app.app_core import db, ma
 
 # ======================================= M O D E L ======================================== #
@@ -0,0 +1,66 @@
+from sqlalchemy import case
+import time
+
+from app.app_core import db
+
+# ============================== D A T A   V E R S I O N S ========================== #
+# Version counters of the data served by the API, bumped by every endpoint that writes
+# it, in the same transaction. They let the API tell whether a response changed (see
+# routes/api_etag.py) without building it. Scopes:
+#     companies            the Companies table
+#     employees            the Employees table
+#     company:<companyID>  the employees of one company ('company:None' for the
+#                          employees without company)
+#     changes              not served: locked by the transactions recording changes on
+#                          databases other than SQLite (see models/change_log.py)
+#
+# New versions are the current time in milliseconds (or the old version + 1, if that
+# is larger), so a version is never repeated even if the database is recreated.
+# =================================================================================== #
+COMPANIES = 'companies'
+EMPLOYEES = 'employees'
+
+data_version = db.Table(
+    'DataVersion',
+    db.Column('scope', db.String(40), primary_key=True),
+    db.Column('version', db.BigInteger, nullable=False)
+)
+
+
+def company_scope(companyID):
+    return 'company:{}'.format(companyID)
+
+
+def get_version(scope):
+    version = db.session.execute(
+        data_version.select().with_only_columns(data_version.c.version).where(data_version.c.scope == scope)
+    ).scalar()
+    return 0 if version is None else version
+
+
+def _next_version(now):
+    return case((data_version.c.version >= now, data_version.c.version + 1), else_=now)
+
+
+# Bumps every scope with one UPDATE, inserting the scopes that weren't written before.
+def bump(*scopes):
+    scopes = set(scopes)
+    now = int(time.time() * 1000)
+    result = db.session.execute(
+        data_version.update().where(data_version.c.scope.in_(scopes)).values(version=_next_version(now))
+    )
+    if result.rowcount < len(scopes):
+        existing = db.session.execute(
+            data_version.select().with_only_columns(data_version.c.scope).where(data_version.c.scope.in_(scopes))
+        ).scalars()
+        db.session.execute(data_version.insert(), [{'scope': scope, 'version': now} for scope in scopes - set(existing)])
+
+
+# Bumps every scope written so far, e.g. when the whole database is replaced.
+def bump_all():
+    db.session.execute(data_version.update().values(version=_next_version(int(time.time() * 1000))))
+
+
+# Bumps the versions of the Employees table and of the companies whose employees changed.
+def bump_employees(companyIDs):
+    bump(EMPLOYEES, *[company_scope(c) for c in companyIDs])
@@ -1,24 +1,34 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-from sqlalchemy import Column, Integer, DateTime, DDL, event
-from flask_cors import CORS
-import json 
-import os
-import datetime
-import requests
+from sqlalchemy import DDL, event, inspect, or_
 
 from app.app_core import db, ma
 
 # ======================================= M O D E L ======================================== #
 class Employee(db.Model):
     __tablename__ = 'Employees'
+    __table_args__ = (
+        # listing a company's employees, its structure level 0 and the trigger below
+        db.Index('ix_Employees_companyID_managerID', 'companyID', 'managerID'),
+        # walking down the structure and finding someone's subordinates
+        db.Index('ix_Employees_managerID', 'managerID'),
+        # ranking a company's managers by headcount
+        db.Index('ix_Employees_companyID_headcount', 'companyID', 'headcount'),
+    )
     employeeID = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=False, nullable=False)
     email = db.Column(db.String(80), unique=True)
     companyID = db.Column(db.Integer, db.ForeignKey("Companies.companyID"))
     managerID = db.Column(db.Integer, db.ForeignKey("Employees.employeeID"))
 
+    # Materialized path of the management chain, from the top manager down to this
+    # employee (e.g. '/1/2/5/'), and its depth (0 for employees without manager).
+    # Both are kept in sync by models/hierarchy.py, never set them by hand.
+    path = db.Column(db.String(1024), index=True)
+    depth = db.Column(db.Integer, nullable=False, default=0)
+    # Aggregates of the structure under this employee: how many employees it has under
+    # it (every level) and how many it manages directly. Also kept by models/hierarchy.py.
+    headcount = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    directReports = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # self-referential relationship
     manager = db.relationship("Employee", backref='subordinates', remote_side=employeeID)
 
@@ -43,7 +53,22 @@ update_manager_trigger = DDL('''\
             OR (employeeID = NEW.employeeID AND NEW.managerID = OLD.managerID);
         END;'''
     )
-event.listen(Employee.__table__, 'after_create', update_manager_trigger)
+event.listen(Employee.__table__, 'after_create', update_manager_trigger.execute_if(dialect='sqlite'))
+
+
+# Same as the trigger above, enforced by the application on the other database backends.
+# Runs in the same flush (and transaction) as the UPDATE that changed the companyID.
+@event.listens_for(Employee, 'after_update')
+def change_manager_after_update_companyID(mapper, connection, employee):
+    if connection.dialect.name == 'sqlite':
+        return
+    state = inspect(employee)
+    if not state.attrs.companyID.history.has_changes():
+        return
+    condition = Employee.managerID == employee.employeeID
+    if not state.attrs.managerID.history.has_changes():
+        condition = or_(condition, Employee.employeeID == employee.employeeID)
+    connection.execute(Employee.__table__.update().where(condition).values(managerID=None))
 # ========================================================================================== #
 
 
@@ -55,4 +80,14 @@ class EmployeeSchema(ma.Schema):
 
 employee_schema = EmployeeSchema()
 employees_schema = EmployeeSchema(many=True)
+
+
+# The employee along with its place in the company structure (see models/hierarchy.py).
+class EmployeeDetailSchema(ma.Schema):
+    class Meta:
+        # Fields to expose
+        fields = EmployeeSchema.Meta.fields + ('depth', 'headcount', 'directReports')
+
+employee_detail_schema = EmployeeDetailSchema()
+employees_detail_schema = EmployeeDetailSchema(many=True)
 # ========================================================================================== #
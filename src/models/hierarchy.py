@@ -0,0 +1,283 @@
+from sqlalchemy import String, and_, bindparam, cast, func, literal, or_, update
+
+from app.app_core import db
+from models.employee_model import Employee
+
+# ================================ H I E R A R C H Y ================================ #
+# Maintains the materialized path index of the management chains (Employee.path and
+# Employee.depth), along with the aggregates of each employee (Employee.headcount and
+# Employee.directReports). A path lists every employeeID from the top manager down to the
+# employee itself, e.g. '/1/2/5/' means 5 is managed by 2, who is managed by 1.
+# With it, "is X above Y?" is a string prefix test and "everyone N levels under X"
+# is a single indexed range query, no matter how deep the chain is.
+#
+# Every write that changes who manages whom must go through these functions:
+#     - index_new_employee: after a new employee has been flushed (needs its ID)
+#     - move_subtree: after an employee's manager changed (moves its subordinates along)
+#     - detach_subordinates: when an employee's direct subordinates lose their manager,
+#       either by deletion or by the change_manager_after_update_companyID trigger
+#     - remove_employee(s): when employees are deleted (detaches their subordinates too)
+# Aggregates are updated incrementally, along the chains above the employees that moved:
+# only the managers above them are written, never a whole company.
+# =================================================================================== #
+PATH_SEPARATOR = '/'
+
+
+def build_path(employeeID, manager_path=None):
+    return (manager_path or PATH_SEPARATOR) + str(employeeID) + PATH_SEPARATOR
+
+
+# Returns the employeeIDs in a path, from the top manager down to the employee.
+def path_to_ids(path):
+    return [int(i) for i in path.strip(PATH_SEPARATOR).split(PATH_SEPARATOR) if i != '']
+
+
+# Filter for everyone under the employee whose path is 'path' (the employee excluded).
+# Written as a range instead of LIKE 'path%' so any backend can use the index on path:
+# '0' is the character right after the separator '/', so every string starting with
+# 'path' sorts between 'path' and 'path' with its last '/' replaced by '0'.
+def descendants_filter(path):
+    upper_bound = path[:-1] + chr(ord(PATH_SEPARATOR) + 1)
+    return and_(Employee.path > path, Employee.path < upper_bound)
+
+
+# True if 'employee' is 'other' or is above 'other' in its chain of management.
+def is_above_or_same(employee, other):
+    return other.path.startswith(employee.path)
+
+
+# IDs of the managers above the employee whose path is 'path', from its manager up.
+def managers_above(path):
+    return path_to_ids(path)[-2::-1]
+
+
+# ID of the lowest employee that is, or is above, both employees whose paths are given
+# (their longest common prefix), or None if they aren't in the same structure.
+def lowest_common_manager(path, other_path):
+    common = None
+    for employeeID, otherID in zip(path_to_ids(path), path_to_ids(other_path)):
+        if employeeID != otherID:
+            break
+        common = employeeID
+    return common
+
+
+def _set_path(employee, manager=None):
+    employee.path = build_path(employee.employeeID, manager.path if manager is not None else None)
+    employee.depth = manager.depth + 1 if manager is not None else 0
+
+
+# Adds the deltas to the headcount and directReports of the employees, with one UPDATE
+# (executemany) for all of them: {employeeID: delta} for each aggregate.
+def _update_aggregates(headcounts, direct_reports=None):
+    direct_reports = direct_reports or {}
+    changes = [{'b_employeeID': e, 'b_headcount': headcounts.get(e, 0), 'b_directReports': direct_reports.get(e, 0)}
+               for e in set(headcounts) | set(direct_reports)
+               if headcounts.get(e, 0) != 0 or direct_reports.get(e, 0) != 0]
+    if len(changes) == 0:
+        return
+    table = Employee.__table__
+    db.session.execute(
+        update(table).where(table.c.employeeID == bindparam('b_employeeID')).values(
+            headcount=table.c.headcount + bindparam('b_headcount'),
+            directReports=table.c.directReports + bindparam('b_directReports')),
+        changes
+    )
+
+
+# Adds 'size' employees (negative to remove them) under the employee whose path is 'path':
+# the employee and everyone above it gain 'size' in headcount, and the employee itself
+# 'reports' direct reports.
+def _add_to_chain(headcounts, direct_reports, path, size, reports):
+    chain = path_to_ids(path)
+    for employeeID in chain:
+        headcounts[employeeID] = headcounts.get(employeeID, 0) + size
+    managerID = chain[-1]
+    direct_reports[managerID] = direct_reports.get(managerID, 0) + reports
+
+
+# Path of the employee's manager, taken from the employee's path (or 'path', if given).
+def _manager_path(employee, path=None):
+    path = employee.path if path is None else path
+    if path is None or path == build_path(employee.employeeID):
+        return None
+    return path[:-len(build_path(employee.employeeID))] + PATH_SEPARATOR
+
+
+# IDs of everyone under the employee whose path is 'path', whose index is about to change.
+def _descendant_ids(path):
+    return [e for e, in db.session.query(Employee.employeeID).filter(descendants_filter(path))]
+
+
+def index_new_employee(employee, manager=None):
+    index_new_employees([(employee, manager)])
+
+
+# Indexes a batch of new employees, each with its manager (None for no manager), updating
+# the headcount of every manager above them at once.
+def index_new_employees(employees):
+    headcounts = {}
+    direct_reports = {}
+    for employee, manager in employees:
+        _set_path(employee, manager)
+        employee.headcount = 0
+        employee.directReports = 0
+        if manager is not None:
+            _add_to_chain(headcounts, direct_reports, manager.path, 1, 1)
+    _update_aggregates(headcounts, direct_reports)
+
+
+# Re-roots the employee under its new manager (None for no manager), shifting the path
+# and depth of its whole subtree with a single UPDATE, and moving its headcount from the
+# chain above its old manager to the one above the new manager. Returns the IDs of its
+# subordinates, whose index changed.
+def move_subtree(employee, new_manager=None):
+    old_path = employee.path
+    old_depth = employee.depth
+    _set_path(employee, new_manager)
+    if old_path is None or old_path == employee.path:
+        return []
+
+    headcounts = {}
+    direct_reports = {}
+    size = employee.headcount + 1
+    old_manager_path = _manager_path(employee, old_path)
+    if old_manager_path is not None:
+        _add_to_chain(headcounts, direct_reports, old_manager_path, -size, -1)
+    if new_manager is not None:
+        _add_to_chain(headcounts, direct_reports, new_manager.path, size, 1)
+    _update_aggregates(headcounts, direct_reports)
+
+    moved = _descendant_ids(old_path)
+    db.session.query(Employee).filter(descendants_filter(old_path)).update({
+            Employee.path: literal(employee.path) + func.substr(Employee.path, len(old_path) + 1),
+            Employee.depth: Employee.depth + (employee.depth - old_depth)
+        }, synchronize_session=False)
+    return moved
+
+
+# Every direct subordinate of the employee becomes a top manager, carrying its own
+# subordinates along. Mirrors what deleting the employee or moving it to another
+# company does to the managerID of its subordinates. Returns the IDs of everyone
+# under the employee, whose index changed.
+def detach_subordinates(employee):
+    if employee.path is None or employee.headcount == 0:
+        return []
+    headcounts = {}
+    _add_to_chain(headcounts, {}, employee.path, -employee.headcount, 0)
+    headcounts.pop(employee.employeeID)
+    _update_aggregates(headcounts)
+    employee.headcount = 0
+    employee.directReports = 0
+    return _reroot_subordinates(employee)
+
+
+# Shifts the path and depth of everyone under the employee, so its direct subordinates
+# become top managers (aggregates are left to the caller). Returns their IDs.
+def _reroot_subordinates(employee):
+    moved = _descendant_ids(employee.path)
+    db.session.query(Employee).filter(descendants_filter(employee.path)).update({
+            Employee.path: literal(PATH_SEPARATOR) + func.substr(Employee.path, len(employee.path) + 1),
+            Employee.depth: Employee.depth - (employee.depth + 1)
+        }, synchronize_session=False)
+    return moved
+
+
+# Index of employees left without a manager nor subordinates (e.g. every employee of a
+# deleted company), as the values of a set-based UPDATE of the Employees table.
+def detached_index():
+    return {
+        'path': literal(PATH_SEPARATOR) + cast(Employee.__table__.c.employeeID, String) + literal(PATH_SEPARATOR),
+        'depth': 0,
+        'headcount': 0,
+        'directReports': 0
+    }
+
+
+# Takes a deleted employee out of the chain above it, after detaching its subordinates.
+def remove_employee(employee):
+    return remove_employees([employee])
+
+
+# Same as remove_employee for a batch of deleted employees, with one UPDATE of the
+# aggregates for all of them. The deepest go first, so the subordinates each employee
+# has left (the ones not deleted nor detached already) follow from the deltas so far.
+# Returns the IDs of the employees left, whose index changed.
+def remove_employees(employees):
+    headcounts = {}
+    direct_reports = {}
+    moved = []
+    for employee in sorted(employees, key=lambda e: e.depth, reverse=True):
+        if employee.path is None:
+            continue
+        headcount = employee.headcount + headcounts.get(employee.employeeID, 0)
+        if headcount > 0:
+            moved += _reroot_subordinates(employee)
+        manager_path = _manager_path(employee)
+        if manager_path is not None:
+            _add_to_chain(headcounts, direct_reports, manager_path, -(headcount + 1), -1)
+
+    removed = {e.employeeID for e in employees}
+    _update_aggregates({e: d for e, d in headcounts.items() if e not in removed},
+                       {e: d for e, d in direct_reports.items() if e not in removed})
+    return [e for e in moved if e not in removed]
+
+
+# Computes the index of a whole set of employees from their (employeeID, managerID) pairs,
+# walking down from the top managers: returns {employeeID: (path, depth)}. Employees whose
+# manager isn't in the set (or that are in a loop) are left out.
+def compute_paths(managers):
+    subordinates = {}
+    for employeeID, managerID in managers:
+        subordinates.setdefault(managerID, []).append(employeeID)
+
+    paths = {}
+    stack = [(employeeID, None, 0) for employeeID in subordinates.get(None, [])]
+    while len(stack) > 0:
+        employeeID, manager_path, depth = stack.pop()
+        path = build_path(employeeID, manager_path)
+        paths[employeeID] = (path, depth)
+        stack.extend((sub, path, depth + 1) for sub in subordinates.get(employeeID, []))
+    return paths
+
+
+# Same as compute_paths, along with the aggregates of each employee:
+# returns {employeeID: (path, depth, headcount, directReports)}.
+def compute_index(managers):
+    paths = compute_paths(managers)
+    headcounts = dict.fromkeys(paths, 0)
+    direct_reports = dict.fromkeys(paths, 0)
+    for path, depth in paths.values():
+        chain = path_to_ids(path)
+        for employeeID in chain[:-1]:
+            headcounts[employeeID] += 1
+        if depth > 0:
+            direct_reports[chain[-2]] += 1
+    return {e: (path, depth, headcounts[e], direct_reports[e]) for e, (path, depth) in paths.items()}
+
+
+# Recomputes the index from the managerID column, for every employee or only for the
+# employees of the given companies (None standing for employees without a company).
+# Only the rows whose index actually changed are written, and their IDs returned. Used
+# after writes that bypass the functions above (imports) or to repair a database.
+# Without 'aggregates', only the paths and depths are rebuilt (for databases migrated
+# from before the aggregate columns existed, see models/migrations.py).
+def rebuild_paths(companyIDs=None, aggregates=True):
+    columns = [Employee.path, Employee.depth] + ([Employee.headcount, Employee.directReports] if aggregates else [])
+    query = db.session.query(Employee.employeeID, Employee.managerID, *columns)
+    if companyIDs is not None:
+        companyIDs = set(companyIDs)
+        company_filter = Employee.companyID.in_([c for c in companyIDs if c is not None])
+        if None in companyIDs:
+            company_filter = or_(company_filter, Employee.companyID.is_(None))
+        query = query.filter(company_filter)
+
+    rows = query.all()
+    current = {row[0]: tuple(row[2:]) for row in rows}
+    managers = [(employeeID, managerID) for employeeID, managerID, *_ in rows]
+    index = compute_index(managers) if aggregates else compute_paths(managers)
+    mappings = [dict(zip(['employeeID'] + [c.key for c in columns], (employeeID,) + values))
+                for employeeID, values in index.items() if current[employeeID] != values]
+
+    db.session.bulk_update_mappings(Employee, mappings)
+    return [m['employeeID'] for m in mappings]
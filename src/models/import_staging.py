@@ -0,0 +1,14 @@
+from app.app_core import db
+
+# ======================================= M O D E L ======================================== #
+# Managers of the employees being imported (see routes/data_transfer.py). Employees are
+# imported without a manager, since it may come later in the file, and their managers are
+# kept here until the whole file is read, then validated and assigned all at once.
+# 'row' is the position of the employee in the file, to report its errors.
+class PendingManager(db.Model):
+    __tablename__ = 'ImportPendingManagers'
+    importID = db.Column(db.String(32), primary_key=True)
+    employeeID = db.Column(db.Integer, primary_key=True)
+    managerID = db.Column(db.Integer, nullable=False)
+    row = db.Column(db.Integer, nullable=False)
+# ========================================================================================== #
@@ -0,0 +1,49 @@
+import json
+import datetime
+
+from app.app_core import db, ma
+
+# ======================================= M O D E L ======================================== #
+# Background jobs (see app/jobs.py). 'payload' and 'result' hold JSON documents: what the
+# job must do, and its report once it is finished (or its errors, when it failed).
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class Job(db.Model):
+    __tablename__ = 'Jobs'
+    __table_args__ = (
+        # workers look for the queued jobs when they start
+        db.Index('ix_Jobs_status', 'status'),
+    )
+    jobID = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=JOB_QUEUED)
+    payload = db.Column(db.Text, nullable=False)
+    result = db.Column(db.Text)
+    createdAt = db.Column(db.DateTime, nullable=False)
+    startedAt = db.Column(db.DateTime)
+    finishedAt = db.Column(db.DateTime)
+
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.status = JOB_QUEUED
+        self.payload = json.dumps(payload)
+        self.createdAt = utc_now()
+# ========================================================================================== #
+
+
+# ====================================== S C H E M A ======================================= #
+class JobSchema(ma.Schema):
+    class Meta:
+        # Fields to expose
+        fields = ('jobID', 'kind', 'status', 'createdAt', 'startedAt', 'finishedAt')
+
+job_schema = JobSchema()
+# ========================================================================================== #
@@ -0,0 +1,113 @@
+from sqlalchemy import inspect, text
+
+from app.app_core import db
+from models.employee_model import Employee
+import models.hierarchy as hierarchy
+import models.search_index as search_index
+# new tables, like DataVersion, are created by db.create_all() and need no migration
+import models.data_versions
+import models.change_log
+import models.import_staging
+
+# ================================ M I G R A T I O N S ============================== #
+# db.create_all() only creates the tables that don't exist yet, it never alters an
+# existing database (new columns, indexes, triggers...). Every such change to the
+# models must come with a migration below, so databases created by older versions of
+# the API are brought up to date when it starts.
+#
+# The version of a database is kept in the SchemaVersion table. A fresh database is
+# created straight at the latest version, an existing one runs the migrations it is
+# missing, in order, each in its own transaction.
+# =================================================================================== #
+schema_version = db.Table('SchemaVersion', db.Column('version', db.Integer, nullable=False))
+
+
+def get_version():
+    version = db.session.execute(text('SELECT MAX(version) FROM SchemaVersion')).scalar()
+    return 0 if version is None else version
+
+
+def set_version(version):
+    db.session.execute(schema_version.delete())
+    db.session.execute(schema_version.insert().values(version=version))
+
+
+def get_columns(table_name):
+    return {c['name'] for c in inspect(db.session.connection()).get_columns(table_name)}
+
+
+def create_indexes(table, *names):
+    for index in table.indexes:
+        if index.name in names:
+            index.create(bind=db.session.connection(), checkfirst=True)
+
+
+# --------------------------------------------------------------------------------- #
+def add_hierarchy_index():
+    columns = get_columns(Employee.__tablename__)
+    if 'path' not in columns:
+        db.session.execute(text('ALTER TABLE Employees ADD COLUMN path VARCHAR(1024)'))
+    if 'depth' not in columns:
+        db.session.execute(text('ALTER TABLE Employees ADD COLUMN depth INTEGER NOT NULL DEFAULT 0'))
+    create_indexes(Employee.__table__, 'ix_Employees_path')
+    # the aggregate columns only come with migration 4, which rebuilds them
+    hierarchy.rebuild_paths(aggregates=False)
+
+
+def add_search_indexes():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    tables = inspect(db.session.connection()).get_table_names()
+    for model, (index, _) in search_index.SEARCH_INDEXES.items():
+        if index in tables:
+            continue
+        for ddl in search_index.search_index_ddl(model):
+            db.session.execute(text(ddl.statement))
+        search_index.rebuild_search_index(model)
+
+
+def add_foreign_key_indexes():
+    create_indexes(Employee.__table__, 'ix_Employees_companyID_managerID', 'ix_Employees_managerID')
+
+
+def add_employee_aggregates():
+    columns = get_columns(Employee.__tablename__)
+    if 'headcount' not in columns:
+        db.session.execute(text('ALTER TABLE Employees ADD COLUMN headcount INTEGER NOT NULL DEFAULT 0'))
+    if 'directReports' not in columns:
+        db.session.execute(text('ALTER TABLE Employees ADD COLUMN directReports INTEGER NOT NULL DEFAULT 0'))
+    create_indexes(Employee.__table__, 'ix_Employees_companyID_headcount')
+    hierarchy.rebuild_paths()
+
+
+MIGRATIONS = [
+    (1, 'hierarchy index (Employees.path and Employees.depth)', add_hierarchy_index),
+    (2, 'name search indexes (EmployeesSearch and CompaniesSearch)', add_search_indexes),
+    (3, 'indexes on Employees.companyID and Employees.managerID', add_foreign_key_indexes),
+    (4, 'employee aggregates (Employees.headcount and Employees.directReports)', add_employee_aggregates),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+# --------------------------------------------------------------------------------- #
+
+
+# Creates the database or brings it up to date. Replaces a plain db.create_all().
+def upgrade():
+    fresh = not inspect(db.engine).has_table(Employee.__tablename__)
+    db.create_all()
+    if fresh:
+        set_version(LATEST_VERSION)
+        db.session.commit()
+        return
+
+    current_version = get_version()
+    for version, description, migrate in MIGRATIONS:
+        if version <= current_version:
+            continue
+        print(" Migrating database to version {}: {} ".format(version, description))
+        try:
+            migrate()
+            set_version(version)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
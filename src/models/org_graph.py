@@ -0,0 +1,279 @@
+from array import array
+from bisect import bisect_left
+from flask import current_app
+import os
+import threading
+
+from app.app_core import db
+from models.employee_model import Employee
+import models.data_versions as data_versions
+
+# ================================ O R G   G R A P H ================================ #
+# Optional in-process copy of the company structures, so the structure reads walk plain
+# arrays instead of running recursive queries. Enabled by COMPANIFY_GRAPH_ENGINE=1.
+#
+# Each company (CompanyGraph) keeps, for its employees sorted by employeeID:
+#     ids       the employeeIDs (8 bytes each), looked up by binary search
+#     parents   the index of each employee's manager (4 bytes each), or NO_MANAGER
+#     starts    CSR child lists: the subordinates of the employee at index i are
+#     children  children[starts[i + 1]:starts[i + 2]] (starts[0:1] for top managers)
+# about 20 bytes per employee, instead of an ORM object. The CSR lists are rebuilt in
+# one pass; in between, writes go to a small overlay (the employees whose position in
+# the lists is outdated, and the subordinates added to each manager since), which is
+# merged back once it grows past COMPACT_RATIO of the company.
+#
+# The writes of routes/employee_routes.py update the graphs copy-on-write: the changes go
+# to a copy of the company, which then replaces it under the lock, so the graphs readers
+# hold are never changed while they walk them. Any other write
+# (bulk endpoints, another worker process...) is noticed by the version of the company
+# (see models/data_versions.py), checked on every read: a stale company is loaded again
+# with one query. Only the traversals run in memory, the payloads of the employees they
+# return are still read from the database, by primary key.
+# =================================================================================== #
+NO_MANAGER = -1
+REMOVED = -2
+COMPACT_RATIO = 8
+COMPACT_MIN = 1024
+
+
+class CompanyGraph:
+    # 'rows' are the (employeeID, managerID) of the company, ordered by employeeID.
+    def __init__(self, rows, version):
+        self.version = version
+        self.ids = array('q')
+        managers = []
+        for employeeID, managerID in rows:
+            self.ids.append(employeeID)
+            managers.append(managerID)
+        self.parents = array('i', [NO_MANAGER]) * len(self.ids)
+        for index, managerID in enumerate(managers):
+            if managerID is not None:
+                self.parents[index] = self.find(managerID)
+        self.compact()
+
+    # A copy to apply writes to: the CSR lists are never changed in place, only replaced
+    # by compact(), so they are shared.
+    def copy(self):
+        graph = CompanyGraph.__new__(CompanyGraph)
+        graph.version = self.version
+        graph.ids = array('q', self.ids)
+        graph.parents = array('i', self.parents)
+        graph.starts = self.starts
+        graph.children = self.children
+        graph.indexed = self.indexed
+        graph.outdated = set(self.outdated)
+        graph.added = {parent: list(added) for parent, added in self.added.items()}
+        return graph
+
+    def find(self, employeeID):
+        index = bisect_left(self.ids, employeeID)
+        if index < len(self.ids) and self.ids[index] == employeeID and self.parents[index] != REMOVED:
+            return index
+        return NO_MANAGER
+
+    # Rebuilds the CSR child lists from the parents, dropping the removed employees.
+    def compact(self):
+        if REMOVED in self.parents:
+            kept = [i for i, parent in enumerate(self.parents) if parent != REMOVED]
+            new_index = array('i', [NO_MANAGER]) * len(self.parents)
+            for new, old in enumerate(kept):
+                new_index[old] = new
+            self.ids = array('q', (self.ids[i] for i in kept))
+            self.parents = array('i', (new_index[self.parents[i]] if self.parents[i] >= 0 else NO_MANAGER for i in kept))
+
+        size = len(self.parents)
+        starts = array('i', [0]) * (size + 2)
+        for parent in self.parents:
+            starts[parent + 2] += 1
+        for key in range(1, size + 2):
+            starts[key] += starts[key - 1]
+        children = array('i', [0]) * size
+        position = array('i', starts)
+        for index, parent in enumerate(self.parents):
+            children[position[parent + 1]] = index
+            position[parent + 1] += 1
+        self.starts = starts
+        self.children = children
+        self.indexed = size
+        self.outdated = set()
+        self.added = {}
+
+    def subordinates(self, index):
+        key = index + 1
+        subordinates = self.children[self.starts[key]:self.starts[key + 1]] if index < self.indexed else ()
+        if len(self.outdated) > 0:
+            subordinates = [s for s in subordinates if s not in self.outdated]
+        added = self.added.get(index)
+        if added is not None:
+            subordinates = sorted(list(subordinates) + added)
+        return subordinates
+
+    def _attach(self, index, parent):
+        old_parent = self.parents[index]
+        if index in self.added.get(old_parent, ()):
+            self.added[old_parent].remove(index)
+        if index < self.indexed:
+            self.outdated.add(index)
+        self.parents[index] = parent
+        if parent != REMOVED:
+            self.added.setdefault(parent, []).append(index)
+        if len(self.outdated) + len(self.parents) - self.indexed > max(COMPACT_MIN, len(self.parents) // COMPACT_RATIO):
+            self.compact()
+
+    # --------------------------------- W R I T E S --------------------------------- #
+    # False when the employee can't be added in place (its ID isn't the largest), in
+    # which case the company must be loaded again.
+    def add(self, employeeID, managerID):
+        if len(self.ids) > 0 and employeeID <= self.ids[-1]:
+            return False
+        self.ids.append(employeeID)
+        self.parents.append(REMOVED)
+        self._attach(len(self.ids) - 1, self.find(managerID) if managerID is not None else NO_MANAGER)
+        return True
+
+    def move(self, employeeID, managerID):
+        index = self.find(employeeID)
+        if index == NO_MANAGER:
+            return False
+        self._attach(index, self.find(managerID) if managerID is not None else NO_MANAGER)
+        return True
+
+    # Removes the employee, leaving its subordinates without a manager (as deleting it, or
+    # the change_manager_after_update_companyID trigger when it changes companies, does).
+    def remove(self, employeeID):
+        index = self.find(employeeID)
+        if index == NO_MANAGER:
+            return False
+        for subordinate in list(self.subordinates(index)):
+            self._attach(subordinate, NO_MANAGER)
+        self._attach(index, REMOVED)
+        return True
+
+    # ---------------------------------- R E A D S ---------------------------------- #
+    # (employeeID, level) of everyone under the employee ordered by level and employeeID,
+    # as models/structure_queries.subtree: only that level if given, else every level.
+    def subtree(self, employeeID, level=None):
+        index = self.find(employeeID)
+        if index == NO_MANAGER:
+            return []
+        result = []
+        frontier = [index]
+        current = 0
+        visited = 0
+        while len(frontier) > 0 and (level is None or current < level) and visited <= len(self.ids):
+            frontier = sorted(s for parent in frontier for s in self.subordinates(parent))
+            current += 1
+            visited += len(frontier)
+            if level is None or current == level:
+                result.extend((self.ids[s], current) for s in frontier)
+        return result
+
+    # employeeIDs under the manager (None for the top managers), ordered.
+    def siblings(self, managerID):
+        parent = NO_MANAGER if managerID is None else self.find(managerID)
+        if managerID is not None and parent == NO_MANAGER:
+            return []
+        return [self.ids[s] for s in self.subordinates(parent)]
+
+
+class OrgGraph:
+    def __init__(self):
+        self.companies = {}
+        self.lock = threading.RLock()
+
+    def versions(self, companyIDs):
+        return {c: data_versions.get_version(data_versions.company_scope(c)) for c in set(companyIDs)}
+
+    def _load(self, companyID, version):
+        query = db.session.query(Employee.employeeID, Employee.managerID)
+        query = query.filter(Employee.companyID.is_(None) if companyID is None else Employee.companyID == companyID)
+        return CompanyGraph(query.order_by(Employee.employeeID).yield_per(10000), version)
+
+    # The graph of the company, loaded again if the company changed since it was read.
+    # Only for reads outside of a write: a graph loaded in the middle of one would hold
+    # its uncommitted changes, with the version from before them.
+    def company(self, companyID):
+        version = self.versions([companyID])[companyID]
+        with self.lock:
+            graph = self.companies.get(companyID)
+            if graph is None or graph.version != version:
+                graph = self._load(companyID, version)
+                self.companies[companyID] = graph
+            return graph
+
+    # Loads every company, e.g. when the API starts.
+    def load_all(self):
+        companyIDs = [c for c, in db.session.query(Employee.companyID).distinct()]
+        for companyID in companyIDs:
+            self.company(companyID)
+
+    # Applies the changes of a write to the companies that were up to date before it
+    # ('before', their versions before the write), which then take the versions after it.
+    # Changes are ('add' | 'move', companyID, employeeID, managerID) or ('remove', companyID,
+    # employeeID), in the order they happened. They are made to copies of the graphs (see
+    # CompanyGraph.copy), which replace them once every change is in.
+    def apply(self, before, after, changes):
+        with self.lock:
+            for companyID, version in before.items():
+                graph = self.companies.get(companyID)
+                if graph is not None and graph.version != version:
+                    del self.companies[companyID]
+            copies = {}
+            for operation, companyID, *arguments in changes:
+                if companyID not in copies:
+                    graph = self.companies.get(companyID)
+                    copies[companyID] = None if graph is None else graph.copy()
+                graph = copies[companyID]
+                if graph is not None and not getattr(graph, operation)(*arguments):
+                    copies[companyID] = None
+            for companyID, graph in copies.items():
+                if graph is None:
+                    self.companies.pop(companyID, None)
+                else:
+                    self.companies[companyID] = graph
+            # the version is only read under the lock, so it can be changed in place
+            for companyID, version in after.items():
+                if companyID in self.companies:
+                    self.companies[companyID].version = version
+
+    def clear(self):
+        with self.lock:
+            self.companies.clear()
+
+
+# ------------------------------------ A P P ------------------------------------ #
+def init_org_graph(app):
+    if os.environ.get('COMPANIFY_GRAPH_ENGINE', '0') == '1':
+        app.extensions['companify_org_graph'] = OrgGraph()
+
+
+# The engine of the app, or None when it is disabled.
+def get_org_graph():
+    return current_app.extensions.get('companify_org_graph')
+
+
+# Loads the graphs of every company ahead of the first requests, if enabled. Otherwise
+# each company is loaded by the first read that needs it.
+def warm_up_org_graph():
+    graph = get_org_graph()
+    if graph is not None:
+        graph.load_all()
+        db.session.commit()
+
+
+# Bumps the versions of the employees of the companies (see data_versions.bump_employees),
+# keeping the versions before and after, to update the graph once the write is committed.
+def bump_employees(companyIDs):
+    graph = get_org_graph()
+    if graph is None:
+        data_versions.bump_employees(companyIDs)
+        return None
+    before = graph.versions(companyIDs)
+    data_versions.bump_employees(companyIDs)
+    return before, graph.versions(companyIDs)
+
+
+def apply_changes(versions, *changes):
+    graph = get_org_graph()
+    if graph is not None and versions is not None:
+        graph.apply(*versions, changes)
@@ -0,0 +1,119 @@
+from sqlalchemy import DDL, and_, case, column, event, literal, select, table, text
+
+from app.app_core import db
+from models.company_model import Company
+from models.employee_model import Employee
+
+# ============================== S E A R C H   I N D E X ============================ #
+# Full-text indexes on the names of companies and employees, so searching by name
+# doesn't scan the whole table. Each index is an SQLite FTS5 table with the trigram
+# tokenizer (any substring of 3+ characters is indexed, case insensitive), using the
+# model's table as external content. Triggers keep it in sync on insert, update and
+# delete, whichever way the rows are written.
+#
+# Terms shorter than 3 characters can't use a trigram index and fall back to LIKE.
+# =================================================================================== #
+MIN_TERM_LENGTH = 3
+
+# model => (search index table, column of the model's primary key)
+SEARCH_INDEXES = {
+    Employee: ('EmployeesSearch', 'employeeID'),
+    Company: ('CompaniesSearch', 'companyID')
+}
+
+
+def search_index_ddl(model):
+    index, key = SEARCH_INDEXES[model]
+    source = model.__tablename__
+    return [
+        DDL('''\
+            CREATE VIRTUAL TABLE {index} USING fts5(
+                name, content='{source}', content_rowid='{key}', tokenize='trigram'
+            );'''.format(index=index, source=source, key=key)),
+        DDL('''\
+            CREATE TRIGGER {index}_after_insert AFTER INSERT ON {source}
+            BEGIN
+                INSERT INTO {index}(rowid, name) VALUES (NEW.{key}, NEW.name);
+            END;'''.format(index=index, source=source, key=key)),
+        DDL('''\
+            CREATE TRIGGER {index}_after_delete AFTER DELETE ON {source}
+            BEGIN
+                INSERT INTO {index}({index}, rowid, name) VALUES ('delete', OLD.{key}, OLD.name);
+            END;'''.format(index=index, source=source, key=key)),
+        DDL('''\
+            CREATE TRIGGER {index}_after_update_name AFTER UPDATE OF name ON {source}
+            BEGIN
+                INSERT INTO {index}({index}, rowid, name) VALUES ('delete', OLD.{key}, OLD.name);
+                INSERT INTO {index}(rowid, name) VALUES (NEW.{key}, NEW.name);
+            END;'''.format(index=index, source=source, key=key))
+    ]
+
+
+# Repopulates an index from its content table, e.g. for a database created before it.
+def rebuild_search_index(model):
+    index, _ = SEARCH_INDEXES[model]
+    db.session.execute(text("INSERT INTO {index}({index}) VALUES ('rebuild')".format(index=index)))
+
+
+for model in SEARCH_INDEXES:
+    for ddl in search_index_ddl(model):
+        event.listen(model.__table__, 'after_create', ddl.execute_if(dialect='sqlite'))
+    # the index isn't known by the metadata, so it has to be dropped along with its table
+    event.listen(model.__table__, 'before_drop',
+                 DDL('DROP TABLE IF EXISTS {}'.format(SEARCH_INDEXES[model][0])).execute_if(dialect='sqlite'))
+
+
+def _search_index(model):
+    index, _ = SEARCH_INDEXES[model]
+    return table(index, column('rowid'), column('rank'), column(index))
+
+
+def _uses_index(name):
+    return len(name) >= MIN_TERM_LENGTH and db.engine.dialect.name == 'sqlite'
+
+
+# Full-text condition on the index, searching the term as a whole (a trigram phrase).
+def _match(index, name):
+    terms = '"' + name.replace('"', '""') + '"'
+    return index.c[index.name].op('MATCH')(terms)
+
+
+# How well the name matches the term: 0 when the name starts with it, 1 when one of
+# its words does, 2 when it is just somewhere in the middle.
+def _match_quality(model, name):
+    return case(
+        (model.name.like(name + '%'), 0),
+        ((literal(' ') + model.name).like('% ' + name + '%'), 1),
+        else_=2
+    )
+
+
+# Filter for the rows of 'model' whose name contains 'name' (or has a word that starts
+# with it, when prefix is True). Case insensitive, like the LIKE it replaces.
+def name_filter(model, name, prefix=False):
+    if prefix:
+        name_condition = _match_quality(model, name) < 2
+    else:
+        name_condition = model.name.like('%' + name + '%')
+    if not _uses_index(name):
+        return name_condition
+
+    index = _search_index(model)
+    key = model.__mapper__.primary_key[0]
+    matches = key.in_(select(index.c.rowid).where(_match(index, name)))
+    return and_(matches, name_condition) if prefix else matches
+
+
+# Query of the 'limit' best matches of 'name': names starting with it first, then
+# names with a word starting with it, then the rest by relevance (bm25) and ID.
+def ranked_search(model, name, limit, prefix=False):
+    key = model.__mapper__.primary_key[0]
+    quality = _match_quality(model, name)
+    if not _uses_index(name):
+        return model.query.filter(name_filter(model, name, prefix)).order_by(quality, key).limit(limit)
+
+    index = _search_index(model)
+    query = model.query.join(index, key == index.c.rowid).filter(_match(index, name))
+    if prefix:
+        query = query.filter(quality < 2)
+    return query.order_by(quality, index.c.rank, key).limit(limit)
@@ -0,0 +1,64 @@
+from flask import current_app
+import sqlite3
+
+from app.app_core import db
+from app.cache import get_cache
+import models.data_versions as data_versions
+from models.org_graph import get_org_graph
+
+# =================================== S N A P S H O T S ================================= #
+# Named copies of the whole test database, kept in memory, so it can be put back in a
+# known state (e.g. right after the fixtures are loaded) in milliseconds, instead of
+# dropping it and loading everything again. Uses SQLite's online backup API, which copies
+# every page of the database, schema and search indexes included.
+#
+# Snapshots live in the process that took them, and only SQLite databases support them.
+# =================================================================================== #
+
+
+def snapshots_supported():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def _snapshots():
+    return current_app.extensions.setdefault('companify_snapshots', {})
+
+
+def has_snapshot(name):
+    return name in _snapshots()
+
+
+def _copy(source, target):
+    source.backup(target)
+    target.commit()
+
+
+def take_snapshot(name):
+    db.session.commit()
+    snapshot = sqlite3.connect(':memory:', check_same_thread=False)
+    connection = db.engine.raw_connection()
+    try:
+        _copy(connection.driver_connection, snapshot)
+    finally:
+        connection.close()
+    old_snapshot = _snapshots().get(name)
+    _snapshots()[name] = snapshot
+    if old_snapshot is not None:
+        old_snapshot.close()
+
+
+def restore_snapshot(name):
+    db.session.remove()
+    connection = db.engine.raw_connection()
+    try:
+        _copy(_snapshots()[name], connection.driver_connection)
+    finally:
+        connection.close()
+    get_cache().clear()
+    # the versions go back with the data too, so the graphs can't be told stale by them
+    if get_org_graph() is not None:
+        get_org_graph().clear()
+    # the data may go back to older versions, which must not be confused with the ones
+    # that clients have seen since the snapshot was taken
+    data_versions.bump_all()
+    db.session.commit()
@@ -0,0 +1,35 @@
+from sqlalchemy import literal, select
+from sqlalchemy.orm import aliased
+
+from app.app_core import db
+from models.employee_model import Employee
+
+# ======================== S T R U C T U R E   Q U E R I E S ======================== #
+# Company structure traversals written as a single WITH RECURSIVE statement each, so
+# walking a structure costs one round trip to the database no matter how deep it is
+# (and no Python recursion limit to hit). They only rely on the managerID adjacency,
+# not on the hierarchy index of models/hierarchy.py.
+# =================================================================================== #
+
+
+# Query of (Employee, level) for everyone under the employee, 'level' being how many
+# grades below it they are. With 'level' set, only that grade is returned (and the
+# recursion stops there), otherwise the whole subtree is.
+def subtree(employeeID, level=None):
+    tree = select(Employee.employeeID, literal(0).label('level'))\
+        .where(Employee.employeeID == employeeID)\
+        .cte('subtree', recursive=True)
+    subordinate = aliased(Employee)
+    step = select(subordinate.employeeID, tree.c.level + 1)\
+        .join(tree, subordinate.managerID == tree.c.employeeID)
+    if level is not None:
+        step = step.where(tree.c.level < level)
+    tree = tree.union_all(step)
+
+    query = db.session.query(Employee, tree.c.level)\
+        .join(tree, Employee.employeeID == tree.c.employeeID)
+    if level is not None:
+        query = query.filter(tree.c.level == level)
+    else:
+        query = query.filter(tree.c.level > 0)
+    return query.order_by(tree.c.level, Employee.employeeID)
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from flask import current_app, g, make_response, request
+import json
+import math
+import os
+import threading
+import time
+
+import routes.api_error_handler as aeh
+from routes.api_error_handler import error_handler
+
+# ========================== A D M I S S I O N   C O N T R O L ========================== #
+# Decides, before an endpoint runs, whether the server takes the request on. Enabled by
+# COMPANIFY_ADMISSION_CONTROL (default 1); requests that aren't admitted get a 429 with a
+# 'Retry-After' header (seconds), in the format of every other error.
+#
+# Each client has a token bucket: it holds up to 'burst' tokens and gets 'rate' tokens
+# back per second. A request costs 1 token, plus 1 per COMPANIFY_ROWS_PER_TOKEN rows (100)
+# it is expected to read, as estimated by the endpoint (see admission_cost) from the
+# aggregates kept by models/hierarchy.py, e.g. the headcount of the employee whose whole
+# structure is asked for. A request costing more than the burst takes the whole bucket.
+#     COMPANIFY_RATE_LIMIT            tokens given back per second to each client (default 100)
+#     COMPANIFY_RATE_BURST            tokens of a full bucket (default 1000)
+#     COMPANIFY_CLIENT_QUOTAS         JSON object with the [rate, burst] of given clients
+#     COMPANIFY_CLIENT_HEADER         header naming the client (e.g. set by a gateway in
+#                                     front of the API); the client's address if not set,
+#                                     which behind a reverse proxy is the proxy's for every
+#                                     client, so proxied deployments must set it
+#
+# Requests costing COMPANIFY_EXPENSIVE_COST tokens or more (default 10) are expensive: at
+# most COMPANIFY_MAX_EXPENSIVE_REQUESTS of them (default 2) run at the same time, and the
+# ones over the cap are turned away right away instead of waiting. The other threads of the
+# server are left to the cheap requests, which never wait for the expensive ones.
+#
+# Buckets and caps are kept by each worker process, up to MAX_BUCKETS clients: the buckets
+# of the clients seen least recently are dropped first, as a new bucket would be full.
+# ======================================================================================= #
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Takes the tokens, if there are enough. Returns how long to wait (seconds) for them
+    # otherwise, 0 if they were taken.
+    def take(self, cost, now):
+        self.refill(now)
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    def __init__(self, rate, burst, quotas, rows_per_token, expensive_cost, max_expensive, client_header=None):
+        self.rate = rate
+        self.burst = burst
+        self.quotas = dict(quotas)
+        self.rows_per_token = rows_per_token
+        self.expensive_cost = expensive_cost
+        self.client_header = client_header
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.expensive_slots = threading.BoundedSemaphore(max_expensive)
+
+    def client(self):
+        if self.client_header is not None and self.client_header in request.headers:
+            return request.headers[self.client_header]
+        return request.remote_addr
+
+    def set_quota(self, client, rate, burst):
+        with self.lock:
+            self.quotas[client] = (rate, burst)
+            self.buckets.pop(client, None)
+
+    def cost(self, rows):
+        return 1 + rows // self.rows_per_token
+
+    def bucket(self, client, now):
+        bucket = self.buckets.get(client)
+        if bucket is not None:
+            self.buckets.move_to_end(client)
+            return bucket
+        if len(self.buckets) >= MAX_BUCKETS:
+            self.buckets.popitem(last=False)
+        bucket = TokenBucket(*self.quotas.get(client, (self.rate, self.burst)), now)
+        self.buckets[client] = bucket
+        return bucket
+
+    # Takes 'tokens' from the bucket of the client: returns the seconds to wait for them, 0
+    # when they were taken. An expensive request must also get one of the expensive slots,
+    # to be given back with release(), and is turned away when there is none left.
+    def admit(self, client, tokens, expensive=False):
+        if expensive and not self.expensive_slots.acquire(blocking=False):
+            return 1
+        with self.lock:
+            now = time.monotonic()
+            retry_after = self.bucket(client, now).take(tokens, now)
+        if expensive and retry_after > 0:
+            self.expensive_slots.release()
+        return retry_after
+
+    # Gives back tokens taken by admit() for a request that was turned away afterwards.
+    def refund(self, client, tokens):
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is not None:
+                bucket.tokens = min(bucket.burst, bucket.tokens + tokens)
+
+    def release(self):
+        self.expensive_slots.release()
+
+
+# Decorates an endpoint with the estimate of the rows it reads, 'estimate_rows' being
+# called with the arguments of the endpoint before it runs. Endpoints without it cost 1.
+def admission_cost(estimate_rows):
+    def decorator(endpoint):
+        endpoint.estimate_rows = estimate_rows
+        return endpoint
+    return decorator
+
+
+def get_admission():
+    return current_app.extensions.get('companify_admission')
+
+
+# Every request first takes its base token, so a client over its quota is turned away
+# before its cost is estimated: the estimates read the database, if only a few rows. The
+# base token is given back when the rest of the cost is turned away.
+def check_admission():
+    admission = get_admission()
+    client = admission.client()
+    retry_after = admission.admit(client, 1)
+    endpoint = current_app.view_functions.get(request.endpoint)
+    estimate_rows = getattr(endpoint, 'estimate_rows', None)
+    if retry_after == 0 and estimate_rows is not None:
+        cost = admission.cost(estimate_rows(**(request.view_args or {})))
+        expensive = cost >= admission.expensive_cost
+        retry_after = admission.admit(client, cost - 1, expensive)
+        g.companify_expensive_request = expensive and retry_after == 0
+        if retry_after > 0:
+            admission.refund(client, 1)
+    if retry_after > 0:
+        retry_after = math.ceil(retry_after)
+        response = make_response(error_handler(429, aeh.HTTP_TOO_MANY_REQUESTS, retry_after))
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+
+def release_admission(exception=None):
+    if g.pop('companify_expensive_request', False):
+        get_admission().release()
+
+
+def init_admission(app, default_client_header=None):
+    if os.environ.get('COMPANIFY_ADMISSION_CONTROL', '1') == '0':
+        return
+    app.extensions['companify_admission'] = AdmissionControl(
+        rate=float(os.environ.get('COMPANIFY_RATE_LIMIT', 100)),
+        burst=float(os.environ.get('COMPANIFY_RATE_BURST', 1000)),
+        quotas={client: tuple(quota) for client, quota in json.loads(os.environ.get('COMPANIFY_CLIENT_QUOTAS', '{}')).items()},
+        rows_per_token=int(os.environ.get('COMPANIFY_ROWS_PER_TOKEN', 100)),
+        expensive_cost=float(os.environ.get('COMPANIFY_EXPENSIVE_COST', 10)),
+        max_expensive=int(os.environ.get('COMPANIFY_MAX_EXPENSIVE_REQUESTS', 2)),
+        client_header=os.environ.get('COMPANIFY_CLIENT_HEADER', default_client_header)
+    )
+    app.before_request(check_admission)
+    app.teardown_request(release_admission)
@@ -0,0 +1,133 @@
+from app.cache import get_cache
+from models.company_model import Company, company_schema
+from models.employee_model import Employee, employee_detail_schema
+from models.hierarchy import path_to_ids
+
+# ================================== A P I   C A C H E ================================== #
+# What the API caches (see app/cache.py) and when it stops being valid:
+#     employee:<employeeID>                  payload of the employee, with its aggregates
+#     company:<companyID>                    payload of the company
+#     structure:<employeeID>                 subordinates of the employee, by level
+#     siblings:<companyID>:<managerID>       employees of the company under that manager
+#                                            (structure level 0)
+# Every write must invalidate the entries of the employees it changes, through the state
+# (employee_state) they had before AND after the write: their payloads, their groups of
+# siblings and the payload and structure of everyone above them in the chain of management
+# (whose aggregates change too). Writes that re-index whole subtrees also invalidate the
+# payloads of the employees in them (invalidate_payloads), since their depth changed.
+# ======================================================================================= #
+
+
+def employee_key(employeeID):
+    return 'employee:{}'.format(employeeID)
+
+
+def company_key(companyID):
+    return 'company:{}'.format(companyID)
+
+
+def structure_key(employeeID):
+    return 'structure:{}'.format(employeeID)
+
+
+def siblings_key(companyID, managerID):
+    return 'siblings:{}:{}'.format(companyID, managerID)
+
+
+# IDs in the URLs are strings, and '7' and '007' must share the same entry.
+def parse_id(id):
+    try:
+        return int(id)
+    except (TypeError, ValueError):
+        return None
+
+
+def cached(key, loader):
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = loader()
+        if value is not None:
+            cache.set(key, value)
+    return value
+
+
+def get_employee_payload(employeeID):
+    employeeID = parse_id(employeeID)
+    if employeeID is None:
+        return None
+
+    def load():
+        employee = Employee.query.get(employeeID)
+        return None if employee is None else employee_detail_schema.dump(employee)
+    return cached(employee_key(employeeID), load)
+
+
+def get_company_payload(companyID):
+    companyID = parse_id(companyID)
+    if companyID is None:
+        return None
+
+    def load():
+        company = Company.query.get(companyID)
+        return None if company is None else company_schema.dump(company)
+    return cached(company_key(companyID), load)
+
+
+# Subordinates of the employee at 'level' ('all' for the whole structure), computed by
+# 'loader' on a miss. All the levels of an employee share one entry, to be invalidated at once.
+def get_structure(employeeID, level, loader):
+    cache = get_cache()
+    key = structure_key(employeeID)
+    levels = cache.get(key) or {}
+    if str(level) not in levels:
+        levels = dict(levels)
+        levels[str(level)] = loader()
+        cache.set(key, levels)
+    return levels[str(level)]
+
+
+def get_siblings(companyID, managerID, loader):
+    return cached(siblings_key(companyID, managerID), loader)
+
+
+# --------------------------------- I N V A L I D A T I O N ------------------------------ #
+def employee_state(employee):
+    return (employee.employeeID, employee.companyID, employee.managerID, employee.path)
+
+
+# States before and after the write of employees left without a manager (by deletion or by
+# the change_manager_after_update_companyID trigger), from their payloads before the write.
+# Their own subordinates don't change, so neither does their structure.
+def detached_states(payloads):
+    states = []
+    for payload in payloads or []:
+        states.append((payload['employeeID'], payload['companyID'], payload['managerID'], None))
+        states.append((payload['employeeID'], payload['companyID'], None, None))
+    return states
+
+
+def invalidate_employees(states):
+    keys = set()
+    for employeeID, companyID, managerID, path in states:
+        keys.add(employee_key(employeeID))
+        keys.add(siblings_key(companyID, managerID))
+        if path is not None:
+            keys.update(structure_key(e) for e in path_to_ids(path))
+            keys.update(employee_key(e) for e in path_to_ids(path))
+    get_cache().delete(*keys)
+
+
+def invalidate_payloads(employeeIDs):
+    if len(employeeIDs) > 0:
+        get_cache().delete(*[employee_key(e) for e in employeeIDs])
+
+
+# Every entry of a company and of its employees, e.g. when the company is deleted. The
+# employees' payloads are the ones returned by the write (managers are in the company).
+def invalidate_company_employees(companyID, payloads):
+    keys = {company_key(companyID), siblings_key(companyID, None), siblings_key(None, None)}
+    for payload in payloads:
+        keys.update((employee_key(payload['employeeID']), structure_key(payload['employeeID']),
+                     siblings_key(companyID, payload['employeeID'])))
+    get_cache().delete(*keys)
@@ -1,10 +1,11 @@
-from flask import Flask, request, jsonify
+from flask import request, jsonify
 
 # ===================== E R R O R   C O D E S ====================== #
 SQL_NOT_FOUND = "sql-0404"
 SQL_CONSTRAINT_FAILED = "sql-0001"
 HTTP_MISSING_PARAMS = "http-0001"
 HTTP_PARAM_TYPE = "http-0002"
+HTTP_TOO_MANY_REQUESTS = "http-0429"
 API_NOT_SAME_COMPANY = "api-0001"
 API_STRUCTURE_LOOP = "api-0002"
 # ================================================================== #
@@ -14,29 +15,42 @@ API_STRUCTURE_LOOP = "api-0002"
 NO_COMPANY_TO_ASSOCIATE = "No company found with ID {} to associate employee."
 NO_EMPLOYEE_TO_ASSIGN = "No employee found with ID {} to assign as manager."
 NO_EMPLOYEE_TO_DELETE = "Employee with ID {} does not exist to be deleted."
+NO_COMPANY_TO_DELETE = "Company with ID {} does not exist to be deleted."
 NO_EMPLOYEE_TO_EDIT = "Employee with ID {} not found. If you wish to create an employee, please use the POST request."
+EMAIL_ALREADY_IN_USE = "Email {} is already in use by another employee."
+REPEATED_IN_BATCH = "Employee with ID {} appears more than once in the batch."
+COMPANY_REPEATED_IN_BATCH = "Company with ID {} appears more than once in the batch."
+NO_EMPLOYEE_FOUND = "Employee with ID {} not found."
+NO_SNAPSHOTS = "Snapshots are only supported on SQLite databases."
+COMPANY_ALREADY_EXISTS = "Company with ID {} already exists."
+EMPLOYEE_ALREADY_EXISTS = "Employee with ID {} already exists."
+COMPANY_NAME_IN_USE = "Company name {} is already in use."
+INVALID_IMPORT_FILE = "The file is not valid {}: {}"
+INVALID_IMPORT_RECORD = "The record is not valid JSON: {}"
+IMPORT_BATCH_FAILED = "The import stopped at a batch that could not be written: {}"
 # ================================================================== #
 
 
 default_messages = {
     "http-0001": "Missing required parameter(s) {}. Please try again with these parameters.",
     "http-0002": "Parameter(s) {} expect {} input.",
+    "http-0429": "Too many requests. Please try again in {} second(s).",
     "sql-0404": "Specified {} not found in database.",
     "api-0001": "Manager (companyID = {}) and subordinate (companyID = {}) can't work in different companies.",
     "api-0002": "Not possible to assign this management relationship (probably due to a structure loop, see 'Company Structure & Constraints' in README for more information)."
 }
 
 
-# Handles error message to be returned to client. 
+# Builds the body of the error message to be returned to client. 
 # When no message is passed, assumes default message according to internal error_code.
 # Messages usually expect some parameters to be passed in *argv to fill in the blanks. 
-def error_handler(status_code, error_code, *argv, message=""):
+def error_body(status_code, error_code, *argv, message=""):
     if message == "":
         message = default_messages[error_code]
 
     message = message.format(*argv)
 
-    response = {
+    return {
         "error": {
             "status_code": status_code,
             "error_code": error_code,
@@ -44,7 +58,22 @@ def error_handler(status_code, error_code, *argv, message=""):
         }
     }
 
-    return jsonify(response), status_code
+
+# Handles error message to be returned to client (see error_body).
+def error_handler(status_code, error_code, *argv, message=""):
+    return jsonify(error_body(status_code, error_code, *argv, message=message)), status_code
+
+
+# Handles the errors of a batch request, reported per record: 'errors' maps the 
+# index of each failed record in the batch to its error_body.
+def bulk_error_body(errors):
+    return {
+        "errors": [dict(index=index, **errors[index]) for index in sorted(errors)]
+    }
+
+
+def bulk_error_handler(status_code, errors):
+    return jsonify(bulk_error_body(errors)), status_code
 
 
 def check_missing_parameters(request, required):
@@ -0,0 +1,61 @@
+from flask import Response, make_response, request
+from functools import wraps
+
+import models.data_versions as data_versions
+import routes.api_cache as api_cache
+
+# ==================================== E T A G S ==================================== #
+# Conditional GETs for the read endpoints. The ETag of a response is the version of the
+# data it comes from (see models/data_versions.py), so checking whether a client's copy
+# is still valid costs a lookup of that version: when it is, the answer is a 304 Not
+# Modified, without querying or serializing anything else.
+#
+# The version is read BEFORE the response is built, so a write committed meanwhile can
+# only make a client fetch an unchanged response again, never keep a stale one.
+# =================================================================================== #
+
+
+def make_etag(scope):
+    return '{}.{}'.format(scope, data_versions.get_version(scope))
+
+
+# Decorates a read endpoint whose data is in the scope returned by 'get_scope', called
+# with the arguments of the endpoint (None when it has no data to tag, e.g. not found).
+def conditional(get_scope):
+    def decorator(endpoint):
+        @wraps(endpoint)
+        def conditional_endpoint(*args, **kwargs):
+            scope = get_scope(*args, **kwargs)
+            if scope is None:
+                return endpoint(*args, **kwargs)
+            etag = make_etag(scope)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            response = make_response(endpoint(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return conditional_endpoint
+    return decorator
+
+
+# --------------------------------------- S C O P E S -------------------------------- #
+def companies_scope(*args, **kwargs):
+    return data_versions.COMPANIES
+
+
+def employees_scope(*args, **kwargs):
+    return data_versions.EMPLOYEES
+
+
+def company_employees_scope(id, *args, **kwargs):
+    companyID = api_cache.parse_id(id)
+    return None if companyID is None else data_versions.company_scope(companyID)
+
+
+# an employee, and its structure, are part of the employees of its company
+def employee_company_scope(id, *args, **kwargs):
+    employee = api_cache.get_employee_payload(id)
+    return None if employee is None else data_versions.company_scope(employee['companyID'])
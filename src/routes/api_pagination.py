@@ -0,0 +1,130 @@
+from flask import Response, current_app, jsonify, request, stream_with_context
+from urllib.parse import urlencode
+
+import routes.api_error_handler as aeh
+from routes.api_error_handler import error_handler
+from models.search_index import ranked_search
+from routes.api_serialization import fast_serialization_enabled, select_fields, rows_response, row_encoder
+
+# ================================ P A G I N A T I O N ============================== #
+# List endpoints answer in one of three modes, chosen by the query string:
+#     - no 'limit'/'after'/'stream': the whole list at once, ordered by ID, as always;
+#     - 'limit' and/or 'after': one page, using the ID column as cursor (keyset
+#       pagination: WHERE ID > after ORDER BY ID LIMIT limit), so fetching any page
+#       costs the same. The next page's URL goes in the 'Link' header (rel="next")
+#       and its cursor in 'X-Next-Cursor', keeping the body a plain list;
+#     - 'stream=ndjson' or 'stream=json': the whole list, written as it is read from
+#       the database in batches of STREAM_BATCH_SIZE rows, one JSON object per line
+#       or as a chunked JSON array. Memory stays flat regardless of the table size.
+# =================================================================================== #
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = 1000
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json'
+}
+
+
+def _page_parameters():
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    limit = DEFAULT_LIMIT if limit is None else min(int(limit), MAX_LIMIT)
+    after = None if after is None else int(after)
+    if limit <= 0:
+        raise ValueError('limit must be positive')
+    return limit, after
+
+
+def _next_page_link(after):
+    args = request.args.to_dict()
+    args['after'] = after
+    return '<{}?{}>; rel="next"'.format(request.base_url, urlencode(args))
+
+
+# Reads the rows after 'after' in batches, so no more than one batch is ever loaded.
+def _batches(query, key_column, after=None, batch_size=STREAM_BATCH_SIZE):
+    while True:
+        batch_query = query if after is None else query.filter(key_column > after)
+        batch = batch_query.order_by(key_column).limit(batch_size).all()
+        if len(batch) == 0:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        after = getattr(batch[-1], key_column.key)
+
+
+# Query reading the rows of 'query' to be serialized, and the functions serializing a
+# list of them as a response and one of them as a JSON string (see api_serialization.py).
+def _serializer(query, schema):
+    if fast_serialization_enabled():
+        encoder = row_encoder(schema)
+        return select_fields(query, schema), lambda rows: rows_response(rows, schema), encoder.encode
+    return query, lambda rows: jsonify(schema.dump(rows)), lambda row: current_app.json.dumps(schema.dump(row, many=False))
+
+
+def _stream(query, key_column, schema, stream_format):
+    query, _, dumps = _serializer(query, schema)
+    if stream_format == 'ndjson':
+        for batch in _batches(query, key_column):
+            yield ''.join(dumps(row) + '\n' for row in batch)
+        return
+
+    separator = '['
+    for batch in _batches(query, key_column):
+        yield separator + ','.join(dumps(row) for row in batch)
+        separator = ','
+    yield '[]\n' if separator == '[' else ']\n'
+
+
+# Builds the response of a list endpoint for 'query', in the mode requested (see above).
+# 'key_column' is the unique, indexed column used as cursor and 'schema' the 'many'
+# schema that serializes the rows. Empty lists are answered with 'empty_status'.
+def list_response(query, key_column, schema, empty_status=200):
+    stream_format = request.args.get('stream')
+    if stream_format is not None:
+        if stream_format not in STREAM_FORMATS:
+            return error_handler(400, aeh.HTTP_PARAM_TYPE, "'stream'", ' or '.join(STREAM_FORMATS))
+        return Response(stream_with_context(_stream(query, key_column, schema, stream_format)),
+                        mimetype=STREAM_FORMATS[stream_format])
+
+    query, list_json, _ = _serializer(query, schema)
+    if 'limit' not in request.args and 'after' not in request.args:
+        rows = query.order_by(key_column).all()
+        return list_json(rows), 200 if len(rows) > 0 else empty_status
+
+    try:
+        limit, after = _page_parameters()
+    except ValueError:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, ['limit', 'after'], 'positive numeric')
+
+    # one extra row tells whether there is a next page, without an empty last page
+    page = next(_batches(query, key_column, after, limit + 1), [])
+    has_next_page = len(page) > limit
+    page = page[:limit]
+    response = list_json(page)
+    response.status_code = 200 if len(page) > 0 else empty_status
+    if has_next_page:
+        next_cursor = getattr(page[-1], key_column.key)
+        response.headers['Link'] = _next_page_link(next_cursor)
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response
+
+
+# Response of a ranking: the 'limit' first rows of what 'ranked_query(limit)' returns,
+# without pages since they are not ordered by ID. Empty rankings are answered with 404.
+def ranking_response(ranked_query, schema):
+    try:
+        limit = _page_parameters()[0]
+    except ValueError:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'limit'", 'positive numeric')
+    query, list_json, _ = _serializer(ranked_query(limit), schema)
+    rows = query.all()
+    return list_json(rows), 200 if len(rows) > 0 else 404
+
+
+# Response of a name search ranked by relevance (see models/search_index.ranked_search):
+# the 'limit' best matches.
+def ranked_search_response(model, name, schema, prefix=False):
+    return ranking_response(lambda limit: ranked_search(model, name, limit, prefix), schema)
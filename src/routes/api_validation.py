@@ -0,0 +1,43 @@
+from sqlalchemy import bindparam, literal, select
+from sqlalchemy.orm import aliased
+
+from app.app_core import db
+from models.company_model import Company
+from models.employee_model import Employee
+import models.hierarchy as hierarchy
+
+# ================================ V A L I D A T I O N ================================ #
+# What the single employee writes check before changing anything, read with one query:
+# the employee being edited, the company it goes to and its new manager, whose path (see
+# models/hierarchy.py) already holds its whole chain of management. A write then costs the
+# same number of round trips to the database however deep its chain of management is.
+# =================================================================================== #
+
+
+# The rows are outer joined to a single-row select, so there is always exactly one row to
+# read. Built once: building the aliases of Employee costs more than running the query.
+_employee = aliased(Employee, name='employee')
+_manager = aliased(Employee, name='manager')
+_single_row = select(literal(1).label('single')).subquery()
+WRITE_TARGETS = select(_employee, _manager, Company.companyID).select_from(_single_row)\
+    .outerjoin(_employee, _employee.employeeID == bindparam('employeeID'))\
+    .outerjoin(_manager, _manager.employeeID == bindparam('managerID'))\
+    .outerjoin(Company, Company.companyID == bindparam('companyID'))
+
+
+# Returns (employee, company_found, manager) for the IDs given, each None when its ID is
+# None (company_found is then None too) or when there's no such row.
+def get_write_targets(employeeID=None, companyID=None, managerID=None):
+    row = db.session.execute(WRITE_TARGETS, {'employeeID': employeeID, 'companyID': companyID, 'managerID': managerID}).one()
+    company_found = None if companyID is None else row[2] is not None
+    return row[0], company_found, row[1]
+
+
+# Checks for possible management loops when creating/editing an employee, i.e.
+# whether the employee would be assigned a manager that is below (or is) itself,
+# from the manager's chain of management in its path, without querying anything.
+# This logic relies on two basic rules:
+#     - No employee can have more than one manager
+#     - No employee can be assigned a manager that doesn't exist
+def valid_company_structure(manager, employee):
+    return not hierarchy.is_above_or_same(employee, manager)
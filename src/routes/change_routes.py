@@ -0,0 +1,54 @@
+from flask import Blueprint, request, jsonify
+import json
+
+import routes.api_error_handler as aeh
+from routes.api_error_handler import error_handler
+from routes.api_pagination import DEFAULT_LIMIT, MAX_LIMIT
+
+from models.change_log import Change, change_schema, ENTITY_KEYS
+
+
+change_routes = Blueprint('change_routes', __name__)
+
+
+# =================================================================================== #
+# Change feed: the changes made to employees and companies since a token, oldest first,
+# in batches of up to 'limit' changes (see models/change_log.py). Each response carries
+# the token to ask for the next batch ('next'), and whether there are more changes right
+# now ('has_more'); consumers keep the last token and ask again from it later on.
+# Reading from token 0 returns every change recorded so far.
+# =================================================================================== #
+@change_routes.route("/changes", methods=['GET'])
+def get_changes():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        if since < 0 or limit <= 0:
+            raise ValueError
+    except ValueError:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, ['since', 'limit'], 'positive numeric')
+
+    entity = request.args.get('entity')
+    query = Change.query.filter(Change.changeID > since)
+    if entity is not None:
+        if entity not in ENTITY_KEYS:
+            return error_handler(400, aeh.HTTP_PARAM_TYPE, "'entity'", ' or '.join(ENTITY_KEYS))
+        query = query.filter(Change.entity == entity)
+
+    # one extra change tells whether there are more, as in the paginated lists
+    changes = query.order_by(Change.changeID).limit(limit + 1).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    sql_result = []
+    for change in changes:
+        result = change_schema.dump(change)
+        result['data'] = None if change.data is None else json.loads(change.data)
+        sql_result.append(result)
+    return jsonify({
+            'changes': sql_result,
+            'next': changes[-1].changeID if len(changes) > 0 else since,
+            'has_more': has_more
+        }), 200
+
+# =================================================================================== #
@@ -1,25 +1,140 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-from sqlalchemy import Column, Integer, DateTime, and_
-from flask_cors import CORS
-import json 
-import os
-import datetime
-import requests
-
-from app.app_core import db, ma, app
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from sqlalchemy import func, or_, delete, select, update
+
+from app.app_core import db
 import routes.api_error_handler as aeh
-from routes.api_error_handler import error_handler, check_missing_parameters
+from routes.api_error_handler import error_handler, error_body, bulk_error_handler, check_missing_parameters
+from routes.api_pagination import list_response, ranked_search_response, ranking_response, STREAM_BATCH_SIZE
+from routes.api_serialization import select_fields, row_encoder
+from routes.employee_bulk_routes import get_batch
+import routes.api_cache as api_cache
+from routes.api_etag import conditional, companies_scope, company_employees_scope
+from routes.api_admission import admission_cost
+
+from models.company_model import Company, company_schema, companies_schema
+from models.employee_model import Employee, EmployeeSchema, employees_schema, employees_detail_schema
+import models.search_index as search_index
+import models.data_versions as data_versions
+import models.hierarchy as hierarchy
+import models.change_log as change_log
+
+
+company_routes = Blueprint('company_routes', __name__)
+
+
+# Nests the employees (rows of the fields of employees_schema, ordered by employeeID) under
+# their managers in one pass over the managerID adjacency: returns the roots of the tree,
+# the employees whose manager isn't among the rows, and the subordinates of each employee.
+def build_tree(rows):
+    employeeIDs = {row.employeeID for row in rows}
+    roots = []
+    subordinates = {}
+    for row in rows:
+        if row.managerID in employeeIDs:
+            subordinates.setdefault(row.managerID, []).append(row)
+        else:
+            roots.append(row)
+    return roots, subordinates
+
+# The tree as nested dicts, each employee with its 'subordinates'.
+def tree_to_dicts(roots, subordinates):
+    nodes = []
+    stack = [(row, nodes) for row in reversed(roots)]
+    while len(stack) > 0:
+        row, siblings = stack.pop()
+        node = dict(row._mapping, subordinates=[])
+        siblings.append(node)
+        stack.extend((sub, node['subordinates']) for sub in reversed(subordinates.get(row.employeeID, [])))
+    return nodes
+
+# The tree as JSON text, written in chunks of about STREAM_BATCH_SIZE employees without
+# building it in memory first. Iterative, so chains of any depth can be written.
+def stream_tree(roots, subordinates, encode):
+    parts = ['[']
+    stack = [iter(roots)]
+    first = True
+    while len(stack) > 0:
+        row = next(stack[-1], None)
+        if row is None:
+            stack.pop()
+            parts.append(']}' if len(stack) > 0 else ']\n')
+            first = False
+            continue
+        if not first:
+            parts.append(', ')
+        # 'subordinates' goes after the fields, which also sort before it
+        parts.append(encode(row)[:-1] + ', "subordinates": [')
+        first = True
+        stack.append(iter(subordinates.get(row.employeeID, [])))
+        if len(parts) >= STREAM_BATCH_SIZE:
+            yield ''.join(parts)
+            parts = []
+    yield ''.join(parts)
+
+
+# Runs the UPDATE or DELETE 'statement' on the employees matching 'where' and returns
+# their payloads after it (before it, for a DELETE), read by the statement itself with
+# RETURNING when the backend supports it, or with one extra query otherwise.
+def write_employees(statement, where):
+    table = Employee.__table__
+    columns = [table.c[field] for field in EmployeeSchema.Meta.fields]
+    statement = statement.where(where)
+    dialect = db.session.get_bind().dialect
+    if dialect.delete_returning if statement.is_delete else dialect.update_returning:
+        rows = db.session.execute(statement.returning(*columns)).all()
+    elif statement.is_delete:
+        rows = db.session.execute(select(*columns).where(where)).all()
+        db.session.execute(statement)
+    else:
+        employeeIDs = [e for e, in db.session.execute(select(table.c.employeeID).where(where))]
+        db.session.execute(statement)
+        rows = db.session.execute(select(*columns).where(table.c.employeeID.in_(employeeIDs))).all()
+    return sorted((dict(row._mapping) for row in rows), key=lambda payload: payload['employeeID'])
+
+# Deletes the companies with a few set-based statements each, no matter how many employees
+# they have: their employees are either deleted too, or detached (left without company
+# and manager, as the change_manager_after_update_companyID trigger would). Returns the
+# payloads of the employees changed in each company, to be reported as indirect changes.
+def remove_companies(companies, delete_employees):
+    table = Employee.__table__
+    if delete_employees:
+        statement, operation = delete(table), change_log.DELETE
+    else:
+        detached = dict(hierarchy.detached_index(), companyID=None, managerID=None)
+        statement, operation = update(table).values(detached), change_log.UPDATE
+
+    changed_employees = {}
+    for company in companies:
+        changed_employees[company['companyID']] = write_employees(statement, table.c.companyID == company['companyID'])
+        change_log.record_changes(change_log.EMPLOYEE, operation, changed_employees[company['companyID']])
+    db.session.execute(delete(Company.__table__).where(Company.__table__.c.companyID.in_(changed_employees)))
+    change_log.record_changes(change_log.COMPANY, change_log.DELETE, companies)
+    data_versions.bump(data_versions.COMPANIES)
+    data_versions.bump_employees(list(changed_employees) + ([] if delete_employees else [None]))
+    return changed_employees
+
+# Indirect changes of deleting companies, as reported by the endpoints below.
+def company_indirect_changes(changed_employees, delete_employees):
+    return {
+        'api_warning':'These employees were also changed to keep database consistency.',
+        'changes': 'Employees deleted.' if delete_employees else "Attributes 'companyID' and 'managerID' set to NULL.",
+        'employees':changed_employees
+    }
+
+# What deleting a company does to its employees, from the 'employees' parameter.
+COMPANY_EMPLOYEES_POLICIES = ('detach', 'delete')
 
-from models.company_model import Company, CompanySchema, company_schema, companies_schema
-from models.employee_model import Employee, EmployeeSchema, employee_schema, employees_schema, update_manager_trigger
+def delete_employees_policy():
+    policy = request.args.get('employees', 'detach')
+    if policy not in COMPANY_EMPLOYEES_POLICIES:
+        return None
+    return policy == 'delete'
 
 
 # =================================================================================== #
 # ================================== C O M P A N Y ================================== #
 # =================================================================================== #
-@app.route("/companies", methods=['POST'])
+@company_routes.route("/companies", methods=['POST'])
 def add_company():
     required = ['name']
     missing = check_missing_parameters(request, required)
@@ -32,6 +147,8 @@ def add_company():
         db.session.add(new_company)
         db.session.flush()
         sql_result = company_schema.dump(new_company)
+        change_log.record_changes(change_log.COMPANY, change_log.INSERT, [sql_result])
+        data_versions.bump(data_versions.COMPANIES)
         db.session.commit()
         return jsonify(sql_result), 200
 
@@ -39,45 +156,203 @@ def add_company():
         return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
 
 
-@app.route("/companies", methods=['GET'])
-def get_companies():
-    all_companies = Company.query.all()
-    sql_result = companies_schema.dump(all_companies)
-    if len(sql_result) == 0:
-        return jsonify(sql_result), 404
+@company_routes.route("/companies/<id>", methods=['DELETE'])
+def delete_company(id):
+    company = api_cache.get_company_payload(id)
+    if company is None:
+        return error_handler(404, aeh.SQL_NOT_FOUND, id, message=aeh.NO_COMPANY_TO_DELETE)
+    delete_employees = delete_employees_policy()
+    if delete_employees is None:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'employees'", ' or '.join(COMPANY_EMPLOYEES_POLICIES))
+
+    try:
+        changed_employees = remove_companies([company], delete_employees)[company['companyID']]
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
+    api_cache.invalidate_company_employees(company['companyID'], changed_employees)
+
+    if len(changed_employees) > 0:
+        return jsonify({
+                'company':company,
+                'indirect_changes':company_indirect_changes(changed_employees, delete_employees)
+                }), 200
+
+    return jsonify(company), 200
+
+
+@company_routes.route("/companies/bulk", methods=['DELETE'])
+def delete_companies_bulk():
+    batch, error = get_batch(request, 'companyIDs')
+    if error is not None:
+        return error
+    delete_employees = delete_employees_policy()
+    if delete_employees is None:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'employees'", ' or '.join(COMPANY_EMPLOYEES_POLICIES))
+
+    errors = {}
+    companyIDs = {}
+    batchIDs = set()
+    for index, companyID in enumerate(batch):
+        try:
+            companyID = int(companyID)
+        except:
+            errors[index] = error_body(400, aeh.HTTP_PARAM_TYPE, "'companyIDs'", 'numeric')
+            continue
+        if companyID in batchIDs:
+            errors[index] = error_body(400, aeh.SQL_CONSTRAINT_FAILED, companyID, message=aeh.COMPANY_REPEATED_IN_BATCH)
+            continue
+        batchIDs.add(companyID)
+        companyIDs[index] = companyID
+
+    companies = {}
+    if len(companyIDs) > 0:
+        companies = {c.companyID: c for c in Company.query.filter(Company.companyID.in_(batchIDs))}
+    for index, companyID in companyIDs.items():
+        if companyID not in companies:
+            errors[index] = error_body(404, aeh.SQL_NOT_FOUND, companyID, message=aeh.NO_COMPANY_TO_DELETE)
+    if len(errors) > 0:
+        return bulk_error_handler(400, errors)
+
+    sql_result = companies_schema.dump([companies[companyIDs[index]] for index in range(len(batch))])
+    try:
+        changed_by_company = remove_companies(sql_result, delete_employees)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
+    for companyID, payloads in changed_by_company.items():
+        api_cache.invalidate_company_employees(companyID, payloads)
+    changed_employees = [e for c in sql_result for e in changed_by_company[c['companyID']]]
+
+    if len(changed_employees) > 0:
+        return jsonify({
+                'companies':sql_result,
+                'indirect_changes':company_indirect_changes(changed_employees, delete_employees)
+                }), 200
+
     return jsonify(sql_result), 200
 
 
-@app.route("/companies/<id>", methods=['GET'])
+@company_routes.route("/companies", methods=['GET'])
+@conditional(companies_scope)
+def get_companies():
+    return list_response(Company.query, Company.companyID, companies_schema, empty_status=404)
+
+
+@company_routes.route("/companies/<id>", methods=['GET'])
+@conditional(companies_scope)
 def get_company_detail(id):
-    company = Company.query.get(id)
-    if company is None:
+    sql_result = api_cache.get_company_payload(id)
+    if sql_result is None:
         return error_handler(404, aeh.SQL_NOT_FOUND, 'company')
-    sql_result = company_schema.dump(company)
     return jsonify(sql_result), 200
 
 
-@app.route("/companies/search", methods=['GET'])
+@company_routes.route("/companies/search", methods=['GET'])
+@conditional(companies_scope)
 def get_company_by_name():
     name = request.args.get('name')
     if name is None:
         return get_companies()
-    filtered_companies = Company.query.filter(Company.name.like("%"+name+"%"))
-    sql_result = companies_schema.dump(filtered_companies)
-    if len(sql_result) == 0:
-        return jsonify(sql_result), 404        
-    return jsonify(sql_result), 200
+    prefix = request.args.get('match') == 'prefix'
+    if request.args.get('ranked') == 'true':
+        return ranked_search_response(Company, name, companies_schema, prefix)
+    filtered_companies = Company.query.filter(search_index.name_filter(Company, name, prefix))
+    return list_response(filtered_companies, Company.companyID, companies_schema, empty_status=404)
 
 
-@app.route("/companies/<id>/employees", methods=['GET'])
+@company_routes.route("/companies/<id>/employees", methods=['GET'])
+@conditional(company_employees_scope)
 def get_company_employees(id):
-    company = Company.query.get(id)
+    company = api_cache.get_company_payload(id)
     if company is None:
         return error_handler(404, aeh.SQL_NOT_FOUND, 'company')
     company_employees = Employee.query.filter(Employee.companyID==id)
-    sql_result = employees_schema.dump(company_employees)
-    if len(sql_result) == 0:
-        return jsonify(sql_result), 404
-    return jsonify(sql_result), 200
+    return list_response(company_employees, Employee.employeeID, employees_schema, empty_status=404)
+
+
+# Employees read by the tree (see routes/api_admission.py): the root and its headcount, or
+# the top managers of the company and their headcounts, read on the index of the companyID.
+def estimate_tree_rows(id):
+    companyID = api_cache.parse_id(id)
+    if 'root' in request.args:
+        root = api_cache.get_employee_payload(request.args['root'])
+        return 0 if root is None else root['headcount'] + 1
+    if companyID is None:
+        return 0
+    top_managers = db.session.query(func.sum(Employee.headcount + 1)).filter(Employee.companyID == companyID, Employee.managerID.is_(None))
+    return top_managers.scalar() or 0
+
+
+# The company structure as a nested tree, read with a single query: the whole company,
+# or the structure under 'root' (as in "/employees/<id>/structure/all"), up to 'max_depth'
+# levels under the top managers (or under 'root'). With 'stream=json', the tree is written
+# as it is serialized, for very large companies.
+@company_routes.route("/companies/<id>/tree", methods=['GET'])
+@admission_cost(estimate_tree_rows)
+@conditional(company_employees_scope)
+def get_company_tree(id):
+    company = api_cache.get_company_payload(id)
+    if company is None:
+        return error_handler(404, aeh.SQL_NOT_FOUND, 'company')
+    try:
+        max_depth = None if 'max_depth' not in request.args else int(request.args['max_depth'])
+        rootID = None if 'root' not in request.args else int(request.args['root'])
+        if max_depth is not None and max_depth < 0:
+            raise ValueError
+    except ValueError:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, ['max_depth', 'root'], 'positive numeric')
+    stream_format = request.args.get('stream')
+    if stream_format not in (None, 'json'):
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'stream'", 'json')
+
+    tree = Employee.query.filter(Employee.companyID==company['companyID'])
+    top_depth = 0
+    if rootID is not None:
+        root = Employee.query.get(rootID)
+        if root is None or root.companyID != company['companyID']:
+            return error_handler(404, aeh.SQL_NOT_FOUND, 'employee')
+        tree = tree.filter(or_(Employee.employeeID==rootID, hierarchy.descendants_filter(root.path)))
+        top_depth = root.depth
+    if max_depth is not None:
+        tree = tree.filter(Employee.depth <= top_depth + max_depth)
+    rows = select_fields(tree, employees_schema).order_by(Employee.employeeID).all()
+    if len(rows) == 0:
+        return jsonify([]), 404
+
+    roots, subordinates = build_tree(rows)
+    if stream_format is not None:
+        return Response(stream_with_context(stream_tree(roots, subordinates, row_encoder(employees_schema).encode)),
+                        mimetype='application/json')
+    return jsonify(tree_to_dicts(roots, subordinates)), 200
+
+
+# Managers of the company ranked by one of their aggregates, kept up to date by every
+# write (see models/hierarchy.py), so the ranking is a single indexed query.
+MANAGER_RANKINGS = {
+    'headcount': Employee.headcount,
+    'directReports': Employee.directReports,
+    'depth': Employee.depth
+}
+
+@company_routes.route("/companies/<id>/managers", methods=['GET'])
+@conditional(company_employees_scope)
+def get_company_managers(id):
+    company = api_cache.get_company_payload(id)
+    if company is None:
+        return error_handler(404, aeh.SQL_NOT_FOUND, 'company')
+    sort = request.args.get('sort', 'headcount')
+    order = request.args.get('order', 'desc')
+    if sort not in MANAGER_RANKINGS:
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'sort'", ' or '.join(MANAGER_RANKINGS))
+    if order not in ('asc', 'desc'):
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'order'", 'asc or desc')
+
+    column = MANAGER_RANKINGS[sort]
+    managers = Employee.query.filter(Employee.companyID==company['companyID'], Employee.directReports > 0)\
+        .order_by(column.desc() if order == 'desc' else column.asc(), Employee.employeeID)
+    return ranking_response(lambda limit: managers.limit(limit), employees_detail_schema)
 
 # =================================================================================== #
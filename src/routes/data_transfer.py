@@ -0,0 +1,388 @@
+from itertools import islice
+from sqlalchemy import delete, func, insert, or_, select, update, bindparam
+import csv
+import io
+import json
+import uuid
+
+from app.app_core import db
+from app.cache import get_cache
+import routes.api_error_handler as aeh
+from routes.api_error_handler import error_body
+from routes.api_serialization import row_encoder
+from routes.employee_bulk_routes import optional_id, get_existing_companies, get_taken_emails, find_structure_loops
+
+from models.company_model import Company, company_schema
+from models.employee_model import Employee, employee_schema
+from models.import_staging import PendingManager
+import models.hierarchy as hierarchy
+import models.data_versions as data_versions
+import models.change_log as change_log
+
+# ============================== D A T A   T R A N S F E R ========================== #
+# Import and export of whole Companies and Employees tables, as streams: rows are read
+# and written TRANSFER_BATCH_SIZE at a time, so memory stays flat whatever the size of
+# the file. Formats:
+#     ndjson    one JSON object per line, as the API serves them
+#     csv       a header with the field names, then one row per line (empty is null)
+#     columnar  a JSON header {"entity", "columns"} on the first line, then one line per
+#               group of up to TRANSFER_BATCH_SIZE rows, holding a list of values for
+#               each column: field names are written once, and each column is compact
+#
+# Imports only add rows: IDs are kept when given, assigned otherwise. Each batch of
+# rows is validated with a few set-based queries and written in its own transaction;
+# invalid rows are skipped and reported. The managers of the employees are validated
+# and assigned once the whole file is read (see models/import_staging.py), so employees
+# may come before their managers. Employees whose manager can't be assigned (unknown,
+# from another company, or in a loop) are imported without one, and reported too.
+# =================================================================================== #
+TRANSFER_BATCH_SIZE = 10000
+MAX_REPORTED_ERRORS = 100
+
+COMPANIES = 'companies'
+EMPLOYEES = 'employees'
+ENTITIES = {
+    COMPANIES: (Company, company_schema),
+    EMPLOYEES: (Employee, employee_schema)
+}
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+COLUMNAR = 'columnar'
+FORMATS = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv',
+    COLUMNAR: 'application/x-ndjson'
+}
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.error_count = 0
+        self.errors = []
+        self.aborted = None
+
+    # Reports an error of the row; 'rejected' when the row wasn't imported at all.
+    def error(self, row, error, rejected=True):
+        self.error_count += 1
+        if rejected:
+            self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(dict(row=row, **error))
+
+    def dump(self):
+        report = {
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'error_count': self.error_count,
+            'errors': sorted(self.errors, key=lambda e: e['row'])
+        }
+        if self.aborted is not None:
+            report['aborted'] = self.aborted
+        return report
+
+
+# ---------------------------------- E X P O R T ---------------------------------- #
+# Rows of the entity, as tuples of the fields of its schema, in batches ordered by ID.
+def export_batches(entity):
+    model, schema = ENTITIES[entity]
+    columns = [model.__table__.c[field] for field in schema.Meta.fields]
+    after = None
+    while True:
+        query = select(*columns).order_by(columns[0]).limit(TRANSFER_BATCH_SIZE)
+        if after is not None:
+            query = query.where(columns[0] > after)
+        rows = db.session.execute(query).all()
+        if len(rows) > 0:
+            yield rows
+        if len(rows) < TRANSFER_BATCH_SIZE:
+            return
+        after = rows[-1][0]
+
+
+# The whole entity in the format, as chunks of text.
+def export_stream(entity, export_format):
+    schema = ENTITIES[entity][1]
+    fields = list(schema.Meta.fields)
+    if export_format == NDJSON:
+        encoder = row_encoder(schema)
+        for rows in export_batches(entity):
+            yield ''.join(encoder.encode(row) + '\n' for row in rows)
+    elif export_format == CSV:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(fields)
+        for rows in export_batches(entity):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        yield json.dumps({'entity': entity, 'columns': fields}) + '\n'
+        for rows in export_batches(entity):
+            yield json.dumps([list(column) for column in zip(*rows)], separators=(',', ':')) + '\n'
+
+
+# ---------------------------------- I M P O R T ---------------------------------- #
+# The records (dicts) of a text stream in the format. A line that can't be parsed is
+# yielded as an ImportFormatError instead, so only its rows are rejected.
+def read_records(lines, import_format):
+    if import_format == CSV:
+        reader = csv.reader(lines)
+        fields = next(reader, [])
+        for values in reader:
+            yield {field: (None if value == '' else value) for field, value in zip(fields, values)}
+        return
+
+    lines = (line for line in lines if line.strip() != '')
+    if import_format == NDJSON:
+        for line in lines:
+            yield parse_line(line)
+        return
+    header = parse_line(next(lines, '{}'))
+    if isinstance(header, ImportFormatError) or type(header) != dict or type(header.get('columns')) != list:
+        raise ImportFormatError('the first line must be the header of the columns')
+    fields = header['columns']
+    for line in lines:
+        columns = parse_line(line)
+        if isinstance(columns, ImportFormatError) or type(columns) != list or any(type(c) != list for c in columns):
+            yield columns if isinstance(columns, ImportFormatError) else ImportFormatError('a row group must be a list of columns')
+            continue
+        for values in zip(*columns):
+            yield dict(zip(fields, values))
+
+
+def parse_line(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return ImportFormatError(str(e))
+
+
+def company_values(record):
+    if isinstance(record, ImportFormatError):
+        return None, error_body(400, aeh.HTTP_PARAM_TYPE, record, message=aeh.INVALID_IMPORT_RECORD)
+    if type(record) != dict or record.get('name') is None:
+        return None, error_body(400, aeh.HTTP_MISSING_PARAMS, ['name'])
+    try:
+        return {'companyID': optional_id(record, 'companyID'), 'name': record['name']}, None
+    except (TypeError, ValueError):
+        return None, error_body(400, aeh.HTTP_PARAM_TYPE, ['companyID'], 'numeric')
+
+
+def employee_values(record):
+    if isinstance(record, ImportFormatError):
+        return None, error_body(400, aeh.HTTP_PARAM_TYPE, record, message=aeh.INVALID_IMPORT_RECORD)
+    missing = [p for p in ['name', 'email'] if type(record) != dict or record.get(p) is None]
+    if len(missing) > 0:
+        return None, error_body(400, aeh.HTTP_MISSING_PARAMS, missing)
+    try:
+        values = {key: optional_id(record, key) for key in ('employeeID', 'companyID', 'managerID')}
+    except (TypeError, ValueError):
+        return None, error_body(400, aeh.HTTP_PARAM_TYPE, ['employeeID', 'companyID', 'managerID'], 'numeric')
+    values['name'] = record['name']
+    values['email'] = record['email']
+    return values, None
+
+
+def existing_ids(model, key, ids):
+    ids = [i for i in ids if i is not None]
+    if len(ids) == 0:
+        return set()
+    column = getattr(model, key)
+    return {i for i, in db.session.query(column).filter(column.in_(ids))}
+
+
+# Moves the sequence giving out the IDs of the table past its largest ID, once rows were
+# inserted with their own IDs: PostgreSQL doesn't advance it then, and the next row added
+# without an ID would collide with an imported one. SQLite and MySQL give out IDs after
+# the largest one already in the table, so they need nothing.
+def sync_id_sequence(table, key):
+    if db.engine.dialect.name != 'postgresql':
+        return
+    sequence = func.pg_get_serial_sequence(db.engine.dialect.identifier_preparer.format_table(table), table.c[key].name)
+    db.session.execute(select(func.setval(sequence, select(func.max(table.c[key])).scalar_subquery())))
+
+
+# Inserts the rows, with their IDs when they have one, and returns them as the API
+# serves them, IDs included. 'rows' are (row, values) pairs.
+def insert_rows(model, schema, key, rows):
+    table = model.__table__
+    returning = [table.c[field] for field in schema.Meta.fields]
+    inserted = []
+    for with_id in (True, False):
+        batch = [(row, values) for row, values in rows if (values[key] is not None) == with_id]
+        if len(batch) == 0:
+            continue
+        parameters = [{f: v for f, v in values.items() if with_id or f != key} for _, values in batch]
+        result = db.session.execute(insert(table).returning(*returning, sort_by_parameter_order=True), parameters)
+        inserted += [(row, dict(r._mapping)) for (row, _), r in zip(batch, result)]
+        if with_id:
+            sync_id_sequence(table, key)
+    return inserted
+
+
+def import_companies(rows, report, importID):
+    names = {values['name'] for _, values in rows}
+    taken_names = {n for n, in db.session.query(Company.name).filter(Company.name.in_(names))} if len(names) > 0 else set()
+    taken_ids = existing_ids(Company, 'companyID', {values['companyID'] for _, values in rows})
+    batch_names = set()
+    batch_ids = set()
+    valid = []
+    for row, values in rows:
+        if values['name'] in taken_names or values['name'] in batch_names:
+            report.error(row, error_body(400, aeh.SQL_CONSTRAINT_FAILED, values['name'], message=aeh.COMPANY_NAME_IN_USE))
+        elif values['companyID'] in taken_ids or values['companyID'] in batch_ids:
+            report.error(row, error_body(400, aeh.SQL_CONSTRAINT_FAILED, values['companyID'], message=aeh.COMPANY_ALREADY_EXISTS))
+        else:
+            valid.append((row, values))
+        batch_names.add(values['name'])
+        if values['companyID'] is not None:
+            batch_ids.add(values['companyID'])
+
+    inserted = insert_rows(Company, company_schema, 'companyID', valid)
+    change_log.record_changes(change_log.COMPANY, change_log.INSERT, [payload for _, payload in inserted])
+    data_versions.bump(data_versions.COMPANIES)
+    return len(inserted)
+
+
+def import_employees(rows, report, importID):
+    companies = get_existing_companies({values['companyID'] for _, values in rows})
+    taken_emails = get_taken_emails({values['email'] for _, values in rows})
+    taken_ids = existing_ids(Employee, 'employeeID', {values['employeeID'] for _, values in rows})
+    batch_emails = set()
+    batch_ids = set()
+    valid = []
+    for row, values in rows:
+        if values['companyID'] is not None and values['companyID'] not in companies:
+            report.error(row, error_body(400, aeh.SQL_NOT_FOUND, values['companyID'], message=aeh.NO_COMPANY_TO_ASSOCIATE))
+        elif values['email'] in taken_emails or values['email'] in batch_emails:
+            report.error(row, error_body(400, aeh.SQL_CONSTRAINT_FAILED, values['email'], message=aeh.EMAIL_ALREADY_IN_USE))
+        elif values['employeeID'] in taken_ids or values['employeeID'] in batch_ids:
+            report.error(row, error_body(400, aeh.SQL_CONSTRAINT_FAILED, values['employeeID'], message=aeh.EMPLOYEE_ALREADY_EXISTS))
+        else:
+            valid.append((row, values))
+        batch_emails.add(values['email'])
+        if values['employeeID'] is not None:
+            batch_ids.add(values['employeeID'])
+
+    # managers are assigned at the end of the import, see assign_pending_managers
+    managers = {row: values.pop('managerID') for row, values in valid}
+    inserted = insert_rows(Employee, employee_schema, 'employeeID', valid)
+    table = Employee.__table__
+    db.session.execute(update(table).where(table.c.path.is_(None)).values(**hierarchy.detached_index()))
+    pending = [{'importID': importID, 'employeeID': payload['employeeID'], 'managerID': managers[row], 'row': row}
+               for row, payload in inserted if managers[row] is not None]
+    if len(pending) > 0:
+        db.session.execute(insert(PendingManager.__table__), pending)
+    change_log.record_changes(change_log.EMPLOYEE, change_log.INSERT, [payload for _, payload in inserted])
+    data_versions.bump_employees({payload['companyID'] for _, payload in inserted})
+    return len(inserted)
+
+
+# Validates and assigns the managers of the employees imported, reporting the ones that
+# can't be: unknown managers and managers from another company first, then the employees
+# that would end up in a structure loop. Rebuilds the hierarchy index of their companies.
+def assign_pending_managers(importID, report):
+    table = Employee.__table__
+    pending = PendingManager.__table__
+    employee = table.alias('employee')
+    manager = table.alias('manager')
+    invalid = select(pending.c.row, pending.c.employeeID, pending.c.managerID, manager.c.employeeID, manager.c.companyID, employee.c.companyID)\
+        .join(employee, employee.c.employeeID == pending.c.employeeID)\
+        .outerjoin(manager, manager.c.employeeID == pending.c.managerID)\
+        .where(pending.c.importID == importID, or_(manager.c.employeeID.is_(None), manager.c.companyID.is_distinct_from(employee.c.companyID)))
+    unassigned = []
+    for row, employeeID, managerID, found, manager_company, employee_company in db.session.execute(invalid):
+        if found is None:
+            report.error(row, error_body(400, aeh.SQL_NOT_FOUND, managerID, message=aeh.NO_EMPLOYEE_TO_ASSIGN), rejected=False)
+        else:
+            report.error(row, error_body(400, aeh.API_NOT_SAME_COMPANY, manager_company, employee_company), rejected=False)
+        unassigned.append(employeeID)
+    forget_pending_managers(importID, unassigned)
+
+    imported = select(pending.c.employeeID).where(pending.c.importID == importID)
+    db.session.execute(update(table).where(table.c.employeeID.in_(imported)).values(managerID=select(pending.c.managerID)
+        .where(pending.c.importID == importID, pending.c.employeeID == table.c.employeeID).scalar_subquery()))
+    companyIDs = {c for c, in db.session.execute(select(table.c.companyID).distinct().where(table.c.employeeID.in_(imported)))}
+    hierarchy.rebuild_paths(companyIDs)
+
+    # employees that no top manager reaches after the index is rebuilt are in, or under, a loop
+    unreachable = dict(db.session.execute(select(table.c.employeeID, table.c.managerID)
+        .where(table.c.employeeID.in_(imported), table.c.depth == 0, table.c.managerID.isnot(None))).all())
+    loops = find_structure_loops(unreachable, unreachable)
+    if len(loops) > 0:
+        rows = db.session.execute(select(pending.c.row).where(pending.c.importID == importID, pending.c.employeeID.in_(loops)))
+        for row, in rows:
+            report.error(row, error_body(400, aeh.API_STRUCTURE_LOOP), rejected=False)
+        db.session.execute(update(table).where(table.c.employeeID == bindparam('b_employeeID')).values(managerID=None),
+                           [{'b_employeeID': e} for e in loops])
+        forget_pending_managers(importID, loops)
+        hierarchy.rebuild_paths(companyIDs)
+
+    # the employees just got their managers, after their insert was recorded
+    after = None
+    while True:
+        query = select(pending.c.employeeID).where(pending.c.importID == importID).order_by(pending.c.employeeID).limit(TRANSFER_BATCH_SIZE)
+        if after is not None:
+            query = query.where(pending.c.employeeID > after)
+        employeeIDs = [e for e, in db.session.execute(query)]
+        if len(employeeIDs) == 0:
+            break
+        change_log.record_employee_updates(employeeIDs)
+        after = employeeIDs[-1]
+    db.session.execute(delete(pending).where(pending.c.importID == importID))
+    data_versions.bump_employees(companyIDs)
+
+
+def forget_pending_managers(importID, employeeIDs):
+    pending = PendingManager.__table__
+    if len(employeeIDs) > 0:
+        db.session.execute(delete(pending).where(pending.c.importID == importID, pending.c.employeeID == bindparam('b_employeeID')),
+                           [{'b_employeeID': e} for e in employeeIDs])
+
+
+# Imports the records of a text stream ('lines') in the format into the entity, batch
+# by batch, and returns the report of the import. A batch that fails to be written
+# stops the import, the batches before it staying imported.
+def import_stream(entity, lines, import_format):
+    parse = company_values if entity == COMPANIES else employee_values
+    import_batch = import_companies if entity == COMPANIES else import_employees
+    importID = uuid.uuid4().hex
+    report = ImportReport()
+    records = enumerate(read_records(lines, import_format), start=1)
+    while report.aborted is None:
+        try:
+            batch = list(islice(records, TRANSFER_BATCH_SIZE))
+        except (ImportFormatError, csv.Error, UnicodeDecodeError) as e:
+            report.aborted = error_body(400, aeh.HTTP_PARAM_TYPE, import_format, e, message=aeh.INVALID_IMPORT_FILE)
+            break
+        if len(batch) == 0:
+            break
+        rows = []
+        for row, record in batch:
+            values, error = parse(record)
+            if error is not None:
+                report.error(row, error)
+            else:
+                rows.append((row, values))
+        try:
+            report.imported += import_batch(rows, report, importID)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            report.aborted = error_body(400, aeh.SQL_CONSTRAINT_FAILED, e, message=aeh.IMPORT_BATCH_FAILED)
+
+    if entity == EMPLOYEES:
+        assign_pending_managers(importID, report)
+        db.session.commit()
+    # cached payloads, structures and lookups of missing rows may all be outdated
+    get_cache().clear()
+    return report
@@ -0,0 +1,412 @@
+from flask import Blueprint, request, jsonify
+from sqlalchemy import bindparam, update
+
+from app.app_core import db
+import routes.api_error_handler as aeh
+import routes.api_cache as api_cache
+from routes.api_error_handler import error_handler, error_body, bulk_error_body, bulk_error_handler, check_missing_parameters
+
+from models.company_model import Company
+from models.employee_model import Employee, employee_schema, employees_schema
+import models.hierarchy as hierarchy
+import models.data_versions as data_versions
+import models.change_log as change_log
+
+
+employee_bulk_routes = Blueprint('employee_bulk_routes', __name__)
+
+
+# =================================================================================== #
+# Batch versions of the employee endpoints. Each batch is validated as a whole with a
+# few set-based queries (one per kind of lookup, no matter the size of the batch) and
+# written in a single transaction: either every record is written, or none is and the
+# response lists the errors of each failed record (see bulk_error_handler).
+# =================================================================================== #
+MAX_BATCH_SIZE = 10000
+
+
+def get_batch(request, key):
+    missing = check_missing_parameters(request, [key])
+    if len(missing) > 0:
+        return None, error_handler(400, aeh.HTTP_MISSING_PARAMS, missing)
+    batch = request.json[key]
+    if type(batch) != list or len(batch) > MAX_BATCH_SIZE:
+        return None, error_handler(400, aeh.HTTP_PARAM_TYPE, "'{}'".format(key), 'a list of up to {} elements as'.format(MAX_BATCH_SIZE))
+    return batch, None
+
+
+def optional_id(record, key):
+    return None if key not in record or record[key] is None else int(record[key])
+
+
+# The employees found, by ID (see employee_routes.get_employees_by_id for an ordered list).
+def get_employee_map(employeeIDs):
+    if len(employeeIDs) == 0:
+        return {}
+    employees = Employee.query.filter(Employee.employeeID.in_(employeeIDs)).all()
+    return {e.employeeID: e for e in employees}
+
+
+def get_existing_companies(companyIDs):
+    companyIDs = [c for c in companyIDs if c is not None]
+    if len(companyIDs) == 0:
+        return set()
+    return {c for c, in db.session.query(Company.companyID).filter(Company.companyID.in_(companyIDs))}
+
+
+# Emails of the batch that are already used by employees outside of it.
+def get_taken_emails(emails, batchIDs=()):
+    if len(emails) == 0:
+        return set()
+    query = db.session.query(Employee.email).filter(Employee.email.in_(emails))
+    if len(batchIDs) > 0:
+        query = query.filter(Employee.employeeID.notin_(batchIDs))
+    return {e for e, in query}
+
+
+# Walks up the final chains of management of the batch (managers maps each employee
+# to its manager after the batch is written) and returns the employees that would end
+# up in a structure loop. Each employee is visited once overall.
+def find_structure_loops(managers, employeeIDs):
+    acyclic = set()
+    in_loop = set()
+    for employeeID in employeeIDs:
+        chain = []
+        current = employeeID
+        while current is not None and current not in acyclic and current not in in_loop:
+            if current in chain:
+                in_loop.update(chain[chain.index(current):])
+                break
+            chain.append(current)
+            current = managers.get(current)
+        acyclic.update(c for c in chain if c not in in_loop)
+    return in_loop
+
+
+# Runs a function of models/hierarchy.py on an employee of the batch ('employees', by ID),
+# returning the IDs it reindexed. The functions write the index of other employees with
+# set-based UPDATEs, so the ones of the batch it changed (under the employee, or along the
+# chains above its old and new places) are read again when next used.
+INDEX_ATTRIBUTES = ['path', 'depth', 'headcount', 'directReports']
+
+
+def reindex(function, employee, employees, *args):
+    changed = set(hierarchy.path_to_ids(employee.path))
+    reindexed = function(employee, *args)
+    db.session.flush()
+    changed.update(hierarchy.path_to_ids(employee.path), reindexed)
+    for employeeID in changed & employees.keys():
+        db.session.expire(employees[employeeID], INDEX_ATTRIBUTES)
+    return reindexed
+
+
+@employee_bulk_routes.route("/employees/bulk", methods=['POST'])
+def add_employees_bulk():
+    batch, error = get_batch(request, 'employees')
+    if error is not None:
+        return error
+
+    errors = {}
+    records = {}
+    for index, record in enumerate(batch):
+        missing = [p for p in ['name', 'email'] if type(record) != dict or p not in record]
+        if len(missing) > 0:
+            errors[index] = error_body(400, aeh.HTTP_MISSING_PARAMS, missing)
+            continue
+        try:
+            records[index] = (record['name'], record['email'], optional_id(record, 'companyID'), optional_id(record, 'managerID'))
+        except:
+            errors[index] = error_body(400, aeh.HTTP_PARAM_TYPE, ['companyID', 'managerID'], 'numeric')
+
+    companies = get_existing_companies({r[2] for r in records.values()})
+    managers = get_employee_map({r[3] for r in records.values() if r[3] is not None})
+    taken_emails = get_taken_emails({r[1] for r in records.values()})
+    batch_emails = set()
+    for index, (name, email, companyID, managerID) in records.items():
+        if companyID is not None and companyID not in companies:
+            errors[index] = error_body(400, aeh.SQL_NOT_FOUND, companyID, message=aeh.NO_COMPANY_TO_ASSOCIATE)
+        elif managerID is not None and managerID not in managers:
+            errors[index] = error_body(400, aeh.SQL_NOT_FOUND, managerID, message=aeh.NO_EMPLOYEE_TO_ASSIGN)
+        elif managerID is not None and managers[managerID].companyID != companyID:
+            errors[index] = error_body(400, aeh.API_NOT_SAME_COMPANY, managers[managerID].companyID, companyID)
+        elif email in taken_emails or email in batch_emails:
+            errors[index] = error_body(400, aeh.SQL_CONSTRAINT_FAILED, email, message=aeh.EMAIL_ALREADY_IN_USE)
+        batch_emails.add(email)
+        # There's no need to verify for loops since the employees are being created now, therefore have no subordinates.
+
+    if len(errors) > 0:
+        return bulk_error_handler(400, errors)
+
+    new_employees = [Employee(*records[index]) for index in range(len(batch))]
+    try:
+        db.session.add_all(new_employees)
+        db.session.flush()
+        hierarchy.index_new_employees([(e, managers.get(e.managerID)) for e in new_employees])
+        sql_result = employees_schema.dump(new_employees)
+        change_log.record_changes(change_log.EMPLOYEE, change_log.INSERT, sql_result)
+        new_states = [api_cache.employee_state(e) for e in new_employees]
+        data_versions.bump_employees({e.companyID for e in new_employees})
+        db.session.commit()
+        api_cache.invalidate_employees(new_states)
+        return jsonify(sql_result), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
+
+
+@employee_bulk_routes.route("/employees/bulk", methods=['PUT'])
+def employee_update_bulk():
+    batch, error = get_batch(request, 'employees')
+    if error is not None:
+        return error
+
+    body, status = update_employees(batch)
+    return jsonify(body), status
+
+
+# Validates and writes a batch of employee edits (see employee_update_bulk), returning
+# the body and the status code of the response. Also runs the reorganization jobs.
+def update_employees(batch):
+    errors = {}
+    records = {}
+    batchIDs = set()
+    for index, record in enumerate(batch):
+        if type(record) != dict or 'employeeID' not in record:
+            errors[index] = error_body(400, aeh.HTTP_MISSING_PARAMS, ['employeeID'])
+            continue
+        try:
+            employeeID = int(record['employeeID'])
+            companyID = optional_id(record, 'companyID')
+            managerID = optional_id(record, 'managerID')
+        except:
+            errors[index] = error_body(400, aeh.HTTP_PARAM_TYPE, ['employeeID', 'companyID', 'managerID'], 'numeric')
+            continue
+        if employeeID in batchIDs:
+            errors[index] = error_body(400, aeh.SQL_CONSTRAINT_FAILED, employeeID, message=aeh.REPEATED_IN_BATCH)
+            continue
+        batchIDs.add(employeeID)
+        records[index] = dict(record, employeeID=employeeID, companyID=companyID, managerID=managerID)
+
+    employees = get_employee_map(batchIDs | {r['managerID'] for r in records.values() if r['managerID'] is not None})
+    companies = get_existing_companies({r['companyID'] for r in records.values()})
+    taken_emails = get_taken_emails({r['email'] for r in records.values() if 'email' in r}, batchIDs)
+
+    # company of each employee of the batch once it is written
+    final_companies = {}
+    for index, record in list(records.items()):
+        employee = employees.get(record['employeeID'])
+        if employee is None:
+            errors[index] = error_body(404, aeh.SQL_NOT_FOUND, record['employeeID'], message=aeh.NO_EMPLOYEE_TO_EDIT)
+        elif 'companyID' in batch[index] and record['companyID'] is not None and record['companyID'] not in companies:
+            errors[index] = error_body(404, aeh.SQL_NOT_FOUND, record['companyID'], message=aeh.NO_COMPANY_TO_ASSOCIATE)
+        elif 'email' in record and record['email'] in taken_emails:
+            errors[index] = error_body(400, aeh.SQL_CONSTRAINT_FAILED, record['email'], message=aeh.EMAIL_ALREADY_IN_USE)
+        else:
+            final_companies[employee.employeeID] = record['companyID'] if 'companyID' in batch[index] else employee.companyID
+            continue
+        del records[index]
+
+    moved = {e for e, c in final_companies.items() if c != employees[e].companyID}
+    for index, record in records.items():
+        managerID = record['managerID']
+        if 'managerID' not in batch[index] or managerID is None:
+            continue
+        manager = employees.get(managerID)
+        if manager is None:
+            errors[index] = error_body(404, aeh.SQL_NOT_FOUND, managerID, message=aeh.NO_EMPLOYEE_TO_ASSIGN)
+            continue
+        manager_company = final_companies.get(managerID, manager.companyID)
+        if manager_company != final_companies[record['employeeID']]:
+            errors[index] = error_body(400, aeh.API_NOT_SAME_COMPANY, manager_company, final_companies[record['employeeID']])
+
+    if len(errors) > 0:
+        return bulk_error_body(errors), 400
+
+    # Final chains of management of the companies receiving new managers, applying the
+    # batch the same way the change_manager_after_update_companyID trigger will: the
+    # subordinates of employees moving to another company (and these employees, when
+    # no new manager is given) are left without a manager.
+    assigned = {r['employeeID']: r['managerID'] for i, r in records.items() if 'managerID' in batch[i]}
+    target_companies = {final_companies[e] for e, m in assigned.items() if m is not None}
+    final_managers = {}
+    if len(target_companies) > 0:
+        company_employees = db.session.query(Employee.employeeID, Employee.managerID)\
+            .filter(Employee.companyID.in_(target_companies)).all()
+        final_managers = {e: (None if m in moved else m) for e, m in company_employees}
+    for employeeID in final_companies:
+        final_managers[employeeID] = None if employeeID in moved else employees[employeeID].managerID
+    final_managers.update(assigned)
+
+    loops = find_structure_loops(final_managers, assigned)
+    for index, record in records.items():
+        if record['employeeID'] in loops and assigned.get(record['employeeID']) is not None:
+            errors[index] = error_body(400, aeh.API_STRUCTURE_LOOP)
+    if len(errors) > 0:
+        return bulk_error_body(errors), 400
+
+    # subordinates outside of the batch that will be left without a manager
+    changed_employees = []
+    if len(moved) > 0:
+        changed_employees = Employee.query.filter(
+                Employee.managerID.in_(moved), Employee.employeeID.notin_(assigned)
+            ).order_by(Employee.employeeID).all()
+        changed_employees = employees_schema.dump(changed_employees)
+
+    affected_companies = {employees[e].companyID for e in final_companies} | set(final_companies.values())
+    # employees whose manager changes, the only ones (with their subordinates) to reindex
+    restructured = [e for e in final_companies if e in moved or final_managers[e] != employees[e].managerID]
+    old_states = [api_cache.employee_state(employees[e]) for e in final_companies] + api_cache.detached_states(changed_employees)
+    try:
+        for index, record in records.items():
+            employee = employees[record['employeeID']]
+            for attribute in ('name', 'email', 'companyID', 'managerID'):
+                if attribute in batch[index]:
+                    setattr(employee, attribute, record[attribute])
+        db.session.flush()
+        # the trigger may have unassigned managers that the batch assigns explicitly
+        if len(assigned) > 0:
+            table = Employee.__table__
+            db.session.execute(
+                update(table).where(table.c.employeeID == bindparam('b_employeeID')).values(managerID=bindparam('b_managerID')),
+                [{'b_employeeID': e, 'b_managerID': m} for e, m in assigned.items()]
+            )
+        # every employee whose manager changes is detached first and attached to its new
+        # manager afterwards, so none is ever put under its own subordinates, in any order
+        reindexed = []
+        for employeeID in restructured:
+            if employeeID in moved:
+                reindexed += reindex(hierarchy.detach_subordinates, employees[employeeID], employees)
+            reindexed += reindex(hierarchy.move_subtree, employees[employeeID], employees)
+        for employeeID in restructured:
+            if final_managers[employeeID] is not None:
+                reindexed += reindex(hierarchy.move_subtree, employees[employeeID], employees,
+                                     employees[final_managers[employeeID]])
+        change_log.record_employee_updates(list(final_companies) + change_log.payload_ids(changed_employees))
+        data_versions.bump_employees(affected_companies)
+        db.session.commit()
+        # the commit expired the batch: read it back with one query instead of one per employee
+        get_employee_map(list(final_companies))
+        sql_result = employees_schema.dump([employees[r['employeeID']] for r in records.values()])
+    except Exception as e:
+        db.session.rollback()
+        return error_body(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e)), 400
+    api_cache.invalidate_employees(old_states + [api_cache.employee_state(employees[e]) for e in final_companies])
+    api_cache.invalidate_payloads(reindexed)
+
+    if len(changed_employees) > 0:
+        return {
+                'employees':sql_result,
+                'indirect_changes':{
+                    'api_warning':'These employees were also changed to keep database consistency.',
+                    'changes': 'Attribute managerID set to NULL.',
+                    'employees':changed_employees }
+                }, 200
+
+    return sql_result, 200
+
+
+# Lowest common manager of each pair of employees: the lowest employee that is, or is above,
+# both of them (null when they aren't in the same structure). Answered with two queries
+# for the whole batch, one for the paths of the employees and one for their managers.
+@employee_bulk_routes.route("/employees/lca", methods=['POST'])
+def get_lowest_common_managers():
+    batch, error = get_batch(request, 'pairs')
+    if error is not None:
+        return error
+
+    errors = {}
+    pairs = {}
+    for index, pair in enumerate(batch):
+        try:
+            if type(pair) != list or len(pair) != 2:
+                raise ValueError
+            pairs[index] = (int(pair[0]), int(pair[1]))
+        except (TypeError, ValueError):
+            errors[index] = error_body(400, aeh.HTTP_PARAM_TYPE, "'pairs'", 'a pair of employeeIDs as')
+
+    employeeIDs = {e for pair in pairs.values() for e in pair}
+    paths = {}
+    if len(employeeIDs) > 0:
+        paths = dict(db.session.query(Employee.employeeID, Employee.path).filter(Employee.employeeID.in_(employeeIDs)))
+    for index, pair in pairs.items():
+        missing = [e for e in pair if e not in paths]
+        if len(missing) > 0:
+            errors[index] = error_body(404, aeh.SQL_NOT_FOUND, missing[0], message=aeh.NO_EMPLOYEE_FOUND)
+    if len(errors) > 0:
+        return bulk_error_handler(400, errors)
+
+    common = {index: hierarchy.lowest_common_manager(paths[a], paths[b]) for index, (a, b) in pairs.items()}
+    managers = get_employee_map({m for m in common.values() if m is not None})
+    sql_result = []
+    for index in range(len(batch)):
+        manager = managers.get(common[index])
+        sql_result.append({
+            'employeeIDs': list(pairs[index]),
+            'manager': None if manager is None else employee_schema.dump(manager)
+        })
+    return jsonify(sql_result), 200
+
+
+@employee_bulk_routes.route("/employees/bulk", methods=['DELETE'])
+def employee_delete_bulk():
+    batch, error = get_batch(request, 'employeeIDs')
+    if error is not None:
+        return error
+
+    errors = {}
+    employeeIDs = {}
+    batchIDs = set()
+    for index, employeeID in enumerate(batch):
+        try:
+            employeeID = int(employeeID)
+        except:
+            errors[index] = error_body(400, aeh.HTTP_PARAM_TYPE, "'employeeIDs'", 'numeric')
+            continue
+        if employeeID in batchIDs:
+            errors[index] = error_body(400, aeh.SQL_CONSTRAINT_FAILED, employeeID, message=aeh.REPEATED_IN_BATCH)
+            continue
+        batchIDs.add(employeeID)
+        employeeIDs[index] = employeeID
+
+    employees = get_employee_map(batchIDs)
+    for index, employeeID in employeeIDs.items():
+        if employeeID not in employees:
+            errors[index] = error_body(404, aeh.SQL_NOT_FOUND, employeeID, message=aeh.NO_EMPLOYEE_TO_DELETE)
+    if len(errors) > 0:
+        return bulk_error_handler(400, errors)
+
+    deleted = list(employees)
+    changed_employees = Employee.query.filter(
+            Employee.managerID.in_(deleted), Employee.employeeID.notin_(deleted)
+        ).order_by(Employee.employeeID).all()
+    changed_employees = employees_schema.dump(changed_employees)
+    sql_result = employees_schema.dump([employees[employeeIDs[index]] for index in range(len(batch))])
+    old_states = [api_cache.employee_state(e) for e in employees.values()] + api_cache.detached_states(changed_employees)
+    try:
+        reindexed = hierarchy.remove_employees(list(employees.values()))
+        Employee.query.filter(Employee.managerID.in_(deleted), Employee.employeeID.notin_(deleted))\
+            .update({Employee.managerID: None}, synchronize_session=False)
+        Employee.query.filter(Employee.employeeID.in_(deleted)).delete(synchronize_session=False)
+        change_log.record_changes(change_log.EMPLOYEE, change_log.DELETE, sql_result)
+        change_log.record_employee_updates(change_log.payload_ids(changed_employees))
+        data_versions.bump_employees({e.companyID for e in employees.values()})
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
+    api_cache.invalidate_employees(old_states)
+    api_cache.invalidate_payloads(reindexed)
+
+    if len(changed_employees) > 0:
+        return jsonify({
+                'employees':sql_result,
+                'indirect_changes':{
+                    'api_warning':'These employees were also changed to keep database consistency.',
+                    'changes': "Attribute 'managerID' set to NULL.",
+                    'employees':changed_employees }
+                }), 200
+
+    return jsonify(sql_result), 200
+
+# =================================================================================== #
@@ -1,57 +1,65 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-from sqlalchemy import Column, Integer, DateTime, and_
-from flask_cors import CORS
-import json 
-import os
-import datetime
-import requests
-
-from app.app_core import db, ma, app
+from flask import Blueprint, request, jsonify
+from sqlalchemy import and_
+
+from app.app_core import db
 import routes.api_error_handler as aeh
 from routes.api_error_handler import error_handler, check_missing_parameters
-
-from models.company_model import Company, CompanySchema, company_schema, companies_schema
-from models.employee_model import Employee, EmployeeSchema, employee_schema, employees_schema, update_manager_trigger
-
-
-# Recursive function that goes up a company's structure, checking for possible 
-# management loops when creating/editing an employee. 
-# This logic relies on two basic rules:
-#     - No employee can have more than one manager
-#     - No employee can be assigned a manager that doesn't exist
-def valid_company_structure(managerID, employeeID):
-    # the recursion has come to a loop
-    if managerID == employeeID: 
-        return False
-    
-    # the recursion has come to someone without a boss => there's no loop
-    if managerID is None:
-        return True
-
-    # go up a level and check again
-    return valid_company_structure(Employee.query.get(managerID).managerID, employeeID)
-
-# Recursive function that returns the subordinates N levels 
-# under the selected employee.
-def get_employees_under(employees, level):
-    subordinates = Employee.query.filter(Employee.managerID.in_(employees)).all()
-    sql_result = employees_schema.dump(subordinates)
-    level -= 1
-    if level <= 0:
-        return sql_result
+from routes.api_pagination import list_response, ranked_search_response
+import routes.api_cache as api_cache
+from routes.api_validation import get_write_targets, valid_company_structure
+from routes.api_etag import conditional, employees_scope, employee_company_scope
+from routes.api_admission import admission_cost
+
+from models.employee_model import Employee, employee_schema, employees_schema
+import models.search_index as search_index
+import models.hierarchy as hierarchy
+import models.structure_queries as structure_queries
+import models.change_log as change_log
+import models.org_graph as org_graph
+
+
+employee_routes = Blueprint('employee_routes', __name__)
+
+
+# Employees with IDs per query when loading a list of employees by ID.
+ID_BATCH_SIZE = 500
+
+# The employees, in the order of their IDs in the list.
+def get_employees_by_id(employeeIDs):
+    employees = {}
+    for start in range(0, len(employeeIDs), ID_BATCH_SIZE):
+        batch = employeeIDs[start:start + ID_BATCH_SIZE]
+        employees.update((e.employeeID, e) for e in Employee.query.filter(Employee.employeeID.in_(batch)))
+    return [employees[e] for e in employeeIDs]
+
+# Returns the subordinates N levels under the selected employee, in a single
+# recursive query (or walking the org graph of its company, when enabled).
+# When no level is given, returns the whole structure under the employee
+# instead, with the level of each subordinate.
+def get_employees_under(employeeID, companyID, level=None):
+    graph = org_graph.get_org_graph()
+    if graph is None:
+        subordinates = structure_queries.subtree(employeeID, level).all()
+        sql_result = employees_schema.dump([employee for employee, _ in subordinates])
     else:
-        employees = [sub['employeeID'] for sub in sql_result]
-    return(get_employees_under(employees, level))
+        subordinates = graph.company(companyID).subtree(employeeID, level)
+        sql_result = employees_schema.dump(get_employees_by_id([employeeID for employeeID, _ in subordinates]))
+    if level is None:
+        for result, (_, employee_level) in zip(sql_result, subordinates):
+            result['level'] = employee_level
+    return sql_result
+
+# The employees of the company right under the manager (the top managers, if None).
+def get_employees_beside(companyID, managerID):
+    graph = org_graph.get_org_graph()
+    if graph is None:
+        return Employee.query.filter(and_(Employee.managerID==managerID, Employee.companyID == companyID)).all()
+    return get_employees_by_id(graph.company(companyID).siblings(managerID))
 
-# Returns indirect changes when an object is altered.
-# Although deleting a compnay is yet to be implemented, this
-# function is ready to report the indirect changes to that.
+# Returns indirect changes when an object is altered. Deleting a company reports its
+# indirect changes straight from the statements that write them (see company_routes.py).
 def get_indirect_changes(altered_object):
-    if type(altered_object) == Company:
-        indirect_changes = Employee.query.filter(Employee.companyID==altered_object.companyID).all()
-    elif type(altered_object) == Employee:
+    if type(altered_object) == Employee:
         indirect_changes = Employee.query.filter(Employee.managerID==altered_object.employeeID)
     else:
         return None
@@ -63,7 +71,7 @@ def get_indirect_changes(altered_object):
 # ================================== E M P L O Y E E ================================ #
 # =================================================================================== #
 
-@app.route("/employees", methods=['POST'])
+@employee_routes.route("/employees", methods=['POST'])
 def add_employee():
     required = ['name', 'email']
 
@@ -82,13 +90,11 @@ def add_employee():
 
     new_employee = Employee(name, email, companyID, managerID)
 
-    if companyID is not None:
-        company = Company.query.get(request.json['companyID'])
-        if company is None:
-            return error_handler(400, aeh.SQL_NOT_FOUND, request.json['companyID'], message=aeh.NO_COMPANY_TO_ASSOCIATE)
+    _, company_found, manager = get_write_targets(companyID=companyID, managerID=managerID)
+    if company_found is False:
+        return error_handler(400, aeh.SQL_NOT_FOUND, request.json['companyID'], message=aeh.NO_COMPANY_TO_ASSOCIATE)
     
     if managerID is not None:
-        manager = Employee.query.get(request.json['managerID'])
         if manager is None:
             return error_handler(400, aeh.SQL_NOT_FOUND, request.json['managerID'], message=aeh.NO_EMPLOYEE_TO_ASSIGN)
         if manager.companyID != new_employee.companyID:
@@ -98,8 +104,14 @@ def add_employee():
     try:
         db.session.add(new_employee)
         db.session.flush()
+        hierarchy.index_new_employee(new_employee, manager)
         sql_result = employee_schema.dump(new_employee)
+        change_log.record_changes(change_log.EMPLOYEE, change_log.INSERT, [sql_result])
+        new_state = api_cache.employee_state(new_employee)
+        versions = org_graph.bump_employees([companyID])
         db.session.commit()
+        org_graph.apply_changes(versions, ('add', companyID, sql_result['employeeID'], managerID))
+        api_cache.invalidate_employees([new_state])
         return jsonify(sql_result), 200
 
     except Exception as e:
@@ -108,49 +120,55 @@ def add_employee():
         return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
 
 
-@app.route("/employees", methods=['GET'])
+@employee_routes.route("/employees", methods=['GET'])
+@conditional(employees_scope)
 def get_employees():
-    all_employees = Employee.query.all()
-    sql_result = employees_schema.dump(all_employees)
-    if len(sql_result) == 0:
-        return jsonify(sql_result), 200
-    return jsonify(sql_result), 200
+    return list_response(Employee.query, Employee.employeeID, employees_schema)
 
 
-@app.route("/employees/search", methods=['GET'])
+@employee_routes.route("/employees/search", methods=['GET'])
+@conditional(employees_scope)
 def get_employee_by_name():
     name = request.args.get('name')
     if name is None:
         return get_employees()
-    filtered_employees = Employee.query.filter(Employee.name.like("%{}%".format(name)))
-    sql_result = employees_schema.dump(filtered_employees)
-    if len(sql_result) == 0:
-        return jsonify(sql_result), 404        
-    return jsonify(sql_result), 200
+    prefix = request.args.get('match') == 'prefix'
+    if request.args.get('ranked') == 'true':
+        return ranked_search_response(Employee, name, employees_schema, prefix)
+    filtered_employees = Employee.query.filter(search_index.name_filter(Employee, name, prefix))
+    return list_response(filtered_employees, Employee.employeeID, employees_schema, empty_status=404)
 
 
-@app.route("/employees/<id>", methods=['GET'])
+@employee_routes.route("/employees/<id>", methods=['GET'])
+@conditional(employee_company_scope)
 def get_employee_detail(id):
-    employee = Employee.query.get(id)
-    if employee is None:
+    sql_result = api_cache.get_employee_payload(id)
+    if sql_result is None:
         return error_handler(404, aeh.SQL_NOT_FOUND, 'employee')
-    sql_result = employee_schema.dump(employee)
     return jsonify(sql_result), 200
 
 
-@app.route("/employees/<id>", methods=["DELETE"])
+@employee_routes.route("/employees/<id>", methods=["DELETE"])
 def usuario_delete(id):
     employee = Employee.query.get(id)
     if employee is None:
         return error_handler(404, aeh.SQL_NOT_FOUND, id, message=aeh.NO_EMPLOYEE_TO_DELETE)
 
-    subordinates = get_employees_under([id], 1)
-    subordinatesID = [s['employeeID'] for s in subordinates]
     try:
         changed_employees = get_indirect_changes(employee)
         sql_result = employee_schema.dump(employee)
+        old_states = [api_cache.employee_state(employee)] + api_cache.detached_states(changed_employees)
+        reindexed = hierarchy.remove_employee(employee)
+        versions = org_graph.bump_employees([employee.companyID])
         db.session.delete(employee)
+        # subordinates' managerID is set to NULL by the flush
+        db.session.flush()
+        change_log.record_changes(change_log.EMPLOYEE, change_log.DELETE, [sql_result])
+        change_log.record_employee_updates(change_log.payload_ids(changed_employees))
         db.session.commit()
+        org_graph.apply_changes(versions, ('remove', sql_result['companyID'], sql_result['employeeID']))
+        api_cache.invalidate_employees(old_states)
+        api_cache.invalidate_payloads(reindexed)
         if changed_employees is not None and len(changed_employees) > 0:
             return jsonify({
                     'employee':sql_result, 
@@ -168,18 +186,24 @@ def usuario_delete(id):
         return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
 
 
-@app.route("/employees/<id>", methods=["PUT"])
+@employee_routes.route("/employees/<id>", methods=["PUT"])
 def employee_update(id):
-    employee = Employee.query.get(id)
-    if employee is None:
-        return error_handler(404, aeh.SQL_NOT_FOUND, id, message=aeh.NO_EMPLOYEE_TO_EDIT)
-
     try:
         companyID = None if 'companyID' not in request.json or request.json['companyID'] is None else int(request.json['companyID'])
         managerID = None if 'managerID' not in request.json or request.json['managerID'] is None else int(request.json['managerID'])
     except:
+        employee = Employee.query.get(id)
+        if employee is None:
+            return error_handler(404, aeh.SQL_NOT_FOUND, id, message=aeh.NO_EMPLOYEE_TO_EDIT)
         return error_handler(400, aeh.HTTP_PARAM_TYPE, ['companyID', 'managerID'], 'numeric')
 
+    # the employee, its new company and its new manager (with its whole chain of management)
+    employee, company_found, manager = get_write_targets(api_cache.parse_id(id), companyID, managerID)
+    if employee is None:
+        return error_handler(404, aeh.SQL_NOT_FOUND, id, message=aeh.NO_EMPLOYEE_TO_EDIT)
+    old_state = api_cache.employee_state(employee)
+    old_companyID = employee.companyID
+
     if 'name' in request.json:
         employee.name = request.json['name']
 
@@ -187,33 +211,57 @@ def employee_update(id):
         employee.email = request.json['email']
 
     changed_employees = None
+    # who will manage the employee after the update, to keep the hierarchy index in sync
+    company_changed = False
+    manager_changed = False
+    new_manager = None
     if 'companyID' in request.json:
-        if companyID is not None:
-            company = Company.query.get(companyID)
-            if company is None:
-                return error_handler(404, aeh.SQL_NOT_FOUND, companyID, message=aeh.NO_COMPANY_TO_ASSOCIATE)
+        if company_found is False:
+            return error_handler(404, aeh.SQL_NOT_FOUND, companyID, message=aeh.NO_COMPANY_TO_ASSOCIATE)
         if employee.companyID != companyID:
             changed_employees = get_indirect_changes(employee)
+            # the change_manager_after_update_companyID trigger unassigns the manager,
+            # unless a new one is assigned below
+            company_changed = True
+            new_manager = None
         employee.companyID = companyID
 
     if 'managerID' in request.json:
         if managerID is not None:
-            manager = Employee.query.get(request.json['managerID'])
             if manager is None:
                 return error_handler(404, aeh.SQL_NOT_FOUND, request.json['managerID'], message=aeh.NO_EMPLOYEE_TO_ASSIGN)
             if manager.companyID != employee.companyID:
                 return error_handler(400, aeh.API_NOT_SAME_COMPANY, manager.companyID, employee.companyID)
-            if not valid_company_structure(manager.employeeID, employee.employeeID):
+            if not valid_company_structure(manager, employee):
                 return error_handler(400, aeh.API_STRUCTURE_LOOP)
+        if employee.managerID != managerID:
+            manager_changed = True
+            new_manager = manager if managerID is not None else None
         employee.managerID = managerID
 
     # if all went right so far, commit to database
+    reindexed = []
+    graph_changes = []
     try:    
         db.session.flush()
+        new_managerID = None if new_manager is None else new_manager.employeeID
+        if company_changed:
+            reindexed += hierarchy.detach_subordinates(employee)
+            graph_changes += [('remove', old_companyID, employee.employeeID), ('add', employee.companyID, employee.employeeID, new_managerID)]
+        elif manager_changed:
+            graph_changes.append(('move', employee.companyID, employee.employeeID, new_managerID))
+        if company_changed or manager_changed:
+            reindexed += hierarchy.move_subtree(employee, new_manager)
+        change_log.record_employee_updates([employee.employeeID] + change_log.payload_ids(changed_employees))
+        versions = org_graph.bump_employees([old_companyID, employee.companyID])
         db.session.commit()
         sql_result = employee_schema.dump(employee) 
     except Exception as e:
         return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
+    # the graphs first, so the structures cached again after the invalidation come from them
+    org_graph.apply_changes(versions, *graph_changes)
+    api_cache.invalidate_employees([old_state, api_cache.employee_state(employee)] + api_cache.detached_states(changed_employees))
+    api_cache.invalidate_payloads(reindexed)
 
     if changed_employees is not None and len(changed_employees) > 0:
         return jsonify({
@@ -228,22 +276,64 @@ def employee_update(id):
 
 
 
-@app.route("/employees/<id>/structure/<level>", methods=['GET'])
+# Employees read by the structure of the employee (see routes/api_admission.py), from its
+# aggregates: the whole structure under it for 'all', else its direct reports to the power
+# of the level (as if each level under it had the same fan-out), up to its headcount.
+def estimate_structure_rows(id, level):
+    employee = api_cache.get_employee_payload(id)
+    if employee is None:
+        return 0
+    if level == 'all':
+        return employee['headcount']
+    level = api_cache.parse_id(level)
+    if level is None or level <= 0:
+        return 0
+    rows = 1
+    for _ in range(min(level, employee['headcount'])):
+        rows *= employee['directReports']
+        if rows == 0 or rows >= employee['headcount']:
+            break
+    return min(rows, employee['headcount'])
+
+
+@employee_routes.route("/employees/<id>/structure/<level>", methods=['GET'])
+@admission_cost(estimate_structure_rows)
+@conditional(employee_company_scope)
 def get_company_structure(id, level):
     try:
-        level = int(level)
+        level = None if level == 'all' else int(level)
     except Exception as e:
-        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'level'", 'numeric')
+        return error_handler(400, aeh.HTTP_PARAM_TYPE, "'level'", "numeric or 'all'")
 
-    employee = Employee.query.get(id)
+    employee = api_cache.get_employee_payload(id)
     if employee is None:
         return error_handler(404, aeh.SQL_NOT_FOUND, 'employee')
+    companyID, managerID = employee['companyID'], employee['managerID']
     
-    if level <= 0:
-        subordinates = Employee.query.filter(and_(Employee.managerID==employee.managerID, Employee.companyID == employee.companyID)).all()
-        sql_result = employees_schema.dump(subordinates)
+    if level is not None and level <= 0:
+        sql_result = api_cache.get_siblings(companyID, managerID,
+                                            lambda: employees_schema.dump(get_employees_beside(companyID, managerID)))
     else:
-        sql_result = get_employees_under([id], int(level))
+        sql_result = api_cache.get_structure(employee['employeeID'], 'all' if level is None else level,
+                                             lambda: get_employees_under(employee['employeeID'], companyID, level))
+    if len(sql_result) == 0:
+        return jsonify(sql_result), 404
+    return jsonify(sql_result), 200
+
+
+# The managers above the employee, from its manager ('level' 1) up to the top manager,
+# read from its path (see models/hierarchy.py) with a single query.
+@employee_routes.route("/employees/<id>/chain", methods=['GET'])
+@conditional(employee_company_scope)
+def get_management_chain(id):
+    employee = Employee.query.get(id)
+    if employee is None:
+        return error_handler(404, aeh.SQL_NOT_FOUND, 'employee')
+
+    chain = hierarchy.managers_above(employee.path)
+    sql_result = employees_schema.dump(get_employees_by_id(chain))
+    for level, result in enumerate(sql_result, start=1):
+        result['level'] = level
     if len(sql_result) == 0:
         return jsonify(sql_result), 404
     return jsonify(sql_result), 200
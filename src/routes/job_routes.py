@@ -0,0 +1,66 @@
+from flask import Blueprint, request, jsonify, url_for
+import json
+
+from app.app_core import db
+from app.jobs import job_handler, get_job_queue
+import routes.api_error_handler as aeh
+from routes.api_error_handler import error_handler
+from routes.employee_bulk_routes import get_batch, update_employees
+
+from models.job_model import Job, job_schema, JOB_SUCCEEDED, JOB_FAILED
+
+
+job_routes = Blueprint('job_routes', __name__)
+
+
+# =================================================================================== #
+# Reorganizations: a batch of employee edits (the same as PUT /employees/bulk, usually
+# moving many employees between companies and managers) run as a background job (see
+# app/jobs.py), so the request returns right away and no HTTP worker is held while it
+# runs. The job's result is the aggregated report of the changes, indirect ones included.
+# =================================================================================== #
+REORG_JOB = 'reorg'
+
+
+@job_handler(REORG_JOB)
+def run_reorg(payload):
+    body, status = update_employees(payload['moves'])
+    if status != 200:
+        return False, body
+    # the same shape whether or not there were indirect changes
+    if type(body) == list:
+        body = {'employees': body}
+    return True, body
+
+
+@job_routes.route("/jobs/reorg", methods=['POST'])
+def submit_reorg():
+    moves, error = get_batch(request, 'moves')
+    if error is not None:
+        return error
+
+    job = Job(REORG_JOB, {'moves': moves})
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=str(e))
+
+    get_job_queue().submit(job.jobID)
+    response = jsonify(job_schema.dump(job))
+    response.headers['Location'] = url_for('job_routes.get_job', id=job.jobID)
+    return response, 202
+
+
+@job_routes.route("/jobs/<id>", methods=['GET'])
+def get_job(id):
+    job = Job.query.get(id)
+    if job is None:
+        return error_handler(404, aeh.SQL_NOT_FOUND, 'job')
+    sql_result = job_schema.dump(job)
+    if job.status in (JOB_SUCCEEDED, JOB_FAILED):
+        sql_result['result'] = json.loads(job.result)
+    return jsonify(sql_result), 200
+
+# =================================================================================== #
@@ -1,21 +1,25 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-from sqlalchemy import Column, Integer, DateTime, and_
-from flask_cors import CORS
-import json 
+from flask import Blueprint, request, jsonify
+import json
 import os
-import datetime
-import requests
 
-from app.app_core import db, ma, app
+from app.app_core import db
 import routes.api_error_handler as aeh
 from routes.api_error_handler import error_handler, check_missing_parameters
+from routes.api_admission import get_admission
 
-from models.company_model import Company, CompanySchema, company_schema, companies_schema
-from models.employee_model import Employee, EmployeeSchema, employee_schema, employees_schema, update_manager_trigger
+from models.company_model import Company
+from models.employee_model import Employee
+from models.hierarchy import compute_index
+from models.org_graph import get_org_graph
+import models.snapshots as snapshots
+from app.cache import get_cache
 
 
+test_routes = Blueprint('test_routes', __name__)
+
+
+# Fixtures are written with a few Core INSERTs (executemany), IDs and hierarchy index
+# included, instead of building ORM objects for each row.
 def fill_test_database():
     basedir = os.path.abspath(os.path.dirname(__file__))
     project_dir = os.path.dirname(os.path.dirname(basedir)) # up two levels
@@ -23,23 +27,73 @@ def fill_test_database():
         companies_json = json.load(file)
     with open(os.path.join(project_dir, 'tests', 'starting_employees.json')) as file:
         employees_json = json.load(file)
-    companies = [Company(c['name']) for c in companies_json]
-    employees = [Employee(e['name'], e['email'], e['companyID'] if 'companyID' in e else None, e['managerID'] if 'managerID' in e else None) for e in employees_json]
-    db.session.add_all(companies)
-    db.session.add_all(employees)
+    companies = [{'companyID': i + 1, 'name': c['name']} for i, c in enumerate(companies_json)]
+    employees = [{'employeeID': i + 1, 'name': e['name'], 'email': e['email'], 'companyID': e.get('companyID'), 'managerID': e.get('managerID')}
+                 for i, e in enumerate(employees_json)]
+    index = compute_index((e['employeeID'], e['managerID']) for e in employees)
+    for employee in employees:
+        employee['path'], employee['depth'], employee['headcount'], employee['directReports'] = index[employee['employeeID']]
+    db.session.execute(Company.__table__.insert(), companies)
+    db.session.execute(Employee.__table__.insert(), employees)
     db.session.commit()
 
 def empty_test_database():
     db.session.remove()
     db.drop_all()
+    get_cache().clear()
+    if get_org_graph() is not None:
+        get_org_graph().clear()
+
+# Name of the snapshot of the database right after the fixtures are loaded.
+FIXTURES_SNAPSHOT = 'fixtures'
+
+def snapshot_name():
+    body = request.get_json(silent=True) or {}
+    return str(body.get('name', FIXTURES_SNAPSHOT))
 
-@app.route("/tests/setup", methods=['POST'])
+# Loads the fixtures, or restores them from their snapshot when there is one (see
+# models/snapshots.py), which takes milliseconds regardless of the fixtures' size.
+@test_routes.route("/tests/setup", methods=['POST'])
 def set_up():
-    db.create_all()
-    fill_test_database()
+    if snapshots.snapshots_supported() and snapshots.has_snapshot(FIXTURES_SNAPSHOT):
+        snapshots.restore_snapshot(FIXTURES_SNAPSHOT)
+    else:
+        db.create_all()
+        fill_test_database()
+        if snapshots.snapshots_supported():
+            snapshots.take_snapshot(FIXTURES_SNAPSHOT)
     return jsonify({"message":"Database up and ready for testing!"}), 200
 
-@app.route("/tests/teardown", methods=['POST'])
+@test_routes.route("/tests/teardown", methods=['POST'])
 def tear_down():
     empty_test_database()
     return jsonify({"message":"Database dropped!"}), 200
+
+@test_routes.route("/tests/snapshot", methods=['POST'])
+def take_snapshot():
+    if not snapshots.snapshots_supported():
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=aeh.NO_SNAPSHOTS)
+    name = snapshot_name()
+    snapshots.take_snapshot(name)
+    return jsonify({"message":"Snapshot '{}' taken!".format(name)}), 200
+
+@test_routes.route("/tests/restore", methods=['POST'])
+def restore_snapshot():
+    if not snapshots.snapshots_supported():
+        return error_handler(400, aeh.SQL_CONSTRAINT_FAILED, message=aeh.NO_SNAPSHOTS)
+    name = snapshot_name()
+    if not snapshots.has_snapshot(name):
+        return error_handler(404, aeh.SQL_NOT_FOUND, "snapshot '{}'".format(name))
+    snapshots.restore_snapshot(name)
+    return jsonify({"message":"Snapshot '{}' restored!".format(name)}), 200
+
+# Sets the quota of a client (see routes/api_admission.py), as COMPANIFY_CLIENT_QUOTAS does.
+@test_routes.route("/tests/quota", methods=['POST'])
+def set_quota():
+    missing = check_missing_parameters(request, ['client', 'rate', 'burst'])
+    if len(missing) > 0:
+        return error_handler(400, aeh.HTTP_MISSING_PARAMS, missing)
+    admission = get_admission()
+    if admission is not None:
+        admission.set_quota(request.json['client'], float(request.json['rate']), float(request.json['burst']))
+    return jsonify({"message":"Quota of client '{}' set!".format(request.json['client'])}), 200
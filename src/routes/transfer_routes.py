@@ -0,0 +1,68 @@
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from sqlalchemy import func
+import io
+
+from app.app_core import db
+import routes.api_error_handler as aeh
+from routes.api_error_handler import error_handler
+from routes.api_admission import admission_cost
+from routes.data_transfer import ENTITIES, FORMATS, NDJSON, TRANSFER_BATCH_SIZE, export_stream, import_stream
+
+
+transfer_routes = Blueprint('transfer_routes', __name__)
+
+
+# =================================================================================== #
+# Export and import of whole tables (see routes/data_transfer.py), as streams: exports
+# are written batch by batch as the client reads them, and imports read the body of the
+# request as it arrives, without holding either in memory. The same is available from
+# the command line with src/transfer.py, skipping HTTP altogether.
+# =================================================================================== #
+def get_entity_and_format(entity):
+    transfer_format = request.args.get('format', NDJSON)
+    if entity not in ENTITIES:
+        return None, error_handler(404, aeh.HTTP_PARAM_TYPE, "'entity'", ' or '.join(ENTITIES))
+    if transfer_format not in FORMATS:
+        return None, error_handler(400, aeh.HTTP_PARAM_TYPE, "'format'", ' or '.join(FORMATS))
+    return transfer_format, None
+
+
+# Rows read by the export and written by the import (see routes/api_admission.py): the
+# largest ID of the table (read on its primary key, instead of counting the rows), and the
+# rows of the file, from its size (a whole batch when not given).
+IMPORT_BYTES_PER_ROW = 100
+
+
+def estimate_export_rows(entity):
+    if entity not in ENTITIES:
+        return 0
+    model, schema = ENTITIES[entity]
+    return db.session.query(func.max(getattr(model, schema.Meta.fields[0]))).scalar() or 0
+
+
+def estimate_import_rows(entity):
+    return TRANSFER_BATCH_SIZE if request.content_length is None else request.content_length // IMPORT_BYTES_PER_ROW
+
+
+@transfer_routes.route("/export/<entity>", methods=['GET'])
+@admission_cost(estimate_export_rows)
+def export_entity(entity):
+    export_format, error = get_entity_and_format(entity)
+    if error is not None:
+        return error
+    return Response(stream_with_context(export_stream(entity, export_format)), mimetype=FORMATS[export_format])
+
+
+# Responds with the report of the import (see data_transfer.ImportReport): 200 even if
+# some rows were rejected, 400 if the import had to stop before the end of the file.
+@transfer_routes.route("/import/<entity>", methods=['POST'])
+@admission_cost(estimate_import_rows)
+def import_entity(entity):
+    import_format, error = get_entity_and_format(entity)
+    if error is not None:
+        return error
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    report = import_stream(entity, lines, import_format)
+    return jsonify(report.dump()), 400 if report.aborted is not None else 200
+
+# =================================================================================== #
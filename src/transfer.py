@@ -0,0 +1,52 @@
+# Command line export and import of whole tables (see routes/data_transfer.py), on the
+# database of the run mode, without going through the API:
+#
+#     python src/transfer.py export employees employees.csv
+#     python src/transfer.py import employees employees.csv --mode debug
+#     python src/transfer.py export companies - --format columnar > companies.ndjson
+#
+# The format is taken from the extension of the file (.ndjson, .csv, .columnar) unless
+# given. Imports print their report as JSON, and exit with 1 if they had to stop early.
+import argparse
+import json
+import os
+import sys
+
+from app.app_core import create_app, run_modes
+
+EXTENSIONS = {'.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv', '.columnar': 'columnar'}
+
+
+def main():
+    from routes.data_transfer import ENTITIES, FORMATS, NDJSON
+    parser = argparse.ArgumentParser(description='Export and import of the Companify tables.')
+    parser.add_argument('operation', choices=['export', 'import'])
+    parser.add_argument('entity', choices=list(ENTITIES))
+    parser.add_argument('file', help="file to write to or read from, '-' for stdout/stdin")
+    parser.add_argument('--format', choices=list(FORMATS))
+    parser.add_argument('--mode', choices=list(run_modes), default='debug')
+    args = parser.parse_args()
+    transfer_format = args.format or EXTENSIONS.get(os.path.splitext(args.file)[1].lower(), NDJSON)
+
+    app = create_app(run_modes[args.mode])
+    with app.app_context():
+        from models.migrations import upgrade
+        from routes.data_transfer import export_stream, import_stream
+        upgrade()
+        if args.operation == 'export':
+            file = sys.stdout if args.file == '-' else open(args.file, 'w', encoding='utf-8', newline='')
+            with file:
+                for chunk in export_stream(args.entity, transfer_format):
+                    file.write(chunk)
+            return
+
+        file = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8', newline='')
+        with file:
+            report = import_stream(args.entity, file, transfer_format)
+        print(json.dumps(report.dump(), indent=2))
+        if report.aborted is not None:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
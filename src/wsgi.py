@@ -0,0 +1,15 @@
+# Entry point for WSGI servers, e.g.:
+#     gunicorn --chdir src --preload --workers 4 --threads 4 wsgi:application
+# The database is created or migrated here, so '--preload' makes it happen only once,
+# in the master process, before the workers are forked.
+import os
+
+from app.app_core import db, create_app, run_modes
+from models.migrations import upgrade
+
+application = create_app(os.environ.get('COMPANIFY_RUN_MODE', run_modes['production']))
+
+with application.app_context():
+    upgrade()
+    # workers must open their own connections
+    db.engine.dispose()
@@ -5,6 +5,7 @@ import datetime
 import requests
 import time
 import pytest
+import sqlite3
 from flask_testing import TestCase
 
 # we need this here so the test script can find the dir from which to import aeh
@@ -22,6 +23,14 @@ def setup_and_teardown():
     response = requests.post(BASE_URL + "/tests/teardown")
     response = requests.post(BASE_URL + "/tests/setup")    
     yield response
+
+# Runs a test without side effects on the following ones: the database is restored
+# to the snapshot taken right before the test.
+@pytest.fixture
+def isolated_database():
+    requests.post(BASE_URL + "/tests/snapshot", json={"name": "before_test"})
+    yield
+    requests.post(BASE_URL + "/tests/restore", json={"name": "before_test"})
     
 basedir = os.path.abspath(os.path.dirname(__file__))
 with open(os.path.join(basedir, 'starting_companies.json')) as file:
@@ -157,4 +166,483 @@ def test_delete_employee_error(employeeID, expected_status, expected_error):
     response = requests.delete(BASE_URL + "/employees/" + str(employeeID))
     status = response.status_code
     error = response.json()['error']['error_code']
-    assert status == expected_status and error == expected_error
\ No newline at end of file
+    assert status == expected_status and error == expected_error
+
+# Structure after the edits and deletions above: the subordinates of the deleted employee
+# were detached and Pete Miller now works under Andy Bernard.
+@pytest.mark.parametrize("employeeID, structure_level, expected_result", [
+    (1, 2, ['Pam Beesly Halpert', 'Angela Martin', 'Nellie Bertram', 'Erin Hannon', 'Pete Miller']),
+    (1, 3, ['Kevin Malone', 'Oscar Martinez']),
+    (6, 1, [])
+])
+def test_get_company_structure_after_changes(employeeID, structure_level, expected_result):
+    response = requests.get(BASE_URL + "/employees/" + str(employeeID) + "/structure/" + str(structure_level)) 
+    employees = response.json()
+    employee_names = [e['name'] for e in employees]
+    assert employee_names == expected_result
+
+
+@pytest.mark.parametrize("employeeID, employee_data, expected_status, expected_error", [
+    (10, {"managerID": 13}, 400, aeh.API_STRUCTURE_LOOP),
+    (1, {"managerID": 8}, 400, aeh.API_STRUCTURE_LOOP),
+])
+def test_edit_employee_loop_after_changes(employeeID, employee_data, expected_status, expected_error): 
+    response = requests.put(BASE_URL + "/employees/"+str(employeeID), json=employee_data)
+    status = response.status_code
+    error = response.json()['error']['error_code']
+    assert status == expected_status and error == expected_error
+
+
+@pytest.mark.parametrize("employeeID, expected_result", [
+    (2, [('Pam Beesly Halpert', 1), ('Angela Martin', 1), ('Kevin Malone', 2), ('Oscar Martinez', 2)]),
+    (10, [('Nellie Bertram', 1), ('Erin Hannon', 1), ('Pete Miller', 1)])
+])
+def test_get_whole_company_structure(employeeID, expected_result):
+    response = requests.get(BASE_URL + "/employees/" + str(employeeID) + "/structure/all") 
+    employees = response.json()
+    employee_levels = [(e['name'], e['level']) for e in employees]
+    assert employee_levels == expected_result
+
+
+@pytest.mark.parametrize("path, limit", [
+    ("/employees", 4),
+    ("/companies", 1),
+    ("/companies/1/employees", 5),
+    ("/employees/search?name=e", 3)
+])
+def test_list_pagination(path, limit):
+    expected = requests.get(BASE_URL + path).json()
+    pages = []
+    url = BASE_URL + path + ("&" if "?" in path else "?") + "limit=" + str(limit)
+    while url is not None:
+        response = requests.get(url)
+        assert len(response.json()) <= limit
+        pages.extend(response.json())
+        url = response.links['next']['url'] if 'next' in response.links else None
+    assert pages == expected
+
+
+@pytest.mark.parametrize("path", [
+    "/employees",
+    "/companies/2/employees"
+])
+def test_list_streaming(path):
+    expected = requests.get(BASE_URL + path).json()
+    separator = "&" if "?" in path else "?"
+    ndjson = requests.get(BASE_URL + path + separator + "stream=ndjson")
+    json_array = requests.get(BASE_URL + path + separator + "stream=json")
+    assert [json.loads(line) for line in ndjson.text.splitlines()] == expected
+    assert json_array.json() == expected
+
+
+@pytest.mark.parametrize("new_employees, expected_status, expected_errors", [
+    ([{"name":"Jack Harkness", "email":"captain@tw.com", "companyID":3},
+      {"name":"Ianto Jones", "email":"ianto@tw.com", "companyID":"3"}], 200, []),
+    ([{"name":"Gwen Cooper", "email":"gwen@tw.com", "companyID":3},
+      {"name":"Owen Harper", "email":"suckit@dm.com", "companyID":3},
+      {"name":"Toshiko Sato", "email":"tosh@tw.com", "companyID":3, "managerID":15},
+      {"name":"Rhys Williams"},
+      {"name":"Suzie Costello", "email":"suzie@tw.com", "companyID":10}], 400,
+     [(1, aeh.SQL_CONSTRAINT_FAILED), (2, aeh.API_NOT_SAME_COMPANY), (3, aeh.HTTP_MISSING_PARAMS), (4, aeh.SQL_NOT_FOUND)])
+])
+def test_insert_employees_bulk(new_employees, expected_status, expected_errors):
+    response = requests.post(BASE_URL + "/employees/bulk", json={"employees": new_employees})
+    status = response.status_code
+    if status == 200:
+        errors = []
+        assert [e['name'] for e in response.json()] == [e['name'] for e in new_employees]
+    else:
+        errors = [(e['index'], e['error']['error_code']) for e in response.json()['errors']]
+        # nothing is written when any record fails
+        assert requests.get(BASE_URL + "/employees/search?name=Gwen").status_code == 404
+    assert status == expected_status and errors == expected_errors
+
+
+@pytest.mark.parametrize("employees_data, expected_status, expected_errors", [
+    ([{"employeeID":21, "managerID":20}, {"employeeID":6, "managerID":2}, {"employeeID":7, "companyID":3, "managerID":20}], 200, []),
+    ([{"employeeID":20, "managerID":7}], 400, [(0, aeh.API_STRUCTURE_LOOP)]),
+    ([{"employeeID":21, "managerID":6}, {"employeeID":6, "managerID":100}, {"employeeID":100}], 400,
+     [(0, aeh.API_NOT_SAME_COMPANY), (1, aeh.SQL_NOT_FOUND), (2, aeh.SQL_NOT_FOUND)]),
+    ([{"employeeID":21, "managerID":7}, {"employeeID":7, "managerID":21}], 400, [(0, aeh.API_STRUCTURE_LOOP), (1, aeh.API_STRUCTURE_LOOP)]),
+])
+def test_edit_employees_bulk(employees_data, expected_status, expected_errors):
+    response = requests.put(BASE_URL + "/employees/bulk", json={"employees": employees_data})
+    status = response.status_code
+    errors = [] if status == 200 else [(e['index'], e['error']['error_code']) for e in response.json()['errors']]
+    assert status == expected_status and errors == expected_errors
+
+
+@pytest.mark.parametrize("employeeID, structure_level, expected_result", [
+    (20, 1, ['Stanley Hudson', 'Ianto Jones']),
+    (2, 1, ['Pam Beesly Halpert', 'Angela Martin', 'Jim Halpert'])
+])
+def test_get_company_structure_after_bulk(employeeID, structure_level, expected_result):
+    response = requests.get(BASE_URL + "/employees/" + str(employeeID) + "/structure/" + str(structure_level)) 
+    employee_names = [e['name'] for e in response.json()]
+    assert employee_names == expected_result
+
+
+@pytest.mark.parametrize("employeeIDs, expected_status, expected_indirect", [
+    ([20, 100], 400, None),
+    ([20], 200, [7, 21])
+])
+def test_delete_employees_bulk(employeeIDs, expected_status, expected_indirect):
+    response = requests.delete(BASE_URL + "/employees/bulk", json={"employeeIDs": employeeIDs})
+    status = response.status_code
+    if status == 200:
+        indirectID = sorted(i['employeeID'] for i in response.json()['indirect_changes']['employees'])
+    else:
+        indirectID = None
+        assert [e['index'] for e in response.json()['errors']] == [1]
+    assert status == expected_status and indirectID == expected_indirect
+
+
+@pytest.mark.parametrize("query, expected_status, expected_result", [
+    ("name=BER", 200, ['Andy Bernard', 'Nellie Bertram', 'Bertram Gilfoyle']),
+    ("name=ram", 200, ['Nellie Bertram', 'Bertram Gilfoyle']),
+    ("name=ram&match=prefix", 404, []),
+    ("name=ber&ranked=true&limit=1", 200, ['Bertram Gilfoyle']),
+    ("name=Pa", 200, ['Pam Beesly Halpert'])
+])
+def test_search_employee(query, expected_status, expected_result):
+    response = requests.get(BASE_URL + "/employees/search?" + query)
+    employee_names = [e['name'] for e in response.json()]
+    assert response.status_code == expected_status and employee_names == expected_result
+
+
+def test_search_after_rename():
+    requests.put(BASE_URL + "/employees/13", json={"name": "Peter Miller"})
+    assert [e['name'] for e in requests.get(BASE_URL + "/employees/search?name=peter").json()] == ['Peter Miller']
+    assert requests.get(BASE_URL + "/employees/search?name=pete&match=prefix").json()[0]['employeeID'] == 13
+    assert [c['name'] for c in requests.get(BASE_URL + "/companies/search?name=DUNDER&match=prefix").json()] == ["Dunder-Mifflin"]
+
+
+def test_cached_structure_after_changes():
+    names = lambda path: [e['name'] for e in requests.get(BASE_URL + path).json()]
+    # warms up the cache before changing the structure
+    assert names("/employees/5/structure/all") == ['Kevin Malone', 'Oscar Martinez']
+    assert names("/employees/9/structure/0") == ['Kevin Malone', 'Oscar Martinez']
+    assert requests.get(BASE_URL + "/employees/8").json()['managerID'] == 5
+    requests.put(BASE_URL + "/employees/8", json={"managerID": 6, "name": "Kevin Malone Jr."})
+    assert requests.get(BASE_URL + "/employees/8").json()['managerID'] == 6
+    assert names("/employees/5/structure/all") == ['Oscar Martinez']
+    assert names("/employees/9/structure/0") == ['Oscar Martinez']
+    assert names("/employees/6/structure/1") == ['Kevin Malone Jr.']
+    assert names("/employees/2/structure/2") == ['Kevin Malone Jr.', 'Oscar Martinez']
+    requests.put(BASE_URL + "/employees/8", json={"managerID": 5, "name": "Kevin Malone"})
+    assert names("/employees/5/structure/all") == ['Kevin Malone', 'Oscar Martinez']
+    assert requests.get(BASE_URL + "/employees/6/structure/1").status_code == 404
+
+
+@pytest.mark.parametrize("path, change", [
+    ("/employees", ("put", "/employees/12", {"name": "Erin Hannon"})),
+    ("/companies/2/employees", ("post", "/employees", {"name": "Jian Yang", "email": "jian@pp.com", "companyID": 2})),
+    ("/employees/5/structure/1", ("put", "/employees/9", {"email": "oscar@dm.com"})),
+    ("/companies", ("post", "/companies", {"name": "Hooli"}))
+])
+def test_conditional_get(path, change):
+    response = requests.get(BASE_URL + path)
+    etag = response.headers['ETag']
+    response = requests.get(BASE_URL + path, headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.content == b''
+    method, change_path, data = change
+    getattr(requests, method)(BASE_URL + change_path, json=data)
+    response = requests.get(BASE_URL + path, headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+
+def test_instrumentation():
+    response = requests.put(BASE_URL + "/employees/11", json={"name": "Nellie Bertram"})
+    timings = {t.split(';')[0].strip(): t for t in response.headers['Server-Timing'].split(',')}
+    assert set(timings) == {'total', 'sql', 'serialization'} and 'statements' in timings['sql']
+    metrics = requests.get(BASE_URL + "/metrics").text
+    assert 'companify_request_duration_seconds_count{method="PUT",route="/employees/<id>",status="200"}' in metrics
+    assert 'companify_request_sql_statements_bucket{method="PUT",route="/employees/<id>",le="+Inf"}' in metrics
+
+
+def test_isolated_database(isolated_database):
+    assert requests.delete(BASE_URL + "/employees/2").status_code == 200
+    assert requests.get(BASE_URL + "/employees/2").status_code == 404
+    assert requests.post(BASE_URL + "/tests/restore", json={"name": "missing"}).status_code == 404
+
+
+def test_after_isolated_database():
+    assert requests.get(BASE_URL + "/employees/2").status_code == 200
+    assert [e['name'] for e in requests.get(BASE_URL + "/employees/2/structure/1").json()] == ['Pam Beesly Halpert', 'Angela Martin', 'Jim Halpert']
+
+
+def wait_for_job(jobID, timeout=10):
+    for _ in range(timeout * 20):
+        job = requests.get(BASE_URL + "/jobs/" + str(jobID)).json()
+        if job['status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError('job {} still {}'.format(jobID, job['status']))
+
+
+@pytest.mark.parametrize("moves, expected_status, expected_result", [
+    ([{"employeeID":10, "companyID":3}, {"employeeID":12, "companyID":3, "managerID":10}], 'succeeded', [11, 13]),
+    ([{"employeeID":10, "companyID":3}, {"employeeID":12, "companyID":100}], 'failed', [1])
+])
+def test_reorg_job(isolated_database, moves, expected_status, expected_result):
+    response = requests.post(BASE_URL + "/jobs/reorg", json={"moves": moves})
+    assert response.status_code == 202 and response.headers['Location'].endswith("/jobs/" + str(response.json()['jobID']))
+    job = wait_for_job(response.json()['jobID'])
+    if job['status'] == 'succeeded':
+        assert [e['employeeID'] for e in job['result']['employees']] == [10, 12]
+        result = [e['employeeID'] for e in job['result']['indirect_changes']['employees']]
+        assert requests.get(BASE_URL + "/employees/12").json()['managerID'] == 10
+    else:
+        result = [e['index'] for e in job['result']['errors']]
+        assert requests.get(BASE_URL + "/employees/10").json()['companyID'] == 1
+    assert job['status'] == expected_status and result == expected_result
+
+
+def test_change_feed(isolated_database):
+    since = 0
+    while True:
+        feed = requests.get(BASE_URL + "/changes", params={"since": since, "limit": 1000}).json()
+        since = feed['next']
+        if not feed['has_more']:
+            break
+    requests.put(BASE_URL + "/employees/10", json={"companyID": 3})
+    requests.delete(BASE_URL + "/employees/2")
+    requests.post(BASE_URL + "/companies", json={"name": "Raviga"})
+
+    changes = []
+    while True:
+        feed = requests.get(BASE_URL + "/changes", params={"since": since, "limit": 3}).json()
+        assert len(feed['changes']) <= 3
+        changes += feed['changes']
+        since = feed['next']
+        if not feed['has_more']:
+            break
+    assert [(c['entity'], c['entityID'], c['operation']) for c in changes] == [
+        ('employee', 10, 'update'), ('employee', 11, 'update'), ('employee', 12, 'update'), ('employee', 13, 'update'),
+        ('employee', 2, 'delete'), ('employee', 4, 'update'), ('employee', 5, 'update'), ('employee', 6, 'update'),
+        ('company', 6, 'insert')]
+    assert changes[0]['data']['companyID'] == 3 and all(c['data']['managerID'] is None for c in changes[1:4] + changes[5:8])
+    assert changes[4]['data'] is None and changes[8]['data']['name'] == 'Raviga'
+    assert requests.get(BASE_URL + "/changes", params={"since": since}).json() == {'changes': [], 'next': since, 'has_more': False}
+
+
+def assert_aggregates(companyID):
+    managers = requests.get(BASE_URL + "/companies/" + str(companyID) + "/managers").json()
+    assert [m['headcount'] for m in managers] == sorted((m['headcount'] for m in managers), reverse=True)
+    for manager in managers:
+        structure = requests.get(BASE_URL + "/employees/" + str(manager['employeeID']) + "/structure/all").json()
+        assert manager['headcount'] == len(structure)
+        assert manager['directReports'] == len([e for e in structure if e['level'] == 1])
+        assert requests.get(BASE_URL + "/employees/" + str(manager['employeeID'])).json() == manager
+    return managers
+
+
+def test_employee_aggregates(isolated_database):
+    top = assert_aggregates(1)[0]
+    assert top['depth'] == 0 and top['headcount'] > 0
+    subordinate = requests.get(BASE_URL + "/employees/" + str(top['employeeID']) + "/structure/1").json()[0]
+    requests.put(BASE_URL + "/employees/" + str(subordinate['employeeID']), json={"managerID": None})
+    assert assert_aggregates(1)[0]['headcount'] < top['headcount']
+    requests.delete(BASE_URL + "/employees/" + str(top['employeeID']))
+    assert_aggregates(1)
+    assert requests.get(BASE_URL + "/companies/1/managers", params={"sort": "level"}).status_code == 400
+
+
+def test_bulk_writes_keep_aggregates(isolated_database):
+    top = assert_aggregates(1)[0]
+    subordinate = requests.get(BASE_URL + "/employees/" + str(top['employeeID']) + "/structure/1").json()[0]
+    # the subordinate goes above its old manager in the same batch
+    response = requests.put(BASE_URL + "/employees/bulk", json={"employees": [
+        {"employeeID": top['employeeID'], "managerID": subordinate['employeeID']},
+        {"employeeID": subordinate['employeeID'], "managerID": None}]})
+    assert response.status_code == 200
+    assert assert_aggregates(1)[0]['employeeID'] == subordinate['employeeID']
+    response = requests.delete(BASE_URL + "/employees/bulk", json={"employeeIDs": [top['employeeID'], subordinate['employeeID']]})
+    assert response.status_code == 200
+    assert_aggregates(1)
+
+
+@pytest.mark.parametrize("params", [{}, {"stream": "json"}, {"max_depth": 1}, {"root": 2}])
+def test_company_tree(params):
+    tree = requests.get(BASE_URL + "/companies/1/tree", params=params).json()
+    nodes = []
+    stack = [(node, 0) for node in tree]
+    while len(stack) > 0:
+        node, level = stack.pop()
+        nodes.append(node['employeeID'])
+        structure = requests.get(BASE_URL + "/employees/" + str(node['employeeID']) + "/structure/1").json()
+        if 'max_depth' not in params or level < params['max_depth']:
+            assert [e['employeeID'] for e in structure] == [s['employeeID'] for s in node['subordinates']]
+        stack.extend((sub, level + 1) for sub in node['subordinates'])
+    if 'root' in params:
+        expected = [params['root']] + [e['employeeID'] for e in requests.get(BASE_URL + "/employees/2/structure/all").json()]
+    elif 'max_depth' in params:
+        expected = [e['employeeID'] for e in requests.get(BASE_URL + "/companies/1/employees").json()
+                    if e['managerID'] is None or requests.get(BASE_URL + "/employees/" + str(e['managerID'])).json()['managerID'] is None]
+    else:
+        expected = [e['employeeID'] for e in requests.get(BASE_URL + "/companies/1/employees").json()]
+    assert sorted(nodes) == sorted(expected)
+
+
+@pytest.mark.parametrize("employeeID, expected_status", [(8, 200), (1, 404), (100, 404)])
+def test_management_chain(employeeID, expected_status):
+    response = requests.get(BASE_URL + "/employees/" + str(employeeID) + "/chain")
+    assert response.status_code == expected_status
+    if expected_status == 200:
+        chain = response.json()
+        assert [m['level'] for m in chain] == list(range(1, len(chain) + 1)) and chain[-1]['managerID'] is None
+        expected = requests.get(BASE_URL + "/employees/" + str(employeeID)).json()['managerID']
+        for manager in chain:
+            assert manager['employeeID'] == expected
+            expected = manager['managerID']
+
+
+@pytest.mark.parametrize("pairs, expected_status, expected_result", [
+    ([[8, 9], [8, 5], [8, 15], [12, 13]], 200, [5, 5, None, 10]),
+    ([[8, 9], [8], [8, 100]], 400, [1, 2])
+])
+def test_lowest_common_managers(pairs, expected_status, expected_result):
+    response = requests.post(BASE_URL + "/employees/lca", json={"pairs": pairs})
+    assert response.status_code == expected_status
+    if expected_status == 200:
+        result = [None if r['manager'] is None else r['manager']['employeeID'] for r in response.json()]
+        assert [r['employeeIDs'] for r in response.json()] == pairs
+    else:
+        result = [e['index'] for e in response.json()['errors']]
+    assert result == expected_result
+
+
+def test_delete_company(isolated_database):
+    employees = [e['employeeID'] for e in requests.get(BASE_URL + "/companies/2/employees").json()]
+    response = requests.delete(BASE_URL + "/companies/2")
+    assert response.status_code == 200 and response.json()['company']['companyID'] == 2
+    changed = response.json()['indirect_changes']['employees']
+    assert [e['employeeID'] for e in changed] == employees
+    assert all(e['companyID'] is None and e['managerID'] is None for e in changed)
+    assert requests.get(BASE_URL + "/companies/2").status_code == 404
+    assert requests.get(BASE_URL + "/employees/" + str(employees[0])).json()['companyID'] is None
+
+    employees = [e['employeeID'] for c in (1, 3) for e in requests.get(BASE_URL + "/companies/" + str(c) + "/employees").json()]
+    response = requests.delete(BASE_URL + "/companies/bulk", params={"employees": "delete"}, json={"companyIDs": [1, 2]})
+    assert response.status_code == 400 and [e['index'] for e in response.json()['errors']] == [1]
+    response = requests.delete(BASE_URL + "/companies/bulk", params={"employees": "delete"}, json={"companyIDs": [1, 3]})
+    assert response.status_code == 200 and [c['companyID'] for c in response.json()['companies']] == [1, 3]
+    assert [e['employeeID'] for e in response.json()['indirect_changes']['employees']] == employees
+    assert all(requests.get(BASE_URL + "/employees/" + str(e)).status_code == 404 for e in employees)
+
+
+def test_export_import(isolated_database):
+    companies = requests.get(BASE_URL + "/export/companies", params={"format": "csv"}).text
+    employees = requests.get(BASE_URL + "/export/employees").text
+    columnar = requests.get(BASE_URL + "/export/employees", params={"format": "columnar"}).text.splitlines()
+    assert json.loads(columnar[0])['columns'] == ['employeeID', 'name', 'email', 'companyID', 'managerID']
+    assert [json.loads(line) for line in employees.splitlines()] == requests.get(BASE_URL + "/employees").json()
+
+    companyIDs = [c['companyID'] for c in requests.get(BASE_URL + "/companies").json()]
+    requests.delete(BASE_URL + "/companies/bulk", params={"employees": "delete"}, json={"companyIDs": companyIDs})
+    requests.delete(BASE_URL + "/employees/bulk", json={"employeeIDs": [e['employeeID'] for e in requests.get(BASE_URL + "/employees").json()]})
+    response = requests.post(BASE_URL + "/import/companies", params={"format": "csv"}, data=companies)
+    assert response.status_code == 200 and response.json()['imported'] == len(companyIDs)
+    # subordinates first: their managers are only assigned once the whole file is read
+    reversed_employees = '\n'.join(reversed(employees.splitlines()))
+    invalid = [{"name": "Gavin", "email": "gavin@hooli.xyz", "companyID": 1, "managerID": 1000},
+               {"name": "Repeated", "email": json.loads(employees.splitlines()[0])['email']}, {"email": "nameless@hooli.xyz"}]
+    response = requests.post(BASE_URL + "/import/employees", data=reversed_employees + '\n' + '\n'.join(map(json.dumps, invalid)) + '\n{')
+    report = response.json()
+    assert response.status_code == 200 and report['imported'] == len(employees.splitlines()) + 1 and report['rejected'] == 3
+    assert [e['error']['error_code'] for e in report['errors']] == [aeh.SQL_NOT_FOUND, aeh.SQL_CONSTRAINT_FAILED, aeh.HTTP_MISSING_PARAMS, aeh.HTTP_PARAM_TYPE]
+    assert requests.get(BASE_URL + "/export/employees").text.splitlines()[:-1] == employees.splitlines()
+    assert_aggregates(1)
+    assert requests.post(BASE_URL + "/import/employees", params={"format": "xml"}, data='').status_code == 400
+
+
+def test_admission_control():
+    greedy = {"X-Client-ID": "greedy"}
+    requests.post(BASE_URL + "/tests/quota", json={"client": "greedy", "rate": 0.5, "burst": 3})
+    statuses = [requests.get(BASE_URL + "/employees/1/structure/all", headers=greedy).status_code for _ in range(4)]
+    assert statuses[:3] == [200] * 3 and statuses[3] == 429
+    response = requests.get(BASE_URL + "/employees/1", headers=greedy)
+    assert response.status_code == 429 and response.headers['Retry-After'] == '2'
+    assert response.json()['error']['error_code'] == aeh.HTTP_TOO_MANY_REQUESTS
+    # a client over its quota is turned away before the cost of its request is estimated
+    response = requests.get(BASE_URL + "/companies/1/tree", headers=greedy)
+    assert response.status_code == 429 and 'desc="0 statements"' in response.headers['Server-Timing']
+    # other clients have their own quotas
+    assert requests.get(BASE_URL + "/employees/1").status_code == 200
+    assert requests.get(BASE_URL + "/employees/1", headers={"X-Client-ID": "polite"}).status_code == 200
+
+
+def test_admission_buckets(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(basedir, os.pardir, 'src'))
+    import routes.api_admission as api_admission
+    monkeypatch.setattr(api_admission, 'MAX_BUCKETS', 2)
+
+    admission = api_admission.AdmissionControl(1, 2, {}, 100, 10, 1)
+    assert admission.admit('a', 1) == 0 and admission.admit('b', 1) == 0
+    # the client seen least recently is dropped first, so the map never grows past the bound
+    assert admission.admit('a', 1) == 0 and admission.admit('c', 1) == 0
+    assert list(admission.buckets) == ['a', 'c']
+    # a base token taken for a request turned away afterwards is given back
+    assert admission.admit('c', 2) > 0
+    admission.refund('c', 1)
+    assert admission.buckets['c'].tokens >= 2
+
+
+# Schema of the databases created before the versioned migrations (the first release).
+BASELINE_SCHEMA = '''
+    CREATE TABLE "Companies" ("companyID" INTEGER NOT NULL, name VARCHAR(80), PRIMARY KEY ("companyID"), UNIQUE (name));
+    CREATE TABLE "Employees" ("employeeID" INTEGER NOT NULL, name VARCHAR(80) NOT NULL, email VARCHAR(80), "companyID" INTEGER,
+        "managerID" INTEGER, PRIMARY KEY ("employeeID"), UNIQUE (email),
+        FOREIGN KEY("companyID") REFERENCES "Companies" ("companyID"), FOREIGN KEY("managerID") REFERENCES "Employees" ("employeeID"));
+    CREATE TRIGGER change_manager_after_update_companyID AFTER UPDATE OF companyID ON Employees
+    BEGIN
+        UPDATE Employees SET managerID = NULL
+        WHERE (managerID = OLD.employeeID) OR (employeeID = NEW.employeeID AND NEW.managerID = OLD.managerID);
+    END;
+'''
+# Databases created after the hierarchy index was added, but before the versioned migrations.
+HIERARCHY_INDEX_SCHEMA = BASELINE_SCHEMA + '''
+    ALTER TABLE Employees ADD COLUMN path VARCHAR(1024);
+    ALTER TABLE Employees ADD COLUMN depth INTEGER NOT NULL DEFAULT 0;
+    CREATE INDEX "ix_Employees_path" ON "Employees" (path);
+'''
+
+
+@pytest.mark.parametrize("schema", [BASELINE_SCHEMA, HIERARCHY_INDEX_SCHEMA])
+def test_upgrade_from_older_schema(tmp_path, monkeypatch, schema):
+    database = tmp_path / 'older.sqlite'
+    with sqlite3.connect(database) as connection:
+        connection.executescript(schema)
+        connection.executemany('INSERT INTO Companies VALUES (?, ?)', [(i + 1, c['name']) for i, c in enumerate(base_companies)])
+        connection.executemany('INSERT INTO Employees (employeeID, name, email, companyID, managerID) VALUES (?, ?, ?, ?, ?)', [(i + 1, e['name'], e['email'], e.get('companyID'), e.get('managerID'))
+                                                                               for i, e in enumerate(base_employees)])
+    monkeypatch.setenv('COMPANIFY_DATABASE_URI', 'sqlite:///' + str(database))
+    monkeypatch.syspath_prepend(os.path.join(basedir, os.pardir, 'src'))
+    from app.app_core import db, create_app, run_modes
+    from models.migrations import upgrade, get_version, LATEST_VERSION
+    from models.employee_model import Employee
+    from models.hierarchy import compute_index
+
+    app = create_app(run_modes['debug'])
+    with app.app_context():
+        upgrade()
+        assert get_version() == LATEST_VERSION
+        employees = Employee.query.order_by(Employee.employeeID).all()
+        index = compute_index((e.employeeID, e.managerID) for e in employees)
+        assert [(e.path, e.depth, e.headcount, e.directReports) for e in employees] == [index[e.employeeID] for e in employees]
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_org_graph_writes_are_copy_on_write(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(basedir, os.pardir, 'src'))
+    from models.org_graph import CompanyGraph, OrgGraph
+
+    graph = OrgGraph()
+    graph.companies[1] = CompanyGraph([(1, None), (2, 1), (3, 1), (4, 2)], 1)
+    read = graph.companies[1]
+    graph.apply({1: 1}, {1: 2}, [('move', 1, 4, 3), ('remove', 1, 2), ('add', 1, 5, 4)])
+    # a reader holding the graph from before the write still walks it whole
+    assert read.subtree(1) == [(2, 1), (3, 1), (4, 2)]
+    assert graph.companies[1].subtree(1) == [(3, 1), (4, 2), (5, 3)]
+    assert graph.companies[1].version == 2